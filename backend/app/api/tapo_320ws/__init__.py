@@ -7,6 +7,11 @@ from app.api.tapo_320ws.light import router as light_router
 from app.api.tapo_320ws.stream import router as stream_router
 from app.api.tapo_320ws.night import router as night_router
 from app.api.tapo_320ws.recordings import router as recordings_router
+from app.api.tapo_320ws.hls import router as hls_router
+from app.api.tapo_320ws.snapshot import router as snapshot_router
+from app.api.tapo_320ws.metrics import router as metrics_router
+from app.api.tapo_320ws.mosaic import router as mosaic_router
+from app.api.tapo_320ws.clips import router as clips_router
 
 router = APIRouter()
 
@@ -15,3 +20,8 @@ router.include_router(light_router, tags=["Light"])
 router.include_router(stream_router, tags=["Stream"])
 router.include_router(night_router, tags=["Night"])
 router.include_router(recordings_router, tags=["Recordings"])
+router.include_router(hls_router, tags=["HLS"])
+router.include_router(snapshot_router, tags=["Snapshot"])
+router.include_router(metrics_router, tags=["Metrics"])
+router.include_router(mosaic_router, tags=["Mosaic"])
+router.include_router(clips_router, tags=["Clips"])
@@ -0,0 +1,46 @@
+"""
+API endpoint for listing and downloading event clips saved on alarm
+"""
+import os
+from fastapi import APIRouter
+from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse, FileResponse
+from app.api.tapo_320ws.hls import hls_manager
+from app.camera.tapo_320ws.clips import ClipRecorder
+from app.utils.logger import Logger
+
+# route /tapo-320ws/clips
+router = APIRouter()
+clip_recorder = ClipRecorder(hls_manager)
+logger = Logger('server_logger.api/tapo_320ws/clips').get_child_logger()
+
+
+@router.get("/clips/{name}")
+async def get_clips(name: str) -> JSONResponse:
+    """
+    Lists event clips of a camera
+    Args:
+        name: name of the camera
+
+    Returns: List[clip file names], oldest first
+    """
+    logger.info('[GET][/tapo-320ws/clips] %s', name)
+    return JSONResponse(status_code=200, content=clip_recorder.list_clips(name))
+
+
+@router.get("/clips/{name}/{filename}")
+async def get_clip(name: str, filename: str) -> FileResponse:
+    """
+    Downloads an event clip
+    Args:
+        name:       name of the camera
+        filename:   clip file name from the clip list
+
+    Returns: MP4 clip
+    """
+    if filename not in clip_recorder.list_clips(name):
+        raise HTTPException(status_code=404, detail=f"Clip {filename} not found")
+
+    logger.info('[GET][/tapo-320ws/clips] %s sent to client', filename)
+    return FileResponse(os.path.join(clip_recorder.path_clips, filename), media_type="video/mp4",
+                        filename=filename)
@@ -0,0 +1,141 @@
+"""
+API endpoints for live HLS playback - playlist and segments served from a shared per-camera segmenter
+"""
+import os
+import time
+from fastapi import APIRouter
+from fastapi.exceptions import HTTPException
+from fastapi.responses import FileResponse, JSONResponse, Response
+from app.camera.tapo_320ws.interface import Tapo320WSBaseInterface
+from app.camera.tapo_320ws.hls import (HLSManager, HLSSegmenter, HLS_SEGMENT_SECONDS, HLS_LIST_SIZE, HLS_RING_SIZE,
+                                       SEGMENT_PATTERN, TIMESHIFT_CAMERAS)
+from app.camera.tapo_320ws.utils import get_auth_by_name, build_stream_url
+from app.utils.logger import Logger
+
+# route /tapo-320ws/hls
+router = APIRouter()
+hls_manager = HLSManager()
+logger = Logger('server_logger.api/tapo_320ws/hls').get_child_logger()
+
+# seconds to wait for the first playlist after starting a segmenter (RTSP handshake + first segment)
+PLAYLIST_TIMEOUT = 4 * HLS_SEGMENT_SECONDS + 10
+PLAYLIST_MEDIA_TYPE = "application/vnd.apple.mpegurl"
+
+
+async def start_timeshift(names: list = None):
+    """
+    Starts segmenters of the cameras whose timeshift buffer is filled all the time
+    Args:
+        names: camera names (default TIMESHIFT_CAMERAS from .env)
+    """
+    for name in TIMESHIFT_CAMERAS if names is None else names:
+        try:
+            ip, _, _, camera_username, camera_password = get_auth_by_name(name)
+        except TypeError:
+            logger.error('Timeshift camera %s not found', name)
+            continue
+        await hls_manager.pin(name, build_stream_url(ip, camera_username, camera_password))
+
+
+async def get_ready_segmenter(name: str) -> HLSSegmenter:
+    """
+    Returns running segmenter of the camera with a playlist, starts it if needed
+    """
+    segmenter = hls_manager.get_running(name)
+    if segmenter is None:
+        interface = Tapo320WSBaseInterface(name)
+        segmenter = await hls_manager.get_segmenter(name, interface.get_stream_url())
+
+    if not await segmenter.wait_for_playlist(PLAYLIST_TIMEOUT):
+        logger.error('[GET][/tapo-320ws/hls] %s - playlist not available', name)
+        raise HTTPException(status_code=504, detail=f"HLS stream of camera {name} is not available")
+
+    return segmenter
+
+
+@router.get("/hls/{name}/index.m3u8")
+async def get_hls_playlist(name: str) -> Response:
+    """
+    Gets live HLS playlist of a camera, starts the segmenter on first request
+    Args:
+        name: name of the camera
+
+    Returns: m3u8 playlist, segment URIs are relative to the playlist
+    """
+    segmenter = await get_ready_segmenter(name)
+
+    if HLS_RING_SIZE > HLS_LIST_SIZE:
+        # ring holds the timeshift buffer -> live viewers only get the last segments
+        playlist = segmenter.live_playlist().encode('utf-8')
+    else:
+        with open(segmenter.playlist_path, 'rb') as file:
+            playlist = file.read()
+
+    logger.info('[GET][/tapo-320ws/hls] %s', name)
+
+    # playlist changes every segment -> never cache
+    return Response(content=playlist, media_type=PLAYLIST_MEDIA_TYPE, headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/hls/{name}/timeshift")
+async def get_timeshift_url(name: str, offset: float = 0) -> JSONResponse:
+    """
+    Gets playlist URL for playback starting offset seconds in the past (rewind)
+    Args:
+        name:   name of the camera
+        offset: seconds before now, clamped to the buffered video
+
+    Returns: dict with playlist URL (fixed start time, stable across playlist reloads),
+    start time (unix seconds) and seconds of buffered video
+    """
+    segmenter = await get_ready_segmenter(name)
+    buffered = segmenter.buffered_seconds()
+    start = time.time() - min(max(offset, 0.0), buffered)
+
+    logger.info('[GET][/tapo-320ws/hls/timeshift] %s offset %s', name, offset)
+
+    return JSONResponse(status_code=200, content={
+        "playlistUrl": f"/tapo-320ws/hls/{name}/timeshift.m3u8?start={start:.3f}",
+        "start": start,
+        "bufferedSeconds": buffered,
+    })
+
+
+@router.get("/hls/{name}/timeshift.m3u8")
+async def get_timeshift_playlist(name: str, start: float) -> Response:
+    """
+    Gets HLS playlist from the given time up to the live edge, players start at its beginning
+    Args:
+        name:   name of the camera
+        start:  unix time to start from (see /hls/{name}/timeshift)
+
+    Returns: m3u8 playlist, segment URIs are relative to the playlist
+    """
+    segmenter = await get_ready_segmenter(name)
+
+    return Response(content=segmenter.timeshift_playlist(start), media_type=PLAYLIST_MEDIA_TYPE,
+                    headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/hls/{name}/{segment}")
+async def get_hls_segment(name: str, segment: str) -> FileResponse:
+    """
+    Gets one HLS segment of a running segmenter
+    Args:
+        name:       name of the camera
+        segment:    segment file name from the playlist
+
+    Returns: MPEG-TS segment
+    """
+    segmenter = hls_manager.get_running(name)
+    if segmenter is None or not SEGMENT_PATTERN.match(segment):
+        raise HTTPException(status_code=404, detail=f"Segment {segment} not found")
+
+    segment_path = os.path.join(segmenter.output_dir, segment)
+    if not os.path.isfile(segment_path):
+        raise HTTPException(status_code=404, detail=f"Segment {segment} not found")
+
+    # segments never change and their names are unique across segmenter restarts (see HLSSegmenter.start)
+    # -> cacheable for as long as they stay in the ring
+    return FileResponse(segment_path, media_type="video/mp2t",
+                        headers={"Cache-Control": f"public, max-age={HLS_SEGMENT_SECONDS * HLS_RING_SIZE}"})
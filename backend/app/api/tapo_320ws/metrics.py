@@ -0,0 +1,32 @@
+"""
+API endpoint for live streaming performance metrics
+"""
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from app.api.tapo_320ws.stream import streamer, fmp4_streamer
+from app.api.tapo_320ws.hls import hls_manager
+from app.api.tapo_320ws.mosaic import mosaic_streamer
+from app.utils.logger import Logger
+
+# route /tapo-320ws/metrics
+router = APIRouter()
+logger = Logger('server_logger.api/tapo_320ws/metrics').get_child_logger()
+
+
+@router.get("/metrics")
+async def get_metrics() -> JSONResponse:
+    """
+    Gets metrics of all live streams - capture FPS, decode/encode times, frame sizes,
+    queue depths, per-client send times and dropped frames
+    Returns: dict with metrics of JPEG, fMP4 and mosaic streams (keyed by stream URL without credentials)
+    and running HLS segmenters
+    """
+    logger.debug('[GET][/tapo-320ws/metrics]')
+
+    return JSONResponse(status_code=200, content={
+        "jpeg": streamer.get_metrics(),
+        "fmp4": fmp4_streamer.get_metrics(),
+        "mosaic": mosaic_streamer.get_metrics(),
+        "hls": sorted(name for name, segmenter in hls_manager.segmenters.items() if segmenter.is_running()),
+    })
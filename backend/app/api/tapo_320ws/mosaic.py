@@ -0,0 +1,127 @@
+"""
+API endpoints for the multi-camera mosaic stream
+"""
+import asyncio
+from typing import Optional
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, WebSocketException, status
+from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
+from app.api.tapo_320ws.stream import streamer
+from app.camera.tapo_320ws.mjpeg import MJPEGSink, MJPEG_MEDIA_TYPE, mjpeg_stream
+from app.camera.tapo_320ws.mosaic import MosaicStreamer, MosaicLayout, MOSAIC_FPS, MOSAIC_TILE_WIDTH, default_columns
+from app.camera.tapo_320ws.utils import get_auth_by_name, build_stream_url, list_tapo_320ws_camera_names
+from app.camera.tapo_320ws.video_stream import (TRANSPORTS, TRANSPORT_TEXT, TRANSPORT_BINARY, TRANSPORT_MJPEG,
+                                                QUALITY_THUMB, FRAME_HEADER, get_camera_id)
+from app.utils.logger import Logger
+
+# limits of a mosaic request
+MOSAIC_MAX_CAMERAS = 16
+MOSAIC_MAX_FPS = 10
+
+# route /tapo-320ws/mosaic
+router = APIRouter()
+mosaic_streamer = MosaicStreamer(streamer)
+logger = Logger('server_logger.api/tapo_320ws/mosaic').get_child_logger()
+
+
+def get_layout(cameras: Optional[str], columns: Optional[int], tile_width: int, fps: float) -> MosaicLayout:
+    """
+    Builds mosaic layout from request parameters
+    Args:
+        cameras:    comma separated camera names (default all cameras)
+        columns:    tiles per row (default most square grid)
+        tile_width: width of one tile in pixels
+        fps:        mosaic frames per second
+
+    Returns: layout, raises HTTPException for invalid parameters or unknown cameras
+    """
+    names = [name for name in cameras.split(',') if name] if cameras else list_tapo_320ws_camera_names()
+    if not 0 < len(names) <= MOSAIC_MAX_CAMERAS:
+        raise HTTPException(status_code=422, detail=f"Mosaic needs 1 to {MOSAIC_MAX_CAMERAS} cameras")
+    if not 0 < fps <= MOSAIC_MAX_FPS or not 64 <= tile_width <= 1280 or (columns is not None and columns < 1):
+        raise HTTPException(status_code=422, detail="Invalid mosaic geometry")
+
+    layout_cameras = []
+    for name in names:
+        try:
+            ip, _, _, camera_username, camera_password = get_auth_by_name(name)
+        except TypeError as error:
+            raise HTTPException(status_code=404, detail=f"Camera with name: {name} not found.") from error
+        layout_cameras.append((name, build_stream_url(ip, camera_username, camera_password, QUALITY_THUMB)))
+
+    return MosaicLayout(tuple(layout_cameras), columns or default_columns(len(names)), tile_width, fps)
+
+
+@router.get("/mosaic/mjpeg")
+async def get_mosaic_mjpeg(cameras: Optional[str] = None, columns: Optional[int] = None,
+                           tile_width: int = MOSAIC_TILE_WIDTH, fps: float = MOSAIC_FPS) -> StreamingResponse:
+    """
+    Streams mosaic of several cameras as MJPEG (see /stream/mjpeg)
+    Args:
+        cameras: comma separated camera names (default all cameras)
+        columns: tiles per row (default most square grid)
+        tile_width: width of one camera tile in pixels
+        fps: mosaic frames per second
+
+    Returns: endless multipart response, one JPEG per part
+    """
+    layout = get_layout(cameras, columns, tile_width, fps)
+    logger.info('[GET][/tapo-320ws/mosaic/mjpeg] %s', layout.key)
+
+    sink = MJPEGSink()
+    key = mosaic_streamer.add_layout_client(layout, sink, TRANSPORT_MJPEG)
+
+    return StreamingResponse(mjpeg_stream(mosaic_streamer, key, sink), media_type=MJPEG_MEDIA_TYPE,
+                             headers={"Cache-Control": "no-cache, no-store", "X-Accel-Buffering": "no"})
+
+
+@router.websocket("/mosaic/ws")
+async def websocket_mosaic(websocket: WebSocket, cameras: Optional[str] = None, columns: Optional[int] = None,
+                           tile_width: int = MOSAIC_TILE_WIDTH, fps: float = MOSAIC_FPS,
+                           transport: str = TRANSPORT_TEXT, heartbeat: bool = False):
+    """
+    Streams mosaic of several cameras via WebSocket, messages are the same as of /stream/ws/{name} in jpeg format
+    Args:
+        websocket: WebSocket connection
+        cameras: comma separated camera names (default all cameras)
+        columns: tiles per row (default most square grid)
+        tile_width: width of one camera tile in pixels
+        fps: mosaic frames per second
+        transport: 'text' (base64 data URLs, default) or 'binary' (header + raw JPEG bytes)
+        heartbeat: JSON text pings, see /stream/ws/{name}
+    """
+    try:
+        if transport not in TRANSPORTS:
+            raise HTTPException(status_code=422, detail=f"Unknown transport: {transport}")
+        layout = get_layout(cameras, columns, tile_width, fps)
+    except HTTPException as error:
+        logger.info('[WEBSOCKET][/tapo-320ws/mosaic] invalid request: %s', error.detail)
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+
+    key = None
+    try:
+        logger.info('[WEBSOCKET][/tapo-320ws/mosaic] %s (%s)', layout.key, transport)
+        await websocket.accept()
+
+        if transport == TRANSPORT_BINARY:
+            await websocket.send_json({
+                "transport": TRANSPORT_BINARY,
+                "cameraId": get_camera_id(layout.key),
+                "headerSize": FRAME_HEADER.size
+            })
+
+        key = mosaic_streamer.add_layout_client(layout, websocket, transport)
+
+        # keep WebSocket connection alive, the client is removed when it disconnects or misses the heartbeat
+        await mosaic_streamer.watch_client(key, websocket, heartbeat)
+
+    except asyncio.TimeoutError:
+        logger.info('[WEBSOCKET][/tapo-320ws/mosaic] client missed the heartbeat, closing connection')
+        await websocket.close(code=status.WS_1001_GOING_AWAY)
+
+    except (WebSocketDisconnect, WebSocketException) as error:
+        logger.info('[WEBSOCKET][/tapo-320ws/mosaic] client disconnected: %s', error)
+        if key is not None:
+            mosaic_streamer.remove_client(key, websocket)
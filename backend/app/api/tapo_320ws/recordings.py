@@ -1,16 +1,20 @@
 """
 API endpoint for listing and downloading camera recordings to the server
 """
+import asyncio
+import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from fastapi import APIRouter
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.exceptions import HTTPException
 from pydantic import BaseModel
-from app.camera.tapo_320ws.utils import get_downloaded_recordings
+from app.camera.tapo_320ws.utils import get_downloaded_recordings, get_auth_by_name, build_stream_url
+from app.camera.tapo_320ws.nvr import NVRRecorder, RecordingIndex, NVR_CAMERAS
 from app.camera.tapo_320ws.interface import Tapo320WSBaseInterface
 from app.utils.time_utils import iter_dates, timestamp_to_string
-from app.camera.tapo_320ws.download import download_async
+from app.camera.tapo_320ws.download import iter_download
+from app.camera.tapo_320ws.download_jobs import DownloadJobManager
 from app.utils.logger import Logger
 
 # route /camera/info
@@ -21,6 +25,16 @@ logger = Logger('server_logger.api/tapo_320ws/recordings').get_child_logger()
 RECORDINGS_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 RECORDINGS_PATH = os.path.join(RECORDINGS_PATH, 'recordings')
 
+# local recordings (NVR), their ids are prefixed to tell them apart from camera recordings
+recording_index = RecordingIndex()
+nvr_recorder = NVRRecorder(recording_index)
+LOCAL_ID_PREFIX = 'nvr_'
+
+# background downloads of camera recordings
+download_jobs = DownloadJobManager()
+# seconds a cancel request waits for the job to stop
+JOB_CANCEL_TIMEOUT = 5
+
 
 class DownloadRecordingsBody(BaseModel):
     """
@@ -30,9 +44,50 @@ class DownloadRecordingsBody(BaseModel):
     date: str
 
 
+def start_nvr(names: list = None):
+    """
+    Starts continuous local recording of cameras
+    Args:
+        names: camera names (default NVR_CAMERAS from .env)
+    """
+    for name in NVR_CAMERAS if names is None else names:
+        try:
+            ip, _, _, camera_username, camera_password = get_auth_by_name(name)
+        except TypeError:
+            logger.error('NVR camera %s not found', name)
+            continue
+        nvr_recorder.start(name, build_stream_url(ip, camera_username, camera_password))
+
+
+def get_local_recordings(name: str, start_date: str, end_date: str) -> list:
+    """
+    Lists locally recorded segments of a camera in the format of camera recordings
+    Args:
+        name:       name of the camera
+        start_date: start of the interval (YYYY-MM-DD)
+        end_date:   end of the interval (YYYY-MM-DD, inclusive)
+
+    Returns: List[recordings]
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
+
+    results = []
+    for segment in recording_index.find(name, start.timestamp(), end.timestamp()):
+        results.append({
+            "startTime": timestamp_to_string(segment["start_time"]),
+            "endTime": timestamp_to_string(segment["end_time"]),
+            "duration_seconds": round(segment["end_time"] - segment["start_time"]),
+            "date": datetime.fromtimestamp(segment["start_time"]).strftime("%Y-%m-%d"),
+            "id": f"{LOCAL_ID_PREFIX}{segment['id']}",
+            "downloaded": True,
+        })
+    return results
+
+
 # Retrieve camera info
 @router.get("/recordings/{name}")
-async def get_recordings(name: str, start_date: str, end_date: str) -> JSONResponse:
+async def get_recordings(name: str, start_date: str, end_date: str, source: str = 'camera') -> JSONResponse:
     """
     Gets information about a camera
     Args:
@@ -41,9 +96,14 @@ async def get_recordings(name: str, start_date: str, end_date: str) -> JSONRespo
         DATE FORMAT: YYYY-MM-DD
         start_date: start of the interval
         end_date: end of the interval
+        source: 'camera' (SD card) or 'local' (segments recorded by the server, see nvr module)
 
     Returns: List[recordings]
     """
+    if source == 'local':
+        logger.info('[GET][/tapo-w320s/recordings] local %s:\t%s - %s', name, start_date, end_date)
+        return JSONResponse(status_code=200, content=get_local_recordings(name, start_date, end_date))
+
     # connect to interface
     interface = Tapo320WSBaseInterface(name)
 
@@ -80,7 +140,8 @@ async def get_recordings(name: str, start_date: str, end_date: str) -> JSONRespo
 @router.post("/recordings/{name}")
 async def download_recordings(name: str, body: DownloadRecordingsBody) -> JSONResponse:
     """
-    Downloads recording from camera of {name} to /recordings to be later uploaded to web app
+    Queues download of a recording from camera of {name} to /recordings to be later uploaded to web app,
+    progress is available at /recordings/jobs/{job_id}
     Args:
         name:       name of the camera
 
@@ -88,21 +149,81 @@ async def download_recordings(name: str, body: DownloadRecordingsBody) -> JSONRe
         date:       date of the recordings
         id:         id of the recording
 
-    Returns:        None
+    Returns:        job status (jobId, state, currentAction, progress, total)
     """
     # format date
     logger.info('[POST][/tapo-w320s/recordings] request -  %s:\t%s', name, body.date)
     date = datetime.strptime(body.date, "%Y-%m-%d")
     date = date.strftime("%Y%m%d")
 
-    # connect to interface
-    interface = Tapo320WSBaseInterface(name)
+    # recording already being downloaded -> share the transfer instead of opening another camera session
+    job = download_jobs.join(name, body.date, body.id)
+    if job is None:
+        # connect to interface
+        interface = Tapo320WSBaseInterface(name)
+
+        job = download_jobs.submit(name, body.date, body.id,
+                                   iter_download(interface.tapo_interface, name, date, body.id))
+
+    logger.info('[POST][/tapo-w320s/recordings] queued - %s:\t%s as job %s', name, body.date, job.id)
+
+    return JSONResponse(status_code=202, content=job.to_dict())
 
-    await download_async(interface.tapo_interface, name, date, body.id)
 
-    logger.info('[POST][/tapo-w320s/recordings] downloaded - %s:\t%s', name, body.date)
+@router.get("/recordings/jobs/{job_id}")
+async def get_download_job(job_id: str) -> JSONResponse:
+    """
+    Status of a download job
+    Args:
+        job_id: id returned by POST /recordings/{name}
+
+    Returns: job status (state: queued, running, finished, failed or cancelled)
+    """
+    job = download_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Download job {job_id} not found")
+    return JSONResponse(status_code=200, content=job.to_dict())
+
+
+@router.get("/recordings/jobs/{job_id}/events")
+async def follow_download_job(job_id: str) -> StreamingResponse:
+    """
+    Streams status of a download job as server-sent events until the job ends,
+    authenticated by ?token= (see /stream-token) or ?api_key= for EventSource clients
+    Args:
+        job_id: id returned by POST /recordings/{name}
+
+    Returns: text/event-stream of job statuses
+    """
+    if download_jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Download job {job_id} not found")
+
+    async def events():
+        async for status in download_jobs.follow(job_id):
+            yield f"data: {json.dumps(status)}\n\n"
 
-    return JSONResponse(status_code=200, content="Recording download successful")
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@router.delete("/recordings/jobs/{job_id}")
+async def cancel_download_job(job_id: str) -> JSONResponse:
+    """
+    Cancels a queued or running download job, its partial recording is removed. A job shared by several
+    requesters keeps running until all of them have cancelled it.
+    Args:
+        job_id: id returned by POST /recordings/{name}
+
+    Returns: job status (requesters still sharing the job)
+    """
+    job = download_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Download job {job_id} not found")
+    if job.task is not None and not job.requesters:
+        await asyncio.wait({job.task}, timeout=JOB_CANCEL_TIMEOUT)
+
+    logger.info('[DELETE][/tapo-w320s/recordings/jobs] %s', job_id)
+    return JSONResponse(status_code=200, content=job.to_dict())
 
 
 @router.delete("/recordings")
@@ -136,6 +257,20 @@ async def get_recordings_download(name: str, body: DownloadRecordingsBody) -> Fi
     recording_date = body.date
     recording_id = body.id
 
+    # locally recorded segment -> no camera session needed
+    if recording_id.startswith(LOCAL_ID_PREFIX):
+        segment_id = recording_id[len(LOCAL_ID_PREFIX):]
+        segment = recording_index.get(int(segment_id)) if segment_id.isdigit() else None
+        if segment is None or segment["camera"] != name or not os.path.isfile(segment["path"]):
+            raise HTTPException(status_code=404, detail=f"Recording {recording_id} not found")
+        extension = os.path.splitext(segment["path"])[1]
+        logger.info("Local recording %s sent to client", recording_id)
+        return FileResponse(
+            segment["path"],
+            media_type="video/mp4" if extension == ".mp4" else "video/mp2t",
+            filename=f"{name}____{recording_date}____{recording_id}{extension}",
+        )
+
     recording_filename = f"{name}____{recording_date}____{recording_id}.mp4"
     recording_file_path = os.path.join(RECORDINGS_PATH, recording_filename)
 
@@ -148,14 +283,21 @@ async def get_recordings_download(name: str, body: DownloadRecordingsBody) -> Fi
             filename=recording_filename,
         )
 
-    # recording needs to be downloaded to server
-    interface = Tapo320WSBaseInterface(name)
-
-    # format the date to YYYYMMDD
-    recording_date = datetime.strptime(recording_date, "%Y-%m-%d")
-    recording_date = recording_date.strftime("%Y%m%d")
-    logger.info("Downloading %s to server", recording_filename)
-    await download_async(interface.tapo_interface, name, recording_date, recording_id)
+    # recording needs to be downloaded to server, concurrent requests of the recording share one download job
+    job = download_jobs.join(name, recording_date, recording_id)
+    if job is None:
+        interface = Tapo320WSBaseInterface(name)
+
+        # format the date to YYYYMMDD
+        camera_date = datetime.strptime(recording_date, "%Y-%m-%d").strftime("%Y%m%d")
+        logger.info("Downloading %s to server", recording_filename)
+        job = download_jobs.submit(name, recording_date, recording_id,
+                                   iter_download(interface.tapo_interface, name, camera_date, recording_id))
+    else:
+        logger.info("Waiting for running download of %s (job %s)", recording_filename, job.id)
+
+    # asyncio.wait -> the shared download keeps running if this client disconnects
+    await asyncio.wait({job.task})
 
     # send the file to client
     if os.path.isfile(recording_file_path):
@@ -0,0 +1,71 @@
+"""
+API endpoint for getting the latest camera frame as JPEG
+"""
+from fastapi import APIRouter
+from fastapi.exceptions import HTTPException
+from fastapi.responses import Response
+from app.api.tapo_320ws.stream import streamer
+from app.camera.tapo_320ws.snapshot import SnapshotCache, borrow_session_frame
+from app.camera.tapo_320ws.utils import get_auth_by_name, build_stream_url
+from app.camera.tapo_320ws.video_stream import QUALITY_HIGH, QUALITY_WIDTHS, stream_key
+from app.utils.logger import Logger
+
+# route /tapo-320ws/snapshot
+router = APIRouter()
+snapshot_cache = SnapshotCache()
+logger = Logger('server_logger.api/tapo_320ws/snapshot').get_child_logger()
+
+
+@router.get("/snapshot/{name}")
+async def get_snapshot(name: str, quality: str = QUALITY_HIGH) -> Response:
+    """
+    Gets the most recent frame of a camera.
+    Served from a running live stream if there is one (requested tier first, then higher resolution tiers),
+    then from an open stream session without clients (warm or idle, see borrow_session_frame),
+    otherwise from a short-lived capture cached for SNAPSHOT_TTL seconds.
+    A request is never answered by a lower resolution tier, the served tier is in X-Snapshot-Quality.
+    Args:
+        name:       name of the camera
+        quality:    'high', 'low' or 'thumb' (see stream endpoint)
+
+    Returns: JPEG image
+    """
+    if quality not in QUALITY_WIDTHS:
+        raise HTTPException(status_code=422, detail=f"Unknown quality: {quality}")
+
+    # camera API is not needed -> only local database lookup
+    try:
+        ip, _, _, camera_username, camera_password = get_auth_by_name(name)
+    except TypeError as error:
+        raise HTTPException(status_code=404, detail=f"Camera with name: {name} not found.") from error
+
+    # requested tier, then the next higher resolution ones (QUALITY_WIDTHS is ordered from the highest)
+    tiers = list(QUALITY_WIDTHS)
+    tiers = tiers[tiers.index(quality)::-1]
+    for tier in tiers:
+        frame = streamer.get_latest_frame(build_stream_url(ip, camera_username, camera_password, tier), tier)
+        if frame is not None:
+            source = 'live'
+            break
+    else:
+        for tier in tiers:
+            frame = await borrow_session_frame(streamer, build_stream_url(ip, camera_username, camera_password, tier),
+                                               tier, name)
+            if frame is not None:
+                source = 'session'
+                break
+        else:
+            tier = quality
+            rtsp_url = build_stream_url(ip, camera_username, camera_password, quality)
+            frame = await snapshot_cache.get(stream_key(rtsp_url, quality), rtsp_url, QUALITY_WIDTHS[quality])
+            source = 'capture'
+
+    if frame is None:
+        logger.error('[GET][/tapo-320ws/snapshot] %s - capture failed', name)
+        raise HTTPException(status_code=504, detail=f"Snapshot of camera {name} is not available")
+
+    logger.debug('[GET][/tapo-320ws/snapshot] %s (%s, %s)', name, source, tier)
+
+    return Response(content=frame.data, media_type="image/jpeg",
+                    headers={"Cache-Control": "no-cache", "X-Snapshot-Source": source, "X-Snapshot-Quality": tier,
+                             "X-Frame-Timestamp": f"{frame.timestamp:.3f}"})
@@ -2,19 +2,90 @@
 API endpoint for opening camera stream websocket
 """
 import asyncio
+import os
+from typing import Optional
 
-from fastapi import APIRouter, WebSocket, WebSocketException, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, WebSocket, WebSocketException, WebSocketDisconnect, Query, status
+from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from app.camera.tapo_320ws.interface import Tapo320WSBaseInterface
-from app.camera.tapo_320ws.video_stream import RTSPStreamer
+from app.camera.tapo_320ws.utils import get_auth_by_name, build_stream_url
+from app.camera.tapo_320ws.video_stream import (RTSPStreamer, TRANSPORTS, TRANSPORT_TEXT, TRANSPORT_BINARY,
+                                                TRANSPORT_MJPEG, FRAME_HEADER, QUALITY_HIGH, QUALITY_WIDTHS,
+                                                STREAM_WARM_CAMERAS, Region, get_camera_id, parse_region)
+from app.camera.tapo_320ws.mjpeg import MJPEGSink, MJPEG_MEDIA_TYPE, mjpeg_stream
+from app.camera.tapo_320ws.fmp4_stream import FMP4Streamer, FORMAT_FMP4
+from app.camera.tapo_320ws.capture_worker import ProcessRTSPStreamer, STREAM_CAPTURE_PROCESSES
 from app.utils.logger import Logger
+from app.utils.stream_token import QUERY_AUTH_PATHS, STREAM_TOKEN_TTL, create_token
+
+# stream formats selectable per client
+FORMAT_JPEG = 'jpeg'
+FORMATS = (FORMAT_JPEG, FORMAT_FMP4)
 
 # route /camera/stream
 router = APIRouter()
-streamer = RTSPStreamer()
+# capture in worker processes scales across cores, threads are cheaper for a few cameras
+streamer = ProcessRTSPStreamer() if STREAM_CAPTURE_PROCESSES else RTSPStreamer()
+fmp4_streamer = FMP4Streamer()
 logger = Logger('server_logger.api/tapo_320ws/stream').get_child_logger()
 
 
+def warm_up_streams(names: list = None, quality: str = QUALITY_HIGH):
+    """
+    Opens RTSP sessions of the warm pool cameras so their first viewer does not wait for the RTSP handshake
+    Args:
+        names:      camera names (default STREAM_WARM_CAMERAS from .env)
+        quality:    quality tier whose camera stream is kept open
+    """
+    for name in STREAM_WARM_CAMERAS if names is None else names:
+        try:
+            ip, _, _, camera_username, camera_password = get_auth_by_name(name)
+        except TypeError:
+            logger.error('Warm pool camera %s not found', name)
+            continue
+        streamer.keep_warm(build_stream_url(ip, camera_username, camera_password, quality))
+        logger.info('Keeping stream of %s warm', name)
+
+
+def get_region(roi: Optional[str], roi_width: Optional[int]) -> Optional[Region]:
+    """
+    Returns: requested region of interest or None
+
+    Raises: ValueError if the region is invalid
+    """
+    if roi is None:
+        return None
+    if roi_width is not None and roi_width <= 0:
+        raise ValueError(f"Invalid region width: {roi_width}")
+    return parse_region(roi, roi_width)
+
+
+@router.get("/stream-token")
+async def get_stream_token(path: str) -> JSONResponse:
+    """
+    Creates short-lived token for opening an MJPEG stream (<img src>) or download job events (EventSource)
+    without the API key in its URL
+    Args:
+        path: /tapo-320ws/stream/mjpeg/{name}, /tapo-320ws/mosaic/mjpeg or /tapo-320ws/recordings/jobs/{job_id}/events
+
+    Returns: dict with the token (pass as ?token=) and its expiry in seconds
+    """
+    if not QUERY_AUTH_PATHS.match(path):
+        raise HTTPException(status_code=422, detail=f"No token can be issued for path: {path}")
+
+    # tokens are signed with the API key, without it there is nothing to sign with (and api_validate refuses them)
+    api_key = os.getenv("API_KEY")
+    if not api_key:
+        logger.error('[GET][/tapo-w320s/stream-token] API_KEY is not configured')
+        raise HTTPException(status_code=503, detail="Stream tokens are not available, API_KEY is not configured")
+
+    logger.info('[GET][/tapo-w320s/stream-token] %s', path)
+
+    return JSONResponse(status_code=200, content={"token": create_token(api_key, path),
+                                                  "expiresIn": STREAM_TOKEN_TTL})
+
+
 # Retrieve camera info
 @router.get("/stream/{name}")
 async def get_stream_url(name: str) -> JSONResponse:
@@ -32,32 +103,109 @@ async def get_stream_url(name: str) -> JSONResponse:
     return JSONResponse(status_code=200, content={"streamUrl": ws_url})
 
 
+@router.get("/stream/mjpeg/{name}")
+async def get_mjpeg_stream(name: str, quality: str = QUALITY_HIGH, roi: Optional[str] = None,
+                           roi_width: Optional[int] = None) -> StreamingResponse:
+    """
+    Streams video frames for a given camera as MJPEG (multipart/x-mixed-replace), usable as <img src>.
+    Shares the encoded frames of the WebSocket JPEG stream, authenticated by ?token= (see /stream-token)
+    or ?api_key=
+    Args:
+        name: name of the camera
+        quality: 'high' (main stream, default), 'low' (camera substream) or 'thumb' (substream downscaled on server)
+        roi: region of interest cropped from the quality's camera stream, name from STREAM_REGIONS
+             or 'x,y,width,height' as fractions of the frame
+        roi_width: width the region is scaled to (default native size of the crop)
+
+    Returns: endless multipart response, one JPEG per part
+    """
+    if quality not in QUALITY_WIDTHS:
+        raise HTTPException(status_code=422, detail=f"Unknown quality: {quality}")
+    try:
+        region = get_region(roi, roi_width)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error)) from error
+
+    try:
+        ip, _, _, camera_username, camera_password = get_auth_by_name(name)
+    except TypeError as error:
+        raise HTTPException(status_code=404, detail=f"Camera with name: {name} not found.") from error
+
+    logger.info('[GET][/tapo-w320s/stream/mjpeg] %s (%s)', name, quality)
+
+    sink = MJPEGSink()
+    rtsp_url = build_stream_url(ip, camera_username, camera_password, quality)
+    key = streamer.add_client(rtsp_url, sink, TRANSPORT_MJPEG, name, quality, region)
+
+    return StreamingResponse(mjpeg_stream(streamer, key, sink), media_type=MJPEG_MEDIA_TYPE,
+                             headers={"Cache-Control": "no-cache, no-store", "X-Accel-Buffering": "no"})
+
+
 @router.websocket("/stream/ws/{name}")
-async def websocket_stream(websocket: WebSocket, name: str):
+async def websocket_stream(websocket: WebSocket, name: str, transport: str = TRANSPORT_TEXT,
+                           stream_format: str = Query(FORMAT_JPEG, alias='format'), quality: str = QUALITY_HIGH,
+                           roi: Optional[str] = None, roi_width: Optional[int] = None, heartbeat: bool = False):
     """
     Streams video frames for a given camera via WebSocket
     Args:
         websocket: WebSocket connection
         name: name of the camera
+        transport: 'text' (base64 data URLs, default) or 'binary' (header + raw JPEG bytes)
+        stream_format: 'jpeg' (decoded JPEG frames, default) or 'fmp4' (H.264 passthrough as fragmented MP4)
+        quality: 'high' (main stream, default), 'low' (camera substream) or 'thumb' (substream downscaled on server)
+        roi: region of interest cropped on the server (jpeg format only), see /stream/mjpeg/{name}
+        roi_width: width the region is scaled to (default native size of the crop)
+        heartbeat: server sends JSON text pings ({"type": "ping"}), client has to send any text message (pong)
+                   within STREAM_PING_TIMEOUT seconds or it is disconnected
+
+    In binary mode the first message is a JSON text hello with the camera id and header size,
+    every following message is a binary frame (see FRAME_HEADER in video_stream).
+    In fmp4 mode the first message is a JSON text hello with the MSE mime type,
+    followed by the init segment and media fragments as binary messages (transport is ignored).
     """
+    if transport not in TRANSPORTS or stream_format not in FORMATS or quality not in QUALITY_WIDTHS:
+        logger.info('[WEBSOCKET][/tapo-w320s/stream] %s - unsupported transport/format/quality: %s/%s/%s', name,
+                    transport, stream_format, quality)
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+
     try:
-        logger.info('[WEBSOCKET][/tapo-w320s/stream] %s', name)
+        region = get_region(roi, roi_width)
+    except ValueError as error:
+        logger.info('[WEBSOCKET][/tapo-w320s/stream] %s - unsupported region: %s', name, error)
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+    if region is not None and stream_format == FORMAT_FMP4:
+        logger.info('[WEBSOCKET][/tapo-w320s/stream] %s - regions need the jpeg format', name)
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+
+    target_streamer = fmp4_streamer if stream_format == FORMAT_FMP4 else streamer
+
+    try:
+        logger.info('[WEBSOCKET][/tapo-w320s/stream] %s (%s, %s, %s)', name, stream_format, transport, quality)
         await websocket.accept()
 
         # retrieve RTSP URL for camera name
         interface = Tapo320WSBaseInterface(name)
-        rtsp_url = interface.get_stream_url()
+        rtsp_url = interface.get_stream_url(quality)
+
+        if transport == TRANSPORT_BINARY and stream_format == FORMAT_JPEG:
+            await websocket.send_json({
+                "transport": TRANSPORT_BINARY,
+                "cameraId": get_camera_id(name),
+                "headerSize": FRAME_HEADER.size
+            })
 
-        # add client to the RTSPStreamer
-        streamer.add_client(rtsp_url, websocket)
+        # add client to the streamer
+        key = target_streamer.add_client(rtsp_url, websocket, transport, name, quality, region)
 
-        # keep WebSocket connection alive
-        while True:
-            await websocket.receive_text()
+        # keep WebSocket connection alive, the client is removed when it disconnects or misses the heartbeat
+        await target_streamer.watch_client(key, websocket, heartbeat)
 
     except asyncio.TimeoutError:
-        logger.info("Client %s timed out, closing connection", name)
-        await websocket.close()
+        logger.info("Client %s missed the heartbeat, closing connection", name)
+        await websocket.close(code=status.WS_1001_GOING_AWAY)
 
     except WebSocketDisconnect as disconnect_error:
         logger.info('[WEBSOCKET][/tapo-w320s/stream] %s - client dicsonnected: %s, %s', name, disconnect_error.code,
@@ -66,5 +214,5 @@ async def websocket_stream(websocket: WebSocket, name: str):
     except WebSocketException as error:
         # remove client from the RTSPStreamer
         logger.error('[WEBSOCKET][/tapo-w320s/stream] %s = "WebSocket Error: %s ', name, error)
-        streamer.remove_client(rtsp_url, websocket)
+        target_streamer.remove_client(key, websocket)
         return JSONResponse(status_code=500, content={f"WebSocket Error:\t{error}"})
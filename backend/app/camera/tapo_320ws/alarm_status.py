@@ -26,6 +26,8 @@ def get_alarm_status(name: str) -> Tuple[bool, List[dict]]:
 
     # transform events into human-readable format
     for event in events:
+        # raw start time for event clips
+        event['timestamp'] = event['start_time']
         event['start_time'] = timestamp_to_string(event['start_time'])
         event['end_time'] = timestamp_to_string(event['end_time'])
         event['camera_name'] = name
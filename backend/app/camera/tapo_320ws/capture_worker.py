@@ -0,0 +1,452 @@
+"""
+Module for capturing streams in worker processes - each RTSP URL is decoded and encoded by its own process,
+encoded frames are passed to the server process through shared memory rings (one per output),
+only short notifications go through a pipe
+"""
+import asyncio
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv, find_dotenv
+from app.camera.tapo_320ws.encoders import EncoderOptions
+from app.camera.tapo_320ws.metrics import CaptureMetrics
+from app.camera.tapo_320ws.video_stream import (RTSPStreamer, Frame, StreamOptions, OutputShape, Region,
+                                                QUALITY_HIGH, TRANSPORT_TEXT, backoff_delay, run_capture)
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.capture_worker').get_child_logger()
+
+load_dotenv(find_dotenv())
+# capture in worker processes instead of threads of the server process
+STREAM_CAPTURE_PROCESSES = os.getenv("STREAM_CAPTURE_PROCESSES", "0").lower() in ("1", "true", "yes")
+# frames kept in each shared memory ring
+FRAME_RING_SLOTS = int(os.getenv("FRAME_RING_SLOTS", "4"))
+# maximal size of one encoded frame in bytes, larger frames are dropped
+FRAME_RING_SLOT_SIZE = int(os.getenv("FRAME_RING_SLOT_SIZE", str(1024 * 1024)))
+
+# slot header: sequence number (u64, 0 = slot being written) | capture timestamp (f64) | JPEG length (u32)
+SLOT_HEADER = struct.Struct('QdI')
+
+# messages between server and worker
+MESSAGE_OUTPUTS = 'outputs'     # server -> worker: {key: (ring layout, shape)} of outputs with clients
+MESSAGE_OPTIONS = 'options'     # server -> worker: StreamOptions
+MESSAGE_WARM = 'warm'           # server -> worker: keep session open without clients
+MESSAGE_STOP = 'stop'           # server -> worker: close the capture
+MESSAGE_OPENED = 'opened'       # worker -> server: seconds to the first frame
+MESSAGE_FRAME = 'frame'         # worker -> server: (key, sequence) of a frame written into the ring
+MESSAGE_RECONNECT = 'reconnect' # worker -> server: dropped session is being reopened
+MESSAGE_METRICS = 'metrics'     # worker -> server: CaptureMetrics (at most every METRICS_INTERVAL seconds)
+MESSAGE_CLOSED = 'closed'       # worker -> server: capture closed, True if only because nobody watched it
+
+# seconds between metrics updates of a worker
+METRICS_INTERVAL = 1.0
+
+
+class FrameRing:
+    """
+    Ring of encoded frames in shared memory, written by one worker and read by the server.
+    A slot is read only if its sequence matches before and after copying (the writer zeroes it while writing).
+    """
+
+    def __init__(self, name: Optional[str] = None, slots: int = FRAME_RING_SLOTS,
+                 slot_size: int = FRAME_RING_SLOT_SIZE):
+        """
+        Args:
+            name:       name of an existing ring to attach to, None creates a new ring
+            slots:      number of frames kept
+            slot_size:  maximal size of one encoded frame
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = SLOT_HEADER.size + slot_size
+        if name is None:
+            # new shared memory is zero-filled -> all slots start invalid
+            self.memory = SharedMemory(create=True, size=slots * self.stride)
+        else:
+            self.memory = SharedMemory(name=name)
+
+    @property
+    def layout(self) -> Tuple[str, int, int]:
+        """
+        Returns: (shared memory name, slots, slot size) used to attach from another process
+        """
+        return self.memory.name, self.slots, self.slot_size
+
+    def write(self, frame: Frame) -> bool:
+        """
+        Writes frame into the slot of its sequence number
+        Returns: False if the frame does not fit into a slot
+        """
+        if len(frame.data) > self.slot_size:
+            return False
+        offset = (frame.sequence % self.slots) * self.stride
+        buffer = self.memory.buf
+        SLOT_HEADER.pack_into(buffer, offset, 0, frame.timestamp, len(frame.data))
+        start = offset + SLOT_HEADER.size
+        buffer[start:start + len(frame.data)] = frame.data
+        SLOT_HEADER.pack_into(buffer, offset, frame.sequence, frame.timestamp, len(frame.data))
+        return True
+
+    def read(self, sequence: int) -> Optional[Frame]:
+        """
+        Reads frame with the given sequence number
+        Returns: frame or None if it was already overwritten
+        """
+        offset = (sequence % self.slots) * self.stride
+        buffer = self.memory.buf
+        slot_sequence, timestamp, length = SLOT_HEADER.unpack_from(buffer, offset)
+        if slot_sequence != sequence:
+            return None
+        start = offset + SLOT_HEADER.size
+        data = bytes(buffer[start:start + length])
+        if SLOT_HEADER.unpack_from(buffer, offset)[0] != sequence:
+            return None
+        return Frame(data, sequence, timestamp)
+
+    def close(self, unlink: bool = False):
+        """
+        Detaches from the ring, the creator also unlinks it
+        """
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class WorkerControl:
+    """
+    Capture state of a worker process, updated by messages from the server (see capture_frames for the interface)
+    """
+
+    def __init__(self, connection: Connection, options: StreamOptions, warm: bool, idle_grace: float,
+                 reconnect_delays: Tuple[float, float]):
+        self.connection = connection
+        self.options = options
+        self.warm = warm
+        self.idle_grace = idle_grace
+        self.reconnect_delays = reconnect_delays
+        self.metrics = CaptureMetrics()
+        self.metrics_sent = 0.0
+        self.outputs: Dict[str, Tuple[FrameRing, OutputShape]] = {}
+        self.stopped = False
+
+    def handle_messages(self):
+        """
+        Applies all pending messages from the server
+        """
+        while self.connection.poll():
+            message, value = self.connection.recv()
+            if message == MESSAGE_OUTPUTS:
+                for key in set(self.outputs) - set(value):
+                    self.outputs.pop(key)[0].close()
+                for key, (layout, shape) in value.items():
+                    if key not in self.outputs:
+                        self.outputs[key] = (FrameRing(*layout), shape)
+            elif message == MESSAGE_OPTIONS:
+                self.options = StreamOptions(*value)
+            elif message == MESSAGE_WARM:
+                self.warm = value
+            elif message == MESSAGE_STOP:
+                self.stopped = True
+
+    def active_outputs(self, _: str) -> List[Tuple[str, OutputShape]]:
+        """
+        Returns: (key, shape) of outputs with clients
+        """
+        self.handle_messages()
+        if self.stopped:
+            return []
+        return [(key, shape) for key, (_, shape) in self.outputs.items()]
+
+    def get_capture_metrics(self, _: str) -> CaptureMetrics:
+        """
+        Returns: capture metrics of the worker (sent to the server by emit)
+        """
+        return self.metrics
+
+    def get_stream_options(self, _: str) -> StreamOptions:
+        """
+        Returns: capture options
+        """
+        return self.options
+
+    def keep_open(self, _: str, idle_seconds: float) -> bool:
+        """
+        Returns: True if the capture should stay open without clients
+        """
+        return not self.stopped and (self.warm or idle_seconds < self.idle_grace)
+
+    def reconnect_delay(self, rtsp_url: str, attempt: int) -> Optional[float]:
+        """
+        Returns: seconds to wait before reopening a dropped capture or None to close it
+        """
+        if not self.active_outputs(rtsp_url) and not (self.warm and not self.stopped):
+            return None
+        self.connection.send((MESSAGE_RECONNECT, attempt))
+        return backoff_delay(attempt, *self.reconnect_delays)
+
+    def set_open_latency(self, _: str, seconds: float):
+        """
+        Reports time to the first frame to the server
+        """
+        self.connection.send((MESSAGE_OPENED, seconds))
+
+    def emit(self, key: str, frame: Frame):
+        """
+        Writes frame into the output ring and notifies the server
+        """
+        output = self.outputs.get(key)
+        if output is None:
+            return
+        if output[0].write(frame):
+            self.connection.send((MESSAGE_FRAME, (key, frame.sequence)))
+
+        now = time.monotonic()
+        if now - self.metrics_sent >= METRICS_INTERVAL:
+            self.metrics_sent = now
+            self.connection.send((MESSAGE_METRICS, self.metrics))
+
+    def close(self):
+        """
+        Detaches from all rings
+        """
+        for ring, _ in self.outputs.values():
+            ring.close()
+        self.outputs.clear()
+
+
+def capture_worker(rtsp_url: str, connection: Connection, options: tuple, warm: bool, idle_grace: float,
+                   reconnect_delays: Tuple[float, float]):
+    """
+    Worker process entry point, captures one RTSP URL until nobody watches it (see run_capture)
+    Args:
+        rtsp_url:           RTSP URL of the camera stream
+        connection:         pipe to the server
+        options:            initial StreamOptions
+        warm:               keep session open without clients
+        idle_grace:         seconds the session stays open without clients
+        reconnect_delays:   (min, max) reconnect backoff
+    """
+    control = WorkerControl(connection, StreamOptions(*options), warm, idle_grace, reconnect_delays)
+    idle = False
+    try:
+        idle = run_capture(rtsp_url, control, control.emit)
+    finally:
+        control.close()
+        try:
+            connection.send((MESSAGE_CLOSED, idle and not control.stopped))
+        except (BrokenPipeError, OSError):
+            pass
+        connection.close()
+
+
+class CaptureWorker:
+    """
+    Server side handle of a worker process
+    """
+
+    def __init__(self, process: multiprocessing.Process, connection: Connection):
+        self.process = process
+        self.connection = connection
+
+    def send(self, message: str, value) -> None:
+        """
+        Sends a message to the worker, ignored if it already exited
+        """
+        try:
+            self.connection.send((message, value))
+        except (BrokenPipeError, OSError):
+            pass
+
+
+class ProcessRTSPStreamer(RTSPStreamer):
+    """
+    RTSPStreamer that captures each RTSP URL in a worker process (see capture_worker),
+    the server process only copies encoded frames from shared memory to the output queues.
+    Client API (add_client/remove_client) is the same as RTSPStreamer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # spawn -> workers do not inherit the event loop and threads of the server
+        self.context = multiprocessing.get_context('spawn')
+        self.rings: Dict[str, FrameRing] = {}
+
+    def add_client(self, rtsp_url: str, websocket, transport: str = TRANSPORT_TEXT, camera_name: str = '',
+                   quality: str = QUALITY_HIGH, region: Optional[Region] = None,
+                   max_fps: Optional[float] = None) -> str:
+        """
+        Adds a WebSocket client (see RTSPStreamer.add_client) and updates outputs of the worker
+        """
+        key = super().add_client(rtsp_url, websocket, transport, camera_name, quality, region, max_fps)
+        self.sync_outputs(rtsp_url)
+        return key
+
+    def remove_client(self, rtsp_url: str, websocket):
+        """
+        Removes a client (see RTSPStreamer.remove_client) and updates outputs of the worker
+        """
+        super().remove_client(rtsp_url, websocket)
+        self.sync_outputs(self.outputs.get(rtsp_url, (None,))[0])
+
+    def remove_all_clients(self, rtsp_url: str):
+        """
+        Removes all clients of an output and updates outputs of the worker
+        """
+        super().remove_all_clients(rtsp_url)
+        self.sync_outputs(self.outputs.get(rtsp_url, (None,))[0])
+
+    def set_stream_options(self, rtsp_url: str, target_fps: Optional[float] = None,
+                           change_threshold: Optional[float] = None,
+                           encoder: Optional[EncoderOptions] = None) -> StreamOptions:
+        """
+        Changes capture options (see RTSPStreamer.set_stream_options) and forwards them to the worker
+        """
+        options = super().set_stream_options(rtsp_url, target_fps, change_threshold, encoder)
+        worker = self.streams.get(rtsp_url)
+        if worker is not None:
+            worker.send(MESSAGE_OPTIONS, tuple(self.get_stream_options(rtsp_url)))
+        return options
+
+    def set_fps_limit(self, rtsp_url: str, fps: Optional[float]):
+        """
+        Caps the frame rate (see RTSPStreamer.set_fps_limit) and forwards the effective options to the worker
+        """
+        super().set_fps_limit(rtsp_url, fps)
+        worker = self.streams.get(rtsp_url)
+        if worker is not None:
+            worker.send(MESSAGE_OPTIONS, tuple(self.get_stream_options(rtsp_url)))
+
+    def keep_warm(self, rtsp_url: str):
+        """
+        Keeps the RTSP session open without clients (also in an already running worker)
+        """
+        super().keep_warm(rtsp_url)
+        worker = self.streams.get(rtsp_url)
+        if worker is not None:
+            worker.send(MESSAGE_WARM, True)
+
+    def release_warm(self, rtsp_url: str):
+        """
+        Lets the worker close after the idle grace period again
+        """
+        super().release_warm(rtsp_url)
+        worker = self.streams.get(rtsp_url)
+        if worker is not None:
+            worker.send(MESSAGE_WARM, False)
+
+    def sync_outputs(self, rtsp_url: Optional[str]):
+        """
+        Sends outputs with clients to the worker of the RTSP URL, together with the options
+        (the frame rate follows the clients, see RTSPStreamer.client_fps_cap)
+        """
+        worker = self.streams.get(rtsp_url)
+        if worker is None:
+            return
+        outputs = {key: (self.rings[key].layout, shape) for key, shape in self.active_outputs(rtsp_url)
+                   if key in self.rings}
+        worker.send(MESSAGE_OUTPUTS, outputs)
+        worker.send(MESSAGE_OPTIONS, tuple(self.get_stream_options(rtsp_url)))
+
+    def start_output(self, key: str):
+        """
+        Creates frame queue, sender task and shared memory ring of an output
+        """
+        super().start_output(key)
+        self.rings[key] = FrameRing()
+
+    async def process_stream(self, rtsp_url: str):
+        """
+        Sends frames of an output to its clients (see RTSPStreamer.process_stream), unlinks its ring when done
+        """
+        try:
+            await super().process_stream(rtsp_url)
+        finally:
+            ring = self.rings.pop(rtsp_url, None)
+            if ring is not None:
+                ring.close(unlink=True)
+
+    def start_stream(self, rtsp_url: str):
+        """
+        Starts worker process of the RTSP URL, its frames are read in handle_worker_messages
+        """
+        if rtsp_url in self.streams:
+            logger.info('Stream already active: %s', rtsp_url)
+            return
+
+        connection, worker_connection = self.context.Pipe()
+        process = self.context.Process(
+            target=capture_worker,
+            args=(rtsp_url, worker_connection, tuple(self.get_stream_options(rtsp_url)),
+                  rtsp_url in self.warm_streams, self.idle_grace,
+                  (self.reconnect_min_delay, self.reconnect_max_delay)),
+            daemon=True
+        )
+        process.start()
+        worker_connection.close()
+
+        self.streams[rtsp_url] = CaptureWorker(process, connection)
+        asyncio.get_event_loop().add_reader(connection.fileno(), self.handle_worker_messages, rtsp_url)
+        self.sync_outputs(rtsp_url)
+
+    def handle_worker_messages(self, rtsp_url: str):
+        """
+        Reads pending messages of the worker, copies announced frames from the rings into the output queues
+        """
+        worker = self.streams.get(rtsp_url)
+        if worker is None:
+            return
+        try:
+            while worker.connection.poll():
+                message, value = worker.connection.recv()
+                if message == MESSAGE_FRAME:
+                    key, sequence = value
+                    ring = self.rings.get(key)
+                    frame = ring.read(sequence) if ring is not None else None
+                    if frame is not None:
+                        self.enqueue_frame(key, frame)
+                elif message == MESSAGE_METRICS:
+                    self.capture_metrics[rtsp_url] = value
+                elif message == MESSAGE_OPENED:
+                    self.set_open_latency(rtsp_url, value)
+                elif message == MESSAGE_RECONNECT:
+                    self.count_reconnect(rtsp_url)
+                elif message == MESSAGE_CLOSED:
+                    self.close_worker(rtsp_url, idle=value)
+                    return
+        except (EOFError, OSError):
+            self.close_worker(rtsp_url, idle=False)
+
+    def close_worker(self, rtsp_url: str, idle: bool):
+        """
+        Cleans up after a worker exited. A worker closed for inactivity is restarted
+        if a client joined meanwhile, otherwise outputs of the RTSP URL are stopped.
+        """
+        worker = self.streams.pop(rtsp_url, None)
+        if worker is None:
+            return
+        loop = asyncio.get_event_loop()
+        loop.remove_reader(worker.connection.fileno())
+        worker.connection.close()
+        # the worker exits right after MESSAGE_CLOSED, it is reaped in a thread to not block the event loop
+        loop.run_in_executor(None, worker.process.join, 1)
+
+        if idle and self.active_outputs(rtsp_url):
+            self.start_stream(rtsp_url)
+        else:
+            self.stop_outputs(rtsp_url)
+
+    def stop_all(self):
+        """
+        Stops all worker processes (server shutdown)
+        """
+        for worker in list(self.streams.values()):
+            worker.send(MESSAGE_STOP, None)
+        for rtsp_url, worker in list(self.streams.items()):
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.kill()
+            self.close_worker(rtsp_url, idle=False)
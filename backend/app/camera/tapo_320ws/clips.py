@@ -0,0 +1,170 @@
+"""
+Module for event clips - on alarm the segments around the event are cut from the HLS ring of the camera
+(see hls module) and joined into an MP4 by ffmpeg (stream copy, no re-encode), so the footage is available
+seconds after the event instead of after the camera finished and uploaded its recording
+"""
+import asyncio
+import os
+import shutil
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+from app.camera.tapo_320ws.hls import HLSManager, HLSSegment, HLS_SEGMENT_SECONDS, CLIP_PRE_ROLL, CLIP_POST_ROLL
+from app.utils.ffmpeg import FFMPEG_BINARY
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.clips').get_child_logger()
+
+# get /backend/clips
+CLIPS_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+CLIPS_PATH = os.path.join(CLIPS_PATH, 'clips')
+
+
+def select_segments(segments: List[HLSSegment], start: float, end: float) -> List[HLSSegment]:
+    """
+    Segments overlapping a time interval
+    Args:
+        segments:   segments of the ring (with program date time)
+        start:      start of the interval (unix seconds)
+        end:        end of the interval (unix seconds)
+
+    Returns: segments in playlist order
+    """
+    return [segment for segment in segments
+            if segment.start_time is not None
+            and segment.start_time < end and segment.start_time + segment.duration > start]
+
+
+def clip_ffmpeg_args(list_path: str, output_path: str) -> list:
+    """
+    ffmpeg arguments for joining TS segments into one MP4
+    Args:
+        list_path:      concat demuxer list of the segments
+        output_path:    MP4 file to write
+
+    Returns: ffmpeg argv
+    """
+    return [
+        FFMPEG_BINARY,
+        "-hide_banner",
+        "-loglevel", "error",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", list_path,
+        "-c", "copy",
+        # moov at the start -> clip plays while it is still downloading
+        "-movflags", "+faststart",
+        "-y", output_path,
+    ]
+
+
+def clip_filename(name: str, event_time: float) -> str:
+    """
+    Returns: ex. TestCam____2024-01-01____12-00-00.mp4
+    """
+    moment = datetime.fromtimestamp(event_time)
+    return f"{name}____{moment.strftime('%Y-%m-%d')}____{moment.strftime('%H-%M-%S')}.mp4"
+
+
+class ClipRecorder:
+    """
+    Saves event clips of cameras whose HLS segmenter keeps running (pinned, see HLSManager.pin)
+    """
+
+    def __init__(self, hls_manager: HLSManager, path_clips: str = CLIPS_PATH, pre_roll: float = CLIP_PRE_ROLL,
+                 post_roll: float = CLIP_POST_ROLL):
+        self.hls_manager = hls_manager
+        self.path_clips = path_clips
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        # start of the last clip of each camera -> events reported by several polls are saved once
+        self.last_events: Dict[str, float] = {}
+        self.tasks: Set[asyncio.Task] = set()
+
+    def on_event(self, name: str, event_time: float) -> Optional[asyncio.Task]:
+        """
+        Schedules clip of an alarm event, events inside the previous clip of the camera are skipped
+        Args:
+            name:       name of the camera
+            event_time: start of the event (unix seconds)
+
+        Returns: task saving the clip or None
+        """
+        if name not in self.hls_manager.pinned:
+            return None
+        if event_time < self.last_events.get(name, 0) + self.post_roll:
+            return None
+        self.last_events[name] = event_time
+
+        task = asyncio.get_event_loop().create_task(self.save_clip(name, event_time))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def save_clip(self, name: str, event_time: float) -> Optional[str]:
+        """
+        Waits for the post-roll to be segmented and joins the segments around the event into an MP4
+        Args:
+            name:       name of the camera
+            event_time: start of the event (unix seconds)
+
+        Returns: path of the clip or None if the ring has no segments of the event
+        """
+        # segment containing the end of the post-roll must be finished
+        await asyncio.sleep(max(0.0, event_time + self.post_roll + HLS_SEGMENT_SECONDS - time.time()))
+
+        segmenter = self.hls_manager.segmenters.get(name)
+        if segmenter is None:
+            logger.error('No HLS segmenter for clip of %s', name)
+            return None
+        segments = select_segments(segmenter.read_segments(), event_time - self.pre_roll,
+                                   event_time + self.post_roll)
+
+        output_path = os.path.join(self.path_clips, clip_filename(name, event_time))
+        work_dir = output_path + '.parts'
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            # hard links keep the segments alive while ffmpeg rotates the ring
+            parts = []
+            for segment in segments:
+                part_path = os.path.join(work_dir, segment.uri)
+                try:
+                    os.link(os.path.join(segmenter.output_dir, segment.uri), part_path)
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    # hard links not supported (ex. ring on another filesystem)
+                    shutil.copyfile(os.path.join(segmenter.output_dir, segment.uri), part_path)
+                parts.append(part_path)
+
+            if not parts:
+                logger.error('No segments for clip of %s at %s', name, event_time)
+                return None
+
+            list_path = os.path.join(work_dir, 'segments.txt')
+            with open(list_path, 'w', encoding='utf-8') as file:
+                file.writelines(f"file '{part}'\n" for part in parts)
+
+            process = await asyncio.create_subprocess_exec(
+                *clip_ffmpeg_args(list_path, output_path),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            if await process.wait() != 0:
+                logger.error('ffmpeg failed to save clip %s (exit code %s)', output_path, process.returncode)
+                return None
+
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        logger.info('Saved clip %s (%s segments)', output_path, len(parts))
+        return output_path
+
+    def list_clips(self, name: str) -> List[str]:
+        """
+        Returns: clip file names of the camera (oldest first)
+        """
+        if not os.path.isdir(self.path_clips):
+            return []
+        return sorted(filename for filename in os.listdir(self.path_clips)
+                      if filename.startswith(f"{name}____") and filename.endswith('.mp4'))
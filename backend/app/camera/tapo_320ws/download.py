@@ -5,149 +5,237 @@ Original is licensed under MIT License
 """
 from datetime import datetime, timedelta
 from json import JSONDecodeError
+import asyncio
 import json
 import hashlib
 import logging
-import io
-import subprocess
 import os
-import tempfile
 import aiofiles
+from dotenv import load_dotenv, find_dotenv
 from pytapo import Tapo
+from app.camera.tapo_320ws.mpegts import TSDurationTracker
+from app.utils.ffmpeg import FFMPEG_BINARY
 
 logger = logging.getLogger(__name__)
 logging.getLogger("libav").setLevel(logging.ERROR)
 
+load_dotenv(find_dotenv())
+# seconds ffmpeg may stall reading a download or finishing its MP4 before it is killed
+DOWNLOAD_MUX_TIMEOUT = float(os.getenv("DOWNLOAD_MUX_TIMEOUT", "60"))
 
-class Convert:
+
+def mux_ffmpeg_args(audioFd: int, outputFile: str, fileLength: float) -> list:
     """
-    Pytapo class for video conversion using ffmpeg
+    ffmpeg arguments for muxing piped camera video (MPEG-TS on stdin) and audio (A-law on a second pipe) into MP4
+    Args:
+        audioFd:        file descriptor of the audio pipe inherited by ffmpeg
+        outputFile:     MP4 file to write
+        fileLength:     seconds of video to keep
+
+    Returns: ffmpeg argv
+    """
+    return [
+        FFMPEG_BINARY,
+        "-hide_banner",
+        "-loglevel", "error",
+        "-f", "mpegts",
+        "-i", "pipe:0",
+        "-f", "alaw",
+        "-ar", "8000",
+        "-i", f"pipe:{audioFd}",
+        "-t", str(timedelta(seconds=fileLength)),
+        "-c:v", "copy",
+        "-c:a", "aac",
+        "-map", "0:v:0",
+        "-map", "1:a:0",
+        "-f", "mp4",
+        "-y", outputFile,
+    ]
+
+
+class AudioPipeWriter(asyncio.Protocol):
+    """
+    Write end of the audio pipe to ffmpeg, drain waits while the pipe buffer is full (like StreamWriter.drain)
     """
 
     def __init__(self):
-        self.stream = None
-        self.writer = io.BytesIO()
-        self.audioWriter = io.BytesIO()
-        self.known_lengths = {}
-        self.addedChunks = 0
-        self.lengthLastCalculatedAtChunk = 0
+        self.transport = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.lost = False
 
-    # cuts and saves the video
-    async def save(self, fileLocation, fileLength, method="ffmpeg"):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.lost = True
+        # wakes up waiting drain, which then fails
+        self.writable.set()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def write(self, data: bytes):
         """
-        Save video using ffmpeg (pytapo)
+        Queues data for the pipe
         """
-        if method == "ffmpeg":
-            tempVideoFileLocation = f"{fileLocation}.ts"
-            async with aiofiles.open(tempVideoFileLocation, "wb") as file:
-                await file.write(self.writer.getvalue())
-            tempAudioFileLocation = f"{fileLocation}.alaw"
-            async with aiofiles.open(tempAudioFileLocation, "wb") as file:
-                await file.write(self.audioWriter.getvalue())
-
-            inputVideoFile = tempVideoFileLocation
-            inputAudioFile = tempAudioFileLocation
-            outputFile = fileLocation
-            videoLength = str(timedelta(seconds=fileLength))
-            devnull = os.devnull
-            cmd = f'ffmpeg -ss 00:00:00 -i "{inputVideoFile}" -f alaw -ar 8000 -i "{inputAudioFile}" -t {videoLength} -y -c:v copy -c:a aac -map 0:v:0 -map 1:a:0 "{outputFile}" >{devnull} 2>&1'
-            os.system(cmd)
-
-            os.remove(tempVideoFileLocation)
-            os.remove(tempAudioFileLocation)
-        else:
-            raise NotImplementedError("Method not supported")
+        self.transport.write(data)
 
-    # calculates ideal refresh interval for a real time estimate of downloaded data
-    def getRefreshIntervalForLengthEstimate(self):
+    async def drain(self):
         """
-        Pytapo
+        Waits until the pipe takes more data
+        Raises: ConnectionResetError if ffmpeg closed the pipe
         """
-        if self.addedChunks < 100:
-            return 50
-        if self.addedChunks < 1000:
-            return 250
-        if self.addedChunks < 10000:
-            return 5000
+        if self.transport.is_closing():
+            # lets connection_lost of a broken pipe run first
+            await asyncio.sleep(0)
+        await self.writable.wait()
+        if self.lost:
+            raise ConnectionResetError('Connection lost')
+
+    def is_closing(self) -> bool:
+        """
+        Returns: pipe is closed or being closed
+        """
+        return self.transport.is_closing()
+
+    def close(self):
+        """
+        Closes the pipe once the queued data is written
+        """
+        self.transport.close()
+
+
+class Convert:
+    """
+    Pytapo class for video conversion using ffmpeg, chunks are piped into ffmpeg as they arrive, so a download
+    keeps neither the recording in memory nor temp copies of it on disk
+    """
 
-        return self.addedChunks / 2
+    def __init__(self, fileLocation, fileLength, timeout=DOWNLOAD_MUX_TIMEOUT):
+        self.fileLocation = fileLocation
+        self.fileLength = fileLength
+        # ffmpeg writes next to the output, the file is renamed once it is complete
+        self.partLocation = f"{fileLocation}.part"
+        self.timeout = timeout
+        self.process = None
+        self.audioWriter = None
+        self.inputClosed = False
+        self.durationTracker = TSDurationTracker()
+        self.addedChunks = 0
 
-    # calculates real stream length, hard on processing since it has to go through all the frames
-    def calculateLength(self):
+    async def start(self):
         """
-        Pytapo
+        Starts ffmpeg muxer with the video on stdin and the audio on an inherited pipe
         """
-        detectedLength = False
+        audioRead, audioWrite = os.pipe()
+        # pylint: disable=consider-using-with  # owned by the pipe transport once connected
+        audioPipe = open(audioWrite, "wb", buffering=0)
         try:
-            with tempfile.NamedTemporaryFile(delete=False) as tmp:
-                tmp.write(self.writer.getvalue())
-                result = subprocess.run(
-                    [
-                        "ffprobe",
-                        "-v",
-                        "fatal",
-                        "-show_entries",
-                        "format=duration",
-                        "-of",
-                        "default=noprint_wrappers=1:nokey=1",
-                        tmp.name,
-                    ],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                )
-                formatted_stdout = str(result.stdout.decode('utf-8'))
-                if formatted_stdout[-1] == '\n':
-                    formatted_stdout = formatted_stdout[:-1]
-                    if formatted_stdout[-1] == '\r':
-                        formatted_stdout = formatted_stdout[:-1]
-                if formatted_stdout == "N/A":
-                    formatted_stdout = "0"
-                formatted_stdout = float(formatted_stdout)
-                detectedLength = float(formatted_stdout)
-                # print(detectedLength)
-                self.known_lengths[self.addedChunks] = detectedLength
-                self.lengthLastCalculatedAtChunk = self.addedChunks
-            os.unlink(tmp.name)
-
-        except (FileNotFoundError, subprocess.SubprocessError, ValueError, OSError) as error:
-            raise error
-        return detectedLength
-
-    # returns length of video, can return an estimate which is usually very close
-    def getLength(self, exact=False):
+            self.process = await asyncio.create_subprocess_exec(
+                *mux_ffmpeg_args(audioRead, self.partLocation, self.fileLength),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+                pass_fds=(audioRead,),
+            )
+            _, self.audioWriter = await asyncio.get_running_loop().connect_write_pipe(AudioPipeWriter, audioPipe)
+        except OSError as error:
+            logger.error("Failed to start ffmpeg for %s: %s", self.fileLocation, error)
+            audioPipe.close()
+            self.kill()
+            self.inputClosed = True
+        except BaseException:
+            audioPipe.close()
+            self.kill()
+            raise
+        finally:
+            # ffmpeg has its own copy of the read end
+            os.close(audioRead)
+
+    async def write(self, data: bytes, audioData: bytes):
         """
-        Pytapo
+        Pipes a chunk into ffmpeg, waits while ffmpeg is behind (at most timeout seconds)
         """
-        lastKnownLength = 0
-        if bool(self.known_lengths) is True:
-            lastKnownChunk = list(self.known_lengths)[-1]
-            lastKnownLength = self.known_lengths[lastKnownChunk]
-        if (
-                exact
-                or not self.known_lengths
-                or self.addedChunks
-                > self.lengthLastCalculatedAtChunk
-                + self.getRefreshIntervalForLengthEstimate()
-                or lastKnownLength == 0
-        ):
-            calculatedLength = self.calculateLength()
-            if calculatedLength is not False:
-                return calculatedLength
-
-            if bool(self.known_lengths) is True:
-                bytesPerChunk = lastKnownChunk / lastKnownLength
-                return self.addedChunks / bytesPerChunk
-        else:
-            bytesPerChunk = lastKnownChunk / lastKnownLength
-            return self.addedChunks / bytesPerChunk
-        return False
+        self.addedChunks += 1
+        self.durationTracker.feed(data)
+        if self.process is None and not self.inputClosed:
+            await self.start()
+        if self.inputClosed:
+            return
 
-    def write(self, data: bytes, audioData: bytes):
+        try:
+            self.process.stdin.write(data)
+            self.audioWriter.write(audioData)
+            await asyncio.wait_for(asyncio.gather(self.process.stdin.drain(), self.audioWriter.drain()),
+                                   self.timeout)
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg already has fileLength seconds and exited (save checks the exit code)
+            self.inputClosed = True
+        except asyncio.TimeoutError:
+            logger.error("ffmpeg stopped reading input of %s", self.fileLocation)
+            self.kill()
+
+    # cuts and saves the video
+    async def save(self):
         """
-        Pytapo
+        Closes the pipes and waits for ffmpeg to finish the MP4
+        Returns: True if the recording was saved
         """
-        self.addedChunks += 1
-        return self.writer.write(data) and self.audioWriter.write(audioData)
+        if self.process is None:
+            return False
+        self.closeInputs()
+        try:
+            returnCode = await asyncio.wait_for(self.process.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.error("ffmpeg did not finish %s within %s s", self.fileLocation, self.timeout)
+            self.close()
+            return False
+        if returnCode != 0:
+            logger.error("ffmpeg failed to convert %s (exit code %s)", self.fileLocation, returnCode)
+            self.close()
+            return False
+
+        os.replace(self.partLocation, self.fileLocation)
+        return True
+
+    def closeInputs(self):
+        """
+        Signals end of the stream to ffmpeg
+        """
+        self.inputClosed = True
+        for writer in (self.process.stdin if self.process else None, self.audioWriter):
+            if writer is not None and not writer.is_closing():
+                writer.close()
+
+    def kill(self):
+        """
+        Stops ffmpeg without waiting for the output
+        """
+        if self.process is not None:
+            self.closeInputs()
+            if self.process.returncode is None:
+                self.process.kill()
+
+    def close(self):
+        """
+        Stops ffmpeg and removes unfinished output (safe to call after save)
+        """
+        self.kill()
+        try:
+            os.remove(self.partLocation)
+        except FileNotFoundError:
+            pass
+
+    # returns length of video, tracked from the timestamps of the received chunks
+    def getLength(self):
+        """
+        Returns: seconds of video written so far
+        """
+        return self.durationTracker.duration
 
 
 class Downloader:
@@ -261,86 +349,52 @@ class Downloader:
                 }
                 downloading = False
             else:
-                convert = Convert()
-                mediaSession = self.tapo.getMediaSession()
-                if retry:
-                    mediaSession.set_window_size(50)
-                else:
-                    mediaSession.set_window_size(self.window_size)
-                async with mediaSession:
-                    payload = {
-                        "type": "request",
-                        "seq": 1,
-                        "params": {
-                            "playback": {
-                                "client_id": self.tapo.getUserID(),
-                                "channels": [0, 1],
-                                "scale": "1/1",
-                                "start_time": str(self.startTime),
-                                "end_time": str(self.endTime),
-                                "event_type": [1, 2],
-                            },
-                            "method": "get",
-                        },
-                    }
-
-                    payload = json.dumps(payload)
-                    dataChunks = 0
+                convert = Convert(fileName, segmentLength)
+                try:
+                    mediaSession = self.tapo.getMediaSession()
                     if retry:
-                        currentAction = "Retrying"
+                        mediaSession.set_window_size(50)
                     else:
-                        currentAction = "Downloading"
-                    downloadedFull = False
-                    async for resp in mediaSession.transceive(payload):
-                        if resp.mimetype == "video/mp2t":
-                            dataChunks += 1
-                            convert.write(resp.plaintext, resp.audioPayload)
-                            detectedLength = convert.getLength()
-                            if detectedLength is False:
-                                yield {
-                                    "currentAction": currentAction,
-                                    "fileName": fileName,
-                                    "progress": 0,
-                                    "total": segmentLength,
-                                }
-                                detectedLength = 0
-                            else:
+                        mediaSession.set_window_size(self.window_size)
+                    async with mediaSession:
+                        payload = {
+                            "type": "request",
+                            "seq": 1,
+                            "params": {
+                                "playback": {
+                                    "client_id": self.tapo.getUserID(),
+                                    "channels": [0, 1],
+                                    "scale": "1/1",
+                                    "start_time": str(self.startTime),
+                                    "end_time": str(self.endTime),
+                                    "event_type": [1, 2],
+                                },
+                                "method": "get",
+                            },
+                        }
+
+                        payload = json.dumps(payload)
+                        dataChunks = 0
+                        if retry:
+                            currentAction = "Retrying"
+                        else:
+                            currentAction = "Downloading"
+                        downloadedFull = False
+                        async for resp in mediaSession.transceive(payload):
+                            if resp.mimetype == "video/mp2t":
+                                dataChunks += 1
+                                await convert.write(resp.plaintext, resp.audioPayload)
+                                detectedLength = convert.getLength()
                                 yield {
                                     "currentAction": currentAction,
                                     "fileName": fileName,
                                     "progress": detectedLength,
                                     "total": segmentLength,
                                 }
-                            if (detectedLength > segmentLength + self.padding) or (
-                                    retry
-                                    and detectedLength
-                                    >= segmentLength  # fix for the latest latest recording
-                            ):
-                                downloadedFull = True
-                                currentAction = "Converting"
-                                yield {
-                                    "currentAction": currentAction,
-                                    "fileName": fileName,
-                                    "progress": 0,
-                                    "total": 0,
-                                }
-                                await convert.save(fileName, segmentLength)
-                                downloading = False
-                                break
-                        # in case a finished stream notification is caught, save the chunks as is
-                        elif resp.mimetype == "application/json":
-                            try:
-                                json_data = json.loads(resp.plaintext.decode())
-
-                                if (
-                                        "type" in json_data
-                                        and json_data["type"] == "notification"
-                                        and "params" in json_data
-                                        and "event_type" in json_data["params"]
-                                        and json_data["params"]["event_type"]
-                                        == "stream_status"
-                                        and "status" in json_data["params"]
-                                        and json_data["params"]["status"] == "finished"
+                                if (detectedLength > segmentLength + self.padding) or (
+                                        retry
+                                        and detectedLength
+                                        >= segmentLength  # fix for the latest latest recording
                                 ):
                                     downloadedFull = True
                                     currentAction = "Converting"
@@ -350,73 +404,105 @@ class Downloader:
                                         "progress": 0,
                                         "total": 0,
                                     }
-                                    await convert.save(fileName, convert.getLength())
+                                    await convert.save()
                                     downloading = False
                                     break
-                            except (KeyError, JSONDecodeError, AttributeError, ConnectionError, TypeError):
-                                self.tapo.debugLog(
-                                    "Unable to parse JSON sent from device"
-                                )
-                    if downloading:
-                        # Handle case where camera randomly stopped respoding
-                        if not downloadedFull and not retry:
-                            currentAction = "Retrying"
-                            yield {
-                                "currentAction": currentAction,
-                                "fileName": fileName,
-                                "progress": 0,
-                                "total": 0,
-                            }
-                            retry = True
-                        else:
-                            detectedLength = convert.getLength()
-                            if (
-                                    detectedLength >= segmentLength - 5
-                            ):  # workaround for weird cases where the recording is a bit shorter than reported
-                                downloadedFull = True
-                                currentAction = "Converting [shorter]"
+                            # in case a finished stream notification is caught, save the chunks as is
+                            elif resp.mimetype == "application/json":
+                                try:
+                                    json_data = json.loads(resp.plaintext.decode())
+
+                                    if (
+                                            "type" in json_data
+                                            and json_data["type"] == "notification"
+                                            and "params" in json_data
+                                            and "event_type" in json_data["params"]
+                                            and json_data["params"]["event_type"]
+                                            == "stream_status"
+                                            and "status" in json_data["params"]
+                                            and json_data["params"]["status"] == "finished"
+                                    ):
+                                        downloadedFull = True
+                                        currentAction = "Converting"
+                                        yield {
+                                            "currentAction": currentAction,
+                                            "fileName": fileName,
+                                            "progress": 0,
+                                            "total": 0,
+                                        }
+                                        await convert.save()
+                                        downloading = False
+                                        break
+                                except (KeyError, JSONDecodeError, AttributeError, ConnectionError, TypeError):
+                                    self.tapo.debugLog(
+                                        "Unable to parse JSON sent from device"
+                                    )
+                        if downloading:
+                            # Handle case where camera randomly stopped respoding
+                            if not downloadedFull and not retry:
+                                currentAction = "Retrying"
                                 yield {
                                     "currentAction": currentAction,
                                     "fileName": fileName,
                                     "progress": 0,
                                     "total": 0,
                                 }
-                                await convert.save(fileName, segmentLength)
+                                retry = True
                             else:
-                                currentAction = "Giving up"
-                                yield {
-                                    "currentAction": currentAction,
-                                    "fileName": fileName,
-                                    "progress": 0,
-                                    "total": 0,
-                                }
-                            downloading = False
+                                detectedLength = convert.getLength()
+                                if (
+                                        detectedLength >= segmentLength - 5
+                                ):  # workaround for weird cases where the recording is a bit shorter than reported
+                                    downloadedFull = True
+                                    currentAction = "Converting [shorter]"
+                                    yield {
+                                        "currentAction": currentAction,
+                                        "fileName": fileName,
+                                        "progress": 0,
+                                        "total": 0,
+                                    }
+                                    await convert.save()
+                                else:
+                                    currentAction = "Giving up"
+                                    yield {
+                                        "currentAction": currentAction,
+                                        "fileName": fileName,
+                                        "progress": 0,
+                                        "total": 0,
+                                    }
+                                downloading = False
+                finally:
+                    # ffmpeg and partial output of a failed or abandoned download
+                    convert.close()
 
 
-async def download_async(interface, camera_name: str, date: str, recording_id):
+# get /backend/recordings
+RECORDINGS_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+RECORDINGS_PATH = os.path.join(RECORDINGS_PATH, 'recordings')
+
+
+async def iter_download(interface, camera_name: str, date: str, recording_id):
     """
-    Own downloader implementation
+    Own downloader implementation, downloads one recording to /recordings
     Args:
         interface:              pytapo interface
         camera_name:            name of the camera
         date (YYYYMMDD):        date of the recordings
         recording_id:      recording ids
-    """
-    # navigate to /recordings
-    output_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-    output_dir = os.path.join(output_dir, 'recordings')
 
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-    # print("Getting recordings...")
-    recordings = interface.getRecordings(date)
+    Returns: async iterator of Downloader status dicts (currentAction, fileName, progress, total),
+             nothing if the camera has no such recording
+    """
+    if not os.path.isdir(RECORDINGS_PATH):
+        os.makedirs(RECORDINGS_PATH)
+    # pytapo requests are blocking
+    recordings = await asyncio.to_thread(interface.getRecordings, date)
 
-    timeCorrection = interface.getTimeCorrection()
+    timeCorrection = await asyncio.to_thread(interface.getTimeCorrection)
     for recording in recordings:
         for key in recording:
             # skip if recording not wanted
             if key != recording_id:
-                # print(key)
                 continue
 
             downloader_date = datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
@@ -428,10 +514,23 @@ async def download_async(interface, camera_name: str, date: str, recording_id):
                 camera_name,
                 recording_id,
                 downloader_date,
-                output_dir,
+                RECORDINGS_PATH,
                 None,
                 False,
                 50,
             )
-            async for _ in downloader.download():
-                pass
+            async for status in downloader.download():
+                yield status
+
+
+async def download_async(interface, camera_name: str, date: str, recording_id):
+    """
+    Downloads one recording to /recordings and waits until it is done
+    Args:
+        interface:              pytapo interface
+        camera_name:            name of the camera
+        date (YYYYMMDD):        date of the recordings
+        recording_id:      recording ids
+    """
+    async for _ in iter_download(interface, camera_name, date, recording_id):
+        pass
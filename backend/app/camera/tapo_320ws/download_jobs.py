@@ -0,0 +1,239 @@
+"""
+Module for background recording downloads - every download is a job with an id that runs in a bounded pool
+(at most DOWNLOAD_WORKERS at once, DOWNLOAD_CAMERA_CONCURRENCY per camera) while clients follow its progress
+and may cancel it. Downloads are single-flight, requests for a recording that is already being downloaded
+share the running job, which is cancelled only once every requester sharing it has cancelled.
+"""
+import asyncio
+import os
+import uuid
+from collections import OrderedDict
+from typing import AsyncGenerator, AsyncIterator, Dict, Optional, Tuple
+from dotenv import load_dotenv, find_dotenv
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.download_jobs').get_child_logger()
+
+load_dotenv(find_dotenv())
+# downloads running at the same time, others wait in the queue
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "2"))
+# downloads of one camera running at the same time (cameras struggle with parallel playback sessions)
+DOWNLOAD_CAMERA_CONCURRENCY = int(os.getenv("DOWNLOAD_CAMERA_CONCURRENCY", "1"))
+# finished jobs kept for status queries, the oldest are forgotten first
+DOWNLOAD_JOB_HISTORY = int(os.getenv("DOWNLOAD_JOB_HISTORY", "50"))
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_FINISHED = 'finished'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_DONE = (JOB_FINISHED, JOB_FAILED, JOB_CANCELLED)
+
+
+class DownloadJob:
+    """
+    One recording download and its latest progress
+    """
+
+    def __init__(self, camera: str, date: str, recording_id: str):
+        self.id = uuid.uuid4().hex
+        self.camera = camera
+        self.date = date
+        self.recording_id = recording_id
+        self.state = JOB_QUEUED
+        self.current_action = 'Queued'
+        self.progress = 0
+        self.total = 0
+        self.file_path: Optional[str] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        # requests sharing the job that have not cancelled it
+        self.requesters = 1
+        # replaced on every update -> followers wake up once per change
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        """
+        Returns: job ended (finished, failed or cancelled)
+        """
+        return self.state in JOB_DONE
+
+    def update(self, state: str = None, **fields) -> None:
+        """
+        Changes the job and wakes up its followers
+        """
+        if state is not None:
+            self.state = state
+        for name, value in fields.items():
+            setattr(self, name, value)
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def to_dict(self) -> dict:
+        """
+        Returns: JSON serializable job status (Downloader status fields + job state)
+        """
+        return {
+            "jobId": self.id,
+            "camera": self.camera,
+            "date": self.date,
+            "id": self.recording_id,
+            "state": self.state,
+            "currentAction": self.current_action,
+            "progress": self.progress,
+            "total": self.total,
+            "fileName": os.path.basename(self.file_path) if self.file_path else None,
+            "error": self.error,
+            "requesters": self.requesters,
+        }
+
+
+class DownloadJobManager:
+    """
+    Runs download jobs in the background with global and per-camera concurrency limits
+    """
+
+    def __init__(self, workers: int = DOWNLOAD_WORKERS, camera_concurrency: int = DOWNLOAD_CAMERA_CONCURRENCY,
+                 history: int = DOWNLOAD_JOB_HISTORY):
+        self.workers = workers
+        self.camera_concurrency = camera_concurrency
+        self.history = history
+        self.jobs: Dict[str, DownloadJob] = OrderedDict()
+        # queued and running jobs by (camera, date, recording id)
+        self.active: Dict[Tuple[str, str, str], DownloadJob] = {}
+        # created on first use -> bound to the running event loop
+        self.worker_slots: Optional[asyncio.Semaphore] = None
+        self.camera_slots: Dict[str, asyncio.Semaphore] = {}
+
+    def find(self, camera: str, date: str, recording_id: str) -> Optional[DownloadJob]:
+        """
+        Returns: queued or running job of the recording or None
+        """
+        return self.active.get((camera, date, recording_id))
+
+    def join(self, camera: str, date: str, recording_id: str) -> Optional[DownloadJob]:
+        """
+        Attaches another requester to the queued or running job of the recording
+        Returns: the shared job or None if the recording is not being downloaded
+        """
+        job = self.find(camera, date, recording_id)
+        if job is not None:
+            job.requesters += 1
+            logger.info('Download of %s %s %s shares running job %s (%d requesters)',
+                        camera, date, recording_id, job.id, job.requesters)
+        return job
+
+    def submit(self, camera: str, date: str, recording_id: str, statuses: AsyncGenerator[dict, None]) -> DownloadJob:
+        """
+        Queues a download, if the recording is already being downloaded the running job is returned instead
+        Args:
+            camera:         name of the camera
+            date:           date of the recording (YYYY-MM-DD)
+            recording_id:   id of the recording
+            statuses:       download to run, yields Downloader status dicts (see download.iter_download),
+                            not started when the running job is shared
+
+        Returns: the queued or the shared job
+        """
+        job = self.join(camera, date, recording_id)
+        if job is not None:
+            return job
+
+        if self.worker_slots is None:
+            self.worker_slots = asyncio.Semaphore(self.workers)
+        job = DownloadJob(camera, date, recording_id)
+        self.jobs[job.id] = job
+        self.active[(camera, date, recording_id)] = job
+        job.task = asyncio.get_event_loop().create_task(self.run(job, statuses))
+        self.forget_old_jobs()
+        logger.info('Download job %s queued: %s %s %s', job.id, camera, date, recording_id)
+        return job
+
+    async def run(self, job: DownloadJob, statuses: AsyncGenerator[dict, None]) -> None:
+        """
+        Waits for a free worker and camera slot, then runs the download and tracks its progress
+        """
+        camera_slots = self.camera_slots.setdefault(job.camera, asyncio.Semaphore(self.camera_concurrency))
+        try:
+            # camera first -> a job waiting for its busy camera does not hold a worker other cameras could use
+            async with camera_slots, self.worker_slots:
+                job.update(JOB_RUNNING, current_action='Starting download')
+                async for status in statuses:
+                    job.update(current_action=status.get("currentAction", job.current_action),
+                               progress=status.get("progress", 0), total=status.get("total", 0),
+                               file_path=status.get("fileName", job.file_path))
+
+            if job.file_path is not None and os.path.isfile(job.file_path):
+                job.update(JOB_FINISHED)
+            else:
+                job.update(JOB_FAILED, error=job.current_action if job.file_path else 'Recording not found')
+
+        except asyncio.CancelledError:
+            job.update(JOB_CANCELLED, current_action='Cancelled')
+            logger.info('Download job %s cancelled', job.id)
+            raise
+        # camera session errors must not kill the worker, the client sees them in the job
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            job.update(JOB_FAILED, error=str(error))
+            logger.error('Download job %s failed: %s', job.id, error)
+
+        finally:
+            self.active.pop((job.camera, job.date, job.recording_id), None)
+            # generator is closed here, not by the garbage collector -> ffmpeg and partial files are cleaned up
+            await statuses.aclose()
+
+        logger.info('Download job %s %s', job.id, job.state)
+
+    def get(self, job_id: str) -> Optional[DownloadJob]:
+        """
+        Returns: job with the id or None
+        """
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[DownloadJob]:
+        """
+        Withdraws one requester of a queued or running job, the job is cancelled when none is left
+        Returns: the job or None if it does not exist
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.done or job.task is None:
+            return job
+        job.requesters = max(0, job.requesters - 1)
+        if job.requesters:
+            logger.info('Download job %s still shared by %d requesters, not cancelled', job.id, job.requesters)
+        else:
+            job.task.cancel()
+        return job
+
+    async def follow(self, job_id: str) -> AsyncIterator[dict]:
+        """
+        Status of a job after every change until it ends (intermediate changes may be skipped for slow followers)
+        Returns: async iterator of job dicts, the last one is the final state
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        while True:
+            changed = job.changed
+            yield job.to_dict()
+            if job.done:
+                return
+            await changed.wait()
+
+    def forget_old_jobs(self) -> None:
+        """
+        Keeps at most history finished jobs
+        """
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    async def cancel_all(self) -> None:
+        """
+        Cancels all jobs (server shutdown)
+        """
+        tasks = [job.task for job in self.jobs.values() if job.task is not None and not job.done]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,221 @@
+"""
+Module for JPEG encoder backends - OpenCV (always available), libjpeg-turbo (PyTurboJPEG) and Pillow / Pillow-SIMD
+(optional, used when installed) with configurable quality and chroma subsampling.
+
+Benchmark of all available backends on this host:
+    python -m app.camera.tapo_320ws.encoders [--source video.mp4] [--width 1920] [--frames 50]
+"""
+import argparse
+import functools
+import io
+import os
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+import cv2
+import numpy as np
+from dotenv import load_dotenv, find_dotenv
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.encoders').get_child_logger()
+
+load_dotenv(find_dotenv())
+
+BACKEND_OPENCV = 'opencv'
+BACKEND_TURBOJPEG = 'turbojpeg'
+BACKEND_PILLOW = 'pillow'
+BACKENDS = (BACKEND_OPENCV, BACKEND_TURBOJPEG, BACKEND_PILLOW)
+
+SUBSAMPLINGS = ('444', '422', '420')
+
+# defaults of all streams, can be changed per stream (see RTSPStreamer.set_stream_options)
+JPEG_ENCODER = os.getenv("JPEG_ENCODER", BACKEND_OPENCV)
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "95"))
+JPEG_SUBSAMPLING = os.getenv("JPEG_SUBSAMPLING", "420")
+
+# encoder: BGR image -> JPEG bytes
+Encoder = Callable[[np.ndarray], bytes]
+
+
+class EncoderOptions(NamedTuple):
+    """
+    JPEG encoder configuration
+    """
+    backend: str = JPEG_ENCODER
+    quality: int = JPEG_QUALITY
+    subsampling: str = JPEG_SUBSAMPLING
+
+
+def opencv_encoder(quality: int, subsampling: str) -> Encoder:
+    """
+    Returns: cv2.imencode based encoder
+    """
+    sampling_factors = {
+        '444': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+        '422': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+        '420': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420,
+    }
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_SAMPLING_FACTOR, sampling_factors[subsampling]]
+
+    def encode(image: np.ndarray) -> bytes:
+        _, buffer = cv2.imencode('.jpg', image, params)
+        return buffer.tobytes()
+
+    return encode
+
+
+def turbojpeg_encoder(quality: int, subsampling: str) -> Encoder:
+    """
+    Returns: libjpeg-turbo encoder (needs PyTurboJPEG and the libturbojpeg library)
+    """
+    # optional dependency
+    import turbojpeg  # pylint: disable=import-outside-toplevel
+
+    jpeg = turbojpeg.TurboJPEG()
+    subsamplings = {'444': turbojpeg.TJSAMP_444, '422': turbojpeg.TJSAMP_422, '420': turbojpeg.TJSAMP_420}
+
+    def encode(image: np.ndarray) -> bytes:
+        return jpeg.encode(image, quality=quality, jpeg_subsample=subsamplings[subsampling])
+
+    return encode
+
+
+def pillow_encoder(quality: int, subsampling: str) -> Encoder:
+    """
+    Returns: Pillow encoder (Pillow-SIMD is a drop-in replacement of the same package)
+    """
+    # optional dependency
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    subsamplings = {'444': 0, '422': 1, '420': 2}
+
+    def encode(image: np.ndarray) -> bytes:
+        buffer = io.BytesIO()
+        Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(
+            buffer, 'JPEG', quality=quality, subsampling=subsamplings[subsampling])
+        return buffer.getvalue()
+
+    return encode
+
+
+ENCODER_FACTORIES: Dict[str, Callable[[int, str], Encoder]] = {
+    BACKEND_OPENCV: opencv_encoder,
+    BACKEND_TURBOJPEG: turbojpeg_encoder,
+    BACKEND_PILLOW: pillow_encoder,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(options: EncoderOptions = EncoderOptions()) -> Encoder:
+    """
+    Returns encoder for the options, falls back to OpenCV (with a warning, once per options) if the backend
+    is not installed
+    Args:
+        options: encoder configuration
+
+    Returns: function BGR image -> JPEG bytes
+    """
+    if options.backend not in ENCODER_FACTORIES:
+        raise ValueError(f"Unknown JPEG encoder: {options.backend}")
+    if options.subsampling not in SUBSAMPLINGS:
+        raise ValueError(f"Unknown chroma subsampling: {options.subsampling}")
+
+    try:
+        return ENCODER_FACTORIES[options.backend](options.quality, options.subsampling)
+    except (ImportError, RuntimeError, OSError) as error:
+        # module missing or libturbojpeg not found
+        logger.warning('JPEG encoder %s is not available (%s), falling back to %s',
+                       options.backend, error, BACKEND_OPENCV)
+        return opencv_encoder(options.quality, options.subsampling)
+
+
+def available_backends() -> List[str]:
+    """
+    Returns: backends installed on this host
+    """
+    available = []
+    for backend, factory in ENCODER_FACTORIES.items():
+        try:
+            factory(JPEG_QUALITY, JPEG_SUBSAMPLING)
+            available.append(backend)
+        except (ImportError, RuntimeError, OSError):
+            continue
+    return available
+
+
+def sample_frames(source: Optional[str], width: int, count: int) -> List[np.ndarray]:
+    """
+    Frames for the benchmark, read from a video / RTSP URL or synthesized (gradient + noise, similar entropy
+    to a camera image)
+    """
+    if source:
+        cap = cv2.VideoCapture(source)
+        frames = []
+        while len(frames) < count:
+            success, frame = cap.read()
+            if not success:
+                break
+            height = round(frame.shape[0] * width / frame.shape[1])
+            frames.append(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA))
+        cap.release()
+        if frames:
+            return frames
+
+    height = width * 9 // 16
+    generator = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    frames = []
+    for index in range(count):
+        noise = generator.normal(0, 12, (height, width, 3))
+        frames.append(np.clip(np.roll(gradient, index * 8, axis=1) + noise, 0, 255).astype(np.uint8))
+    return frames
+
+
+def benchmark(frames: List[np.ndarray], backends: List[str], qualities: List[int],
+              subsamplings: List[str]) -> List[dict]:
+    """
+    Measures encode throughput of every combination
+    Returns: list of results (backend, quality, subsampling, fps, ms per frame, average size)
+    """
+    results = []
+    for backend in backends:
+        for quality in qualities:
+            for subsampling in subsamplings:
+                encode = ENCODER_FACTORIES[backend](quality, subsampling)
+                encode(frames[0])
+                start = time.perf_counter()
+                total_size = sum(len(encode(frame)) for frame in frames)
+                elapsed = time.perf_counter() - start
+                results.append({
+                    "backend": backend,
+                    "quality": quality,
+                    "subsampling": subsampling,
+                    "fps": len(frames) / elapsed,
+                    "ms": elapsed / len(frames) * 1000,
+                    "bytes": total_size // len(frames),
+                })
+    return results
+
+
+def main():
+    """
+    Benchmark command line entry point
+    """
+    parser = argparse.ArgumentParser(description="JPEG encoder benchmark")
+    parser.add_argument("--source", help="video file or RTSP URL with sample frames (default synthetic frames)")
+    parser.add_argument("--width", type=int, default=1920, help="frame width")
+    parser.add_argument("--frames", type=int, default=50, help="number of frames")
+    parser.add_argument("--quality", type=int, nargs='+', default=[JPEG_QUALITY], help="JPEG qualities")
+    parser.add_argument("--subsampling", nargs='+', default=list(SUBSAMPLINGS), choices=SUBSAMPLINGS)
+    arguments = parser.parse_args()
+
+    frames = sample_frames(arguments.source, arguments.width, arguments.frames)
+    print(f"{len(frames)} frames {frames[0].shape[1]}x{frames[0].shape[0]}, backends: {available_backends()}")
+    print(f"{'backend':<10} {'quality':>7} {'sampling':>8} {'fps':>8} {'ms':>7} {'bytes':>9}")
+    results = benchmark(frames, available_backends(), arguments.quality, arguments.subsampling)
+    for result in sorted(results, key=lambda item: -item["fps"]):
+        print(f"{result['backend']:<10} {result['quality']:>7} {result['subsampling']:>8} "
+              f"{result['fps']:>8.1f} {result['ms']:>7.2f} {result['bytes']:>9}")
+
+
+if __name__ == "__main__":
+    main()
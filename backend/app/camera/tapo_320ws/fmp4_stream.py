@@ -0,0 +1,197 @@
+"""
+Module for H.264 passthrough streaming - RTSP is remuxed into fragmented MP4 by ffmpeg (stream copy, no decoding)
+and pushed over WebSocket for Media Source Extensions playback
+"""
+import asyncio
+import json
+import struct
+from typing import Dict, Optional, Tuple
+from app.camera.tapo_320ws.video_stream import RTSPStreamer, Region, TRANSPORT_BINARY, QUALITY_HIGH
+from app.utils.ffmpeg import rtsp_input_args
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.fmp4_stream').get_child_logger()
+
+FORMAT_FMP4 = 'fmp4'
+
+# boxes that make up the init segment, everything else belongs to media fragments
+INIT_BOXES = (b'ftyp', b'moov')
+
+
+def fmp4_ffmpeg_args(rtsp_url: str) -> list:
+    """
+    ffmpeg arguments for remuxing the camera video track into fragmented MP4 on stdout
+    Args:
+        rtsp_url: RTSP URL of the camera
+
+    Returns: ffmpeg argv
+    """
+    return rtsp_input_args(rtsp_url) + [
+        "-map", "0:v:0",
+        "-c:v", "copy",
+        "-an",
+        "-f", "mp4",
+        # each fragment starts with a keyframe -> clients can join (or skip) at any fragment
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "pipe:1",
+    ]
+
+
+async def read_box(reader: asyncio.StreamReader) -> Tuple[bytes, bytes]:
+    """
+    Reads one top-level ISO BMFF box
+    Args:
+        reader: stream to read from
+
+    Returns: (box type, whole box including header)
+    """
+    header = await reader.readexactly(8)
+    size, box_type = struct.unpack('>I4s', header)
+    if size == 1:
+        # 64-bit largesize follows the type
+        large_size = await reader.readexactly(8)
+        header += large_size
+        size = struct.unpack('>Q', large_size)[0]
+    elif size == 0:
+        # box extends to the end of the stream
+        return box_type, header + await reader.read()
+
+    body = await reader.readexactly(size - len(header))
+    return box_type, header + body
+
+
+def get_codec_string(init_segment: bytes) -> Optional[str]:
+    """
+    Builds RFC 6381 codec string from the avcC box of an init segment
+    Args:
+        init_segment: ftyp + moov
+
+    Returns: ex. 'avc1.4d001f' or None if the track is not H.264
+    """
+    index = init_segment.find(b'avcC')
+    if index == -1 or len(init_segment) < index + 8:
+        return None
+    profile, compatibility, level = init_segment[index + 5:index + 8]
+    return f"avc1.{profile:02x}{compatibility:02x}{level:02x}"
+
+
+class FMP4Streamer(RTSPStreamer):
+    """
+    Streams camera H.264 as fragmented MP4 without decoding it.
+    Reuses client handling of RTSPStreamer, each client gets:
+        1. JSON text hello with the MSE mime type
+        2. init segment (ftyp + moov)
+        3. media fragments (moof + mdat), each starting with a keyframe
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.init_segments: Dict[str, bytes] = {}
+
+    def add_client(self, rtsp_url: str, websocket, transport: str = TRANSPORT_BINARY, camera_name: str = '',
+                   quality: str = QUALITY_HIGH, region: Optional[Region] = None,
+                   max_fps: Optional[float] = None) -> str:
+        """
+        Adds a WebSocket client, late joiners get the already known init segment first.
+        Nothing is decoded, so quality only selects the camera stream (rtsp_url) and the session is keyed by it,
+        regions of interest and frame rate caps are not supported (region and max_fps are ignored).
+        """
+        key = super().add_client(rtsp_url, websocket, TRANSPORT_BINARY, camera_name)
+
+        if rtsp_url in self.init_segments:
+            self.send_init_segment(self.stream_clients[websocket], self.init_segments[rtsp_url])
+
+        return key
+
+    @staticmethod
+    def send_init_segment(stream_client, init_segment: bytes):
+        """
+        Queues hello and init segment for a client, these are never dropped
+        """
+        codec = get_codec_string(init_segment)
+        mime_type = f'video/mp4; codecs="{codec}"' if codec else 'video/mp4'
+        stream_client.offer_preamble(json.dumps({"format": FORMAT_FMP4, "mimeType": mime_type}))
+        stream_client.offer_preamble(init_segment)
+
+    def start_output(self, key: str):
+        """
+        Fragments are dispatched by the remuxer task itself (see process_stream), no per-output queue
+        """
+
+    async def send_to_clients(self, rtsp_url: str, frame: bytes):
+        """
+        Queues one media fragment for each client of the stream
+        """
+        for client in self.clients.get(rtsp_url, []):
+            stream_client = self.stream_clients.get(client)
+            if stream_client is not None:
+                stream_client.offer(frame)
+
+    async def process_stream(self, rtsp_url: str):
+        """
+        Runs ffmpeg remuxer and splits its output into init segment and fragments
+        """
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *fmp4_ffmpeg_args(rtsp_url),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        except OSError as error:
+            logger.error('Failed to start ffmpeg for %s: %s', rtsp_url, error)
+            self.streams.pop(rtsp_url, None)
+            self.outputs.pop(rtsp_url, None)
+            self.remove_all_clients(rtsp_url)
+            return
+
+        self.streams[rtsp_url] = process
+        init_boxes = []
+        fragment_boxes = []
+
+        try:
+            while self.clients.get(rtsp_url):
+                box_type, box = await read_box(process.stdout)
+
+                if rtsp_url not in self.init_segments:
+                    if box_type in INIT_BOXES:
+                        init_boxes.append(box)
+                    if box_type == b'moov':
+                        init_segment = b''.join(init_boxes)
+                        self.init_segments[rtsp_url] = init_segment
+                        for client in self.clients.get(rtsp_url, []):
+                            if client in self.stream_clients:
+                                self.send_init_segment(self.stream_clients[client], init_segment)
+                    continue
+
+                fragment_boxes.append(box)
+                # mdat closes the fragment (styp/sidx/moof come before it)
+                if box_type == b'mdat':
+                    await self.send_to_clients(rtsp_url, b''.join(fragment_boxes))
+                    fragment_boxes = []
+
+        except asyncio.IncompleteReadError:
+            logger.info('fMP4 remuxer for %s ended (exit code %s)', rtsp_url, process.returncode)
+
+        finally:
+            # session is detached before the first await -> a client joining while ffmpeg exits
+            # is not attached to this session but starts a new one (see add_client)
+            if self.streams.get(rtsp_url) is process:
+                del self.streams[rtsp_url]
+            self.init_segments.pop(rtsp_url, None)
+            self.outputs.pop(rtsp_url, None)
+            self.remove_all_clients(rtsp_url)
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+
+    def start_stream(self, rtsp_url: str):
+        """
+        Starts ffmpeg remuxer task for the stream
+        """
+        if rtsp_url in self.streams:
+            logger.info('Stream already active: %s', rtsp_url)
+            return
+
+        # placeholder until the ffmpeg process is running -> prevents double start
+        self.streams[rtsp_url] = None
+        asyncio.get_event_loop().create_task(self.process_stream(rtsp_url))
@@ -0,0 +1,335 @@
+"""
+Module for live HLS - one ffmpeg segmenter per camera stream-copies RTSP into a rolling ring of TS segments on disk.
+The ring doubles as timeshift buffer - with TIMESHIFT_MINUTES set it keeps the last minutes of every running camera
+and playback can start anywhere in it (point HLS_PATH to a tmpfs to keep the ring in memory).
+"""
+import asyncio
+import math
+import os
+import re
+import shutil
+import time
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Set
+from dotenv import load_dotenv, find_dotenv
+from app.utils.ffmpeg import rtsp_input_args
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.hls').get_child_logger()
+
+load_dotenv(find_dotenv())
+# target segment length in seconds (actual length follows camera keyframe interval)
+HLS_SEGMENT_SECONDS = int(os.getenv("HLS_SEGMENT_SECONDS", "2"))
+# number of segments in the live playlist, ffmpeg deletes older segments from disk
+HLS_LIST_SIZE = int(os.getenv("HLS_LIST_SIZE", "6"))
+# segmenter is stopped when nobody requested its playlist/segments for this many seconds
+HLS_IDLE_TIMEOUT = int(os.getenv("HLS_IDLE_TIMEOUT", "60"))
+# minutes of video kept for timeshift playback, 0 = only the live playlist window
+TIMESHIFT_MINUTES = float(os.getenv("TIMESHIFT_MINUTES", "0"))
+# comma separated camera names segmented all the time (timeshift buffer is always filled)
+TIMESHIFT_CAMERAS = [name.strip() for name in os.getenv("TIMESHIFT_CAMERAS", "").split(',') if name.strip()]
+# comma separated camera names saving event clips on alarm (see clips module), segmented all the time
+CLIP_CAMERAS = [name.strip() for name in os.getenv("CLIP_CAMERAS", "").split(',') if name.strip()]
+# seconds saved before / after an alarm in event clips, the ring always holds them
+CLIP_PRE_ROLL = float(os.getenv("CLIP_PRE_ROLL", "10"))
+CLIP_POST_ROLL = float(os.getenv("CLIP_POST_ROLL", "20"))
+# segments kept on disk by ffmpeg (clips: +2 segments for the one being written and the cut delay)
+HLS_RING_SIZE = max(HLS_LIST_SIZE, math.ceil(TIMESHIFT_MINUTES * 60 / HLS_SEGMENT_SECONDS),
+                    math.ceil((CLIP_PRE_ROLL + CLIP_POST_ROLL) / HLS_SEGMENT_SECONDS) + 2 if CLIP_CAMERAS else 0)
+
+# get /backend/hls
+HLS_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+HLS_PATH = os.path.join(HLS_PATH, 'hls')
+
+PLAYLIST_NAME = 'index.m3u8'
+SEGMENT_PATTERN = re.compile(r'^segment_\d{6,}\.ts$')
+
+
+class HLSSegment(NamedTuple):
+    """
+    One segment of an HLS playlist
+    """
+    uri: str
+    duration: float
+    sequence: int
+    # wall clock time of the first frame (unix seconds), None if the playlist has no program date time
+    start_time: Optional[float] = None
+
+
+def parse_playlist(playlist: str) -> List[HLSSegment]:
+    """
+    Parses segments of a media playlist written by ffmpeg
+    Args:
+        playlist: m3u8 text
+
+    Returns: segments in playlist order
+    """
+    segments = []
+    sequence = 0
+    duration = None
+    start_time = None
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+            start_time = datetime.fromisoformat(line.split(':', 1)[1]).timestamp()
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',')[0])
+        elif line and not line.startswith('#') and duration is not None:
+            segments.append(HLSSegment(line, duration, sequence, start_time))
+            sequence += 1
+            duration = None
+            start_time = None
+    return segments
+
+
+def render_playlist(segments: List[HLSSegment], start_at_first: bool = False) -> str:
+    """
+    Builds a live media playlist (no ENDLIST) from segments
+    Args:
+        segments:       segments to list
+        start_at_first: players start at the first segment instead of the live edge
+
+    Returns: m3u8 text
+    """
+    target_duration = math.ceil(max((segment.duration for segment in segments), default=HLS_SEGMENT_SECONDS))
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        f"#EXT-X-MEDIA-SEQUENCE:{segments[0].sequence if segments else 0}",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+    ]
+    if start_at_first:
+        lines.append("#EXT-X-START:TIME-OFFSET=0,PRECISE=YES")
+    for segment in segments:
+        if segment.start_time is not None:
+            start = datetime.fromtimestamp(segment.start_time).astimezone().isoformat(timespec='milliseconds')
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{start}")
+        lines.append(f"#EXTINF:{segment.duration:.6f},")
+        lines.append(segment.uri)
+    return '\n'.join(lines) + '\n'
+
+
+def hls_ffmpeg_args(rtsp_url: str, output_dir: str, list_size: int = HLS_RING_SIZE, start_number: int = 0) -> list:
+    """
+    ffmpeg arguments for segmenting the camera video track into a live HLS playlist
+    Args:
+        rtsp_url:       RTSP URL of the camera
+        output_dir:     directory for playlist and segments
+        list_size:      segments kept in the playlist and on disk
+        start_number:   media sequence number and file name index of the first segment
+
+    Returns: ffmpeg argv
+    """
+    return rtsp_input_args(rtsp_url) + [
+        "-map", "0:v:0",
+        "-c:v", "copy",
+        "-an",
+        "-f", "hls",
+        "-hls_time", str(HLS_SEGMENT_SECONDS),
+        "-hls_list_size", str(list_size),
+        "-start_number", str(start_number),
+        "-hls_flags", "delete_segments+independent_segments+omit_endlist+program_date_time+temp_file",
+        "-hls_segment_filename", os.path.join(output_dir, "segment_%06d.ts"),
+        os.path.join(output_dir, PLAYLIST_NAME),
+    ]
+
+
+class HLSSegmenter:
+    """
+    ffmpeg HLS segmenter of one camera
+    """
+
+    def __init__(self, name: str, rtsp_url: str, output_dir: str):
+        self.name = name
+        self.rtsp_url = rtsp_url
+        self.output_dir = output_dir
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.last_access = time.monotonic()
+
+    @property
+    def playlist_path(self) -> str:
+        """
+        Returns: path of the live playlist
+        """
+        return os.path.join(self.output_dir, PLAYLIST_NAME)
+
+    def is_running(self) -> bool:
+        """
+        Returns: True if ffmpeg is still running
+        """
+        return self.process is not None and self.process.returncode is None
+
+    def touch(self) -> None:
+        """
+        Marks the segmenter as used (postpones idle shutdown)
+        """
+        self.last_access = time.monotonic()
+
+    async def start(self) -> None:
+        """
+        Starts ffmpeg with a clean output directory, numbering of segments continues from the current time
+        -> a restarted segmenter never reuses the name of a segment clients may have cached
+        """
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+        os.makedirs(self.output_dir)
+
+        # segments are at least 1 s long -> numbers of a run stay below the start number of the next one
+        self.process = await asyncio.create_subprocess_exec(
+            *hls_ffmpeg_args(self.rtsp_url, self.output_dir, start_number=int(time.time())),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        self.touch()
+        logger.info('Started HLS segmenter for %s', self.name)
+
+    async def stop(self) -> None:
+        """
+        Stops ffmpeg and removes all segments
+        """
+        if self.is_running():
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+        logger.info('Stopped HLS segmenter for %s', self.name)
+
+    def read_segments(self) -> List[HLSSegment]:
+        """
+        Returns: all segments of the ring (oldest first)
+        """
+        try:
+            with open(self.playlist_path, 'r', encoding='utf-8') as file:
+                return parse_playlist(file.read())
+        except FileNotFoundError:
+            return []
+
+    def live_playlist(self) -> str:
+        """
+        Returns: live playlist with the last HLS_LIST_SIZE segments of the ring
+        """
+        return render_playlist(self.read_segments()[-HLS_LIST_SIZE:])
+
+    def timeshift_playlist(self, start: float) -> str:
+        """
+        Playlist for playback from a point in the past, players start at its first segment
+        and continue up to the live edge
+        Args:
+            start: wall clock time (unix seconds) to start from, older than the ring = oldest segment
+
+        Returns: m3u8 text
+        """
+        segments = self.read_segments()
+        for index, segment in enumerate(segments):
+            if segment.start_time is not None and segment.start_time + segment.duration > start:
+                return render_playlist(segments[index:], start_at_first=True)
+        return render_playlist(segments[-1:], start_at_first=True)
+
+    def buffered_seconds(self) -> float:
+        """
+        Returns: seconds of video in the ring
+        """
+        return sum(segment.duration for segment in self.read_segments())
+
+    async def wait_for_playlist(self, timeout: float) -> bool:
+        """
+        Waits until ffmpeg wrote the first playlist
+        Args:
+            timeout: seconds to wait
+
+        Returns: True if the playlist exists
+        """
+        deadline = time.monotonic() + timeout
+        while not os.path.isfile(self.playlist_path):
+            if not self.is_running() or time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.2)
+        return True
+
+
+class HLSManager:
+    """
+    Keeps at most one segmenter per camera, shared by all viewers, and stops idle ones
+    """
+
+    def __init__(self, path_hls: str = HLS_PATH, idle_timeout: float = HLS_IDLE_TIMEOUT):
+        self.path_hls = path_hls
+        self.idle_timeout = idle_timeout
+        self.segmenters: Dict[str, HLSSegmenter] = {}
+        # cameras segmented without viewers (timeshift), never stopped for inactivity
+        self.pinned: Set[str] = set()
+        self.reaper_task: Optional[asyncio.Task] = None
+        # serializes segmenter starts -> concurrent first viewers share one ffmpeg
+        self.lock = asyncio.Lock()
+
+    def get_running(self, name: str) -> Optional[HLSSegmenter]:
+        """
+        Returns: running segmenter of the camera (touched) or None
+        """
+        segmenter = self.segmenters.get(name)
+        if segmenter is None or not segmenter.is_running():
+            return None
+        segmenter.touch()
+        return segmenter
+
+    async def get_segmenter(self, name: str, rtsp_url: str) -> HLSSegmenter:
+        """
+        Returns running segmenter of the camera, starts it if needed
+        Args:
+            name:       name of the camera
+            rtsp_url:   RTSP URL of the camera
+        """
+        async with self.lock:
+            segmenter = self.get_running(name)
+            if segmenter is not None:
+                return segmenter
+
+            segmenter = HLSSegmenter(name, rtsp_url, os.path.join(self.path_hls, name))
+            await segmenter.start()
+            self.segmenters[name] = segmenter
+
+            if self.reaper_task is None or self.reaper_task.done():
+                self.reaper_task = asyncio.get_event_loop().create_task(self.reap_idle())
+
+            return segmenter
+
+    async def pin(self, name: str, rtsp_url: str) -> HLSSegmenter:
+        """
+        Starts segmenter of the camera and keeps it running without viewers (restarted if ffmpeg exits)
+        Args:
+            name:       name of the camera
+            rtsp_url:   RTSP URL of the camera
+        """
+        self.pinned.add(name)
+        return await self.get_segmenter(name, rtsp_url)
+
+    async def reap_idle(self) -> None:
+        """
+        Periodically stops segmenters nobody used for idle_timeout seconds, restarts pinned ones that exited
+        """
+        while self.segmenters:
+            await asyncio.sleep(min(self.idle_timeout, 10))
+            now = time.monotonic()
+            for name, segmenter in list(self.segmenters.items()):
+                if name in self.pinned:
+                    if not segmenter.is_running():
+                        logger.info('Restarting pinned HLS segmenter for %s', name)
+                        await segmenter.start()
+                elif not segmenter.is_running() or now - segmenter.last_access > self.idle_timeout:
+                    del self.segmenters[name]
+                    await segmenter.stop()
+
+    async def stop_all(self) -> None:
+        """
+        Stops all segmenters (server shutdown)
+        """
+        if self.reaper_task is not None:
+            self.reaper_task.cancel()
+        for name in list(self.segmenters):
+            await self.segmenters.pop(name).stop()
@@ -5,7 +5,7 @@ from fastapi.exceptions import HTTPException
 from pytapo import Tapo
 
 from app.camera.base_interface import CameraBaseInterface
-from app.camera.tapo_320ws.utils import get_auth_by_name
+from app.camera.tapo_320ws.utils import get_auth_by_name, build_stream_url
 from app.utils.time_utils import minute_ago
 
 
@@ -77,13 +77,15 @@ class Tapo320WSBaseInterface(CameraBaseInterface):
 
         self.tapo_interface.reverseWhitelampStatus()
 
-    def get_stream_url(self) -> str:
+    def get_stream_url(self, quality: str = 'high') -> str:
         """
         Gets URL for camera stream
+        Args:
+            quality: 'high' -> full resolution main stream (stream1), anything else -> substream (stream2)
 
         Returns: stream URL
         """
-        stream_url = f"rtsp://{self.camera_username}:{self.camera_password}@{self.ip}:554/stream1"
+        stream_url = build_stream_url(self.ip, self.camera_username, self.camera_password, quality)
 
         return stream_url
 
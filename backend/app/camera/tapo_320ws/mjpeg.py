@@ -0,0 +1,61 @@
+"""
+Module for MJPEG streaming over plain HTTP (multipart/x-mixed-replace), viewable in an <img> tag
+"""
+import asyncio
+from typing import AsyncIterator
+
+MJPEG_BOUNDARY = 'frame'
+MJPEG_MEDIA_TYPE = f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}'
+# seconds between checks whether the client is still attached to the stream
+MJPEG_CHECK_INTERVAL = 5.0
+
+
+def pack_mjpeg_part(jpeg: bytes) -> bytes:
+    """
+    Wraps JPEG bytes into one part of the multipart response
+    Args:
+        jpeg: encoded frame
+
+    Returns: boundary + part headers + JPEG bytes
+    """
+    header = (f"--{MJPEG_BOUNDARY}\r\n"
+              f"Content-Type: image/jpeg\r\n"
+              f"Content-Length: {len(jpeg)}\r\n\r\n").encode('ascii')
+    return header + jpeg + b"\r\n"
+
+
+class MJPEGSink:
+    """
+    Stands in for the WebSocket of a StreamClient, hands parts over to the HTTP response.
+    Holds a single part, so a slow HTTP client makes its StreamClient drop frames (latest frame wins).
+    """
+
+    def __init__(self):
+        self.parts: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def send_bytes(self, part: bytes) -> None:
+        """
+        Waits until the response took the previous part
+        """
+        await self.parts.put(part)
+
+
+async def mjpeg_stream(streamer, key: str, sink: MJPEGSink) -> AsyncIterator[bytes]:
+    """
+    Yields multipart parts of a client until it disconnects or is removed from the stream
+    Args:
+        streamer:   RTSPStreamer the sink was added to
+        key:        stream key returned by add_client
+        sink:       client sink
+
+    Returns: async iterator of parts (StreamingResponse body)
+    """
+    try:
+        while sink in streamer.stream_clients:
+            try:
+                yield await asyncio.wait_for(sink.parts.get(), timeout=MJPEG_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+    finally:
+        # client disconnected (generator closed) or stream ended
+        streamer.remove_client(key, sink)
@@ -0,0 +1,169 @@
+"""
+Module for the multi-camera mosaic - one grid of all selected cameras composed on the server
+and encoded once for every viewer of the same layout
+"""
+import asyncio
+import math
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import cv2
+import numpy as np
+from dotenv import load_dotenv, find_dotenv
+from app.camera.tapo_320ws.encoders import get_encoder
+from app.camera.tapo_320ws.video_stream import (RTSPStreamer, Frame, QUALITY_HIGH, QUALITY_THUMB, TRANSPORT_TEXT,
+                                                TRANSPORT_BINARY)
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.mosaic').get_child_logger()
+
+load_dotenv(find_dotenv())
+# frames per second of the composed mosaic
+MOSAIC_FPS = float(os.getenv("MOSAIC_FPS", "2"))
+# width of one camera tile in pixels (16:9 tiles)
+MOSAIC_TILE_WIDTH = int(os.getenv("MOSAIC_TILE_WIDTH", "320"))
+
+
+class MosaicLayout(NamedTuple):
+    """
+    Cameras of a mosaic and their tile geometry
+    """
+    cameras: Tuple[Tuple[str, str], ...]    # (camera name, RTSP URL of its substream)
+    columns: int
+    tile_width: int = MOSAIC_TILE_WIDTH
+    fps: float = MOSAIC_FPS
+
+    @property
+    def tile_size(self) -> Tuple[int, int]:
+        """
+        Returns: (width, height) of one tile
+        """
+        return self.tile_width, self.tile_width * 9 // 16
+
+    @property
+    def key(self) -> str:
+        """
+        Returns: key shared by all viewers of the same layout
+        """
+        names = ','.join(name for name, _ in self.cameras)
+        return f"mosaic:{names}:{self.columns}:{self.tile_width}:{self.fps:g}"
+
+
+def default_columns(count: int) -> int:
+    """
+    Returns: columns of the most square grid for count tiles
+    """
+    return max(1, math.ceil(math.sqrt(count)))
+
+
+def compose_grid(tiles: List[Optional[np.ndarray]], columns: int, tile_size: Tuple[int, int]) -> np.ndarray:
+    """
+    Tiles images into a grid, missing tiles stay black
+    Args:
+        tiles:      decoded images (any size, resized to tile_size) or None
+        columns:    tiles per row
+        tile_size:  (width, height) of one tile
+
+    Returns: BGR grid image
+    """
+    width, height = tile_size
+    rows = max(1, math.ceil(len(tiles) / columns))
+    grid = np.zeros((rows * height, columns * width, 3), dtype=np.uint8)
+
+    for index, tile in enumerate(tiles):
+        if tile is None:
+            continue
+        if tile.shape[1] != width or tile.shape[0] != height:
+            tile = cv2.resize(tile, (width, height), interpolation=cv2.INTER_AREA)
+        row, column = divmod(index, columns)
+        grid[row * height:(row + 1) * height, column * width:(column + 1) * width] = tile
+
+    return grid
+
+
+class HoldSink:
+    """
+    Client of a camera stream that only keeps its output running, the mosaic reads the output's latest frame
+    """
+
+    async def send_bytes(self, _: bytes) -> None:
+        """
+        Ignores the frame
+        """
+
+
+class MosaicStreamer(RTSPStreamer):
+    """
+    Streams composed mosaics. Reuses client handling of RTSPStreamer, a "stream" is one layout (MosaicLayout.key)
+    composed by an asyncio task (see compose) from the thumbnail outputs of the source streamer.
+    """
+
+    def __init__(self, source: RTSPStreamer):
+        super().__init__()
+        self.source = source
+        self.layouts: Dict[str, MosaicLayout] = {}
+
+    def add_layout_client(self, layout: MosaicLayout, websocket, transport: str = TRANSPORT_TEXT) -> str:
+        """
+        Adds a client of the mosaic layout and starts composing it if needed
+        Returns: stream key of the client (used for remove_client)
+        """
+        self.layouts[layout.key] = layout
+        return self.add_client(layout.key, websocket, transport, layout.key, QUALITY_HIGH)
+
+    def start_stream(self, rtsp_url: str):
+        """
+        Starts compose task of the layout (rtsp_url is the layout key)
+        """
+        if rtsp_url in self.streams:
+            logger.info('Mosaic already active: %s', rtsp_url)
+            return
+        self.streams[rtsp_url] = asyncio.get_event_loop().create_task(self.compose(rtsp_url))
+
+    async def compose(self, key: str):
+        """
+        Composes the mosaic at the layout FPS while it has clients.
+        Tiles are decoded only when their camera delivered a new frame, unchanged mosaics are not re-encoded.
+        """
+        layout = self.layouts[key]
+        loop = asyncio.get_event_loop()
+        holds = []
+        for name, rtsp_url in layout.cameras:
+            sink = HoldSink()
+            # tiles are read at the layout FPS -> cameras watched only by mosaics are not encoded faster
+            holds.append((self.source.add_client(rtsp_url, sink, TRANSPORT_BINARY, name, QUALITY_THUMB,
+                                                 max_fps=layout.fps), sink))
+
+        sources: List[Optional[Frame]] = [None] * len(layout.cameras)
+        tiles: List[Optional[np.ndarray]] = [None] * len(layout.cameras)
+
+        def render(updates: List[Tuple[int, Frame]]) -> bytes:
+            # decode + tile + encode off the event loop
+            for index, frame in updates:
+                tiles[index] = cv2.imdecode(np.frombuffer(frame.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            return get_encoder()(compose_grid(tiles, layout.columns, layout.tile_size))
+
+        sequence = 0
+        try:
+            while self.active_outputs(key):
+                tick = loop.time()
+
+                updates = []
+                for index, (_, rtsp_url) in enumerate(layout.cameras):
+                    frame = self.source.get_latest_frame(rtsp_url, QUALITY_THUMB)
+                    if frame is not None and frame is not sources[index]:
+                        sources[index] = frame
+                        updates.append((index, frame))
+
+                # first mosaic is sent even without any camera frame (black tiles)
+                if updates or sequence == 0:
+                    data = await asyncio.to_thread(render, updates)
+                    sequence += 1
+                    self.enqueue_frame(key, Frame(data, sequence, time.time()))
+
+                await asyncio.sleep(max(0.0, tick + 1 / layout.fps - loop.time()))
+        finally:
+            for hold_key, sink in holds:
+                self.source.remove_client(hold_key, sink)
+            self.streams.pop(key, None)
+            self.stop_outputs(key)
@@ -0,0 +1,116 @@
+"""
+Module for tracking the duration of an MPEG-TS stream while it is being received - video PES timestamps
+are parsed from the packets as chunks arrive, so the length of a download is known without running ffprobe
+"""
+from typing import Optional
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+# PTS ticks per second
+PTS_CLOCK = 90000
+# PTS is a 33-bit counter that wraps around (~26.5 hours)
+PTS_WRAP = 1 << 33
+
+
+def parse_pts(header: bytes) -> Optional[int]:
+    """
+    Reads PTS of a PES packet
+    Args:
+        header: start of the PES packet (at least 14 bytes)
+
+    Returns: PTS in 90 kHz ticks or None if the packet has none
+    """
+    if len(header) < 14 or header[0:3] != b'\x00\x00\x01':
+        return None
+    # PTS_DTS_flags '10' or '11'
+    if not header[7] & 0x80:
+        return None
+    return (((header[9] >> 1) & 0x07) << 30 | header[10] << 22 | (header[11] >> 1) << 15
+            | header[12] << 7 | header[13] >> 1)
+
+
+class TSDurationTracker:
+    """
+    Incremental duration of an MPEG-TS stream, O(1) per packet and no copies of the stream are kept
+    """
+
+    def __init__(self):
+        # tail of the last chunk shorter than a packet
+        self.remainder = b''
+        self.video_pid: Optional[int] = None
+        self.first_pts: Optional[int] = None
+        self.last_pts: Optional[int] = None
+        # last_pts unwrapped onto a continuous timeline starting at first_pts
+        self.elapsed = 0
+        self.max_elapsed = 0
+        # duration of the latest frame is counted too (like ffprobe does)
+        self.frame_ticks = 0
+
+    @property
+    def duration(self) -> float:
+        """
+        Returns: seconds of video from the first frame to the end of the latest one
+        """
+        return (self.max_elapsed + self.frame_ticks) / PTS_CLOCK
+
+    def feed(self, data: bytes) -> None:
+        """
+        Parses a chunk of the stream, packets may be split between chunks
+        """
+        data = self.remainder + data
+        offset = 0
+        while len(data) - offset >= TS_PACKET_SIZE:
+            if data[offset] != TS_SYNC_BYTE:
+                # lost sync -> skip to the next sync byte
+                offset = data.find(bytes((TS_SYNC_BYTE,)), offset + 1)
+                if offset < 0:
+                    offset = len(data)
+                continue
+            self.read_packet(data[offset:offset + TS_PACKET_SIZE])
+            offset += TS_PACKET_SIZE
+        self.remainder = data[offset:]
+
+    def read_packet(self, packet: bytes) -> None:
+        """
+        Updates the duration from a video packet that starts a PES (frame)
+        """
+        # payload_unit_start_indicator
+        if not packet[1] & 0x40:
+            return
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        if self.video_pid is not None and pid != self.video_pid:
+            return
+
+        adaptation_field_control = (packet[3] >> 4) & 0x03
+        if adaptation_field_control == 0x02:
+            # adaptation field only, no payload
+            return
+        payload_start = 4
+        if adaptation_field_control == 0x03:
+            payload_start += 1 + packet[4]
+        payload = packet[payload_start:]
+
+        # video stream ids 0xE0 - 0xEF
+        if len(payload) < 4 or payload[3] & 0xF0 != 0xE0:
+            return
+        pts = parse_pts(payload)
+        if pts is None:
+            return
+        self.video_pid = pid
+        self.add_pts(pts)
+
+    def add_pts(self, pts: int) -> None:
+        """
+        Moves the timeline, frames may come out of order (B-frames) and PTS may wrap around
+        """
+        if self.first_pts is None:
+            self.first_pts = self.last_pts = pts
+            return
+        delta = (pts - self.last_pts) % PTS_WRAP
+        if delta >= PTS_WRAP // 2:
+            delta -= PTS_WRAP
+        self.last_pts = pts
+        self.elapsed += delta
+        if self.elapsed > self.max_elapsed:
+            self.frame_ticks = self.elapsed - self.max_elapsed
+            self.max_elapsed = self.elapsed
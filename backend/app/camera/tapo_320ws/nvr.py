@@ -0,0 +1,292 @@
+"""
+Module for continuous local recording (NVR) - one ffmpeg per camera stream-copies RTSP into fixed-length
+segments on disk, finished segments are indexed in SQLite by camera and time range, so recordings are served
+from local storage instead of the camera SD card
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv, find_dotenv
+from app.camera.tapo_320ws.video_stream import backoff_delay
+from app.database.sqlite_interface import SqliteInterface
+from app.utils.ffmpeg import rtsp_input_args
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.nvr').get_child_logger()
+
+load_dotenv(find_dotenv())
+# comma separated camera names recorded all the time
+NVR_CAMERAS = [name.strip() for name in os.getenv("NVR_CAMERAS", "").split(',') if name.strip()]
+# segment length in seconds, segments are cut at the next keyframe aligned to the wall clock
+NVR_SEGMENT_SECONDS = int(os.getenv("NVR_SEGMENT_SECONDS", "300"))
+# 'mp4' or 'ts' (TS segments stay playable when ffmpeg is killed mid-segment)
+NVR_FORMAT = os.getenv("NVR_FORMAT", "mp4")
+# segments older than this are deleted, 0 = keep forever
+NVR_RETENTION_DAYS = float(os.getenv("NVR_RETENTION_DAYS", "7"))
+
+# get /backend/nvr
+NVR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+NVR_PATH = os.path.join(NVR_PATH, 'nvr')
+
+# segment file names, local time of the first frame
+SEGMENT_TIME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+
+def nvr_ffmpeg_args(rtsp_url: str, output_dir: str, segment_seconds: int = NVR_SEGMENT_SECONDS,
+                    segment_format: str = NVR_FORMAT) -> list:
+    """
+    ffmpeg arguments for recording the camera video track into segments, every finished segment
+    is reported on stdout as a CSV line (file name, start, end)
+    Args:
+        rtsp_url:           RTSP URL of the camera
+        output_dir:         directory of the segments
+        segment_seconds:    segment length
+        segment_format:     'mp4' or 'ts'
+
+    Returns: ffmpeg argv
+    """
+    args = rtsp_input_args(rtsp_url) + [
+        "-map", "0:v:0",
+        "-c:v", "copy",
+        "-an",
+        "-f", "segment",
+        "-segment_time", str(segment_seconds),
+        "-segment_atclocktime", "1",
+        "-segment_format", segment_format,
+        "-reset_timestamps", "1",
+        "-segment_list", "pipe:1",
+        "-segment_list_type", "csv",
+        "-strftime", "1",
+    ]
+    if segment_format == 'mp4':
+        args += ["-segment_format_options", "movflags=+faststart"]
+    return args + [os.path.join(output_dir, f"{SEGMENT_TIME_FORMAT}.{segment_format}")]
+
+
+def parse_segment_line(line: str) -> Optional[Tuple[str, float]]:
+    """
+    Parses segment list CSV line of ffmpeg
+    Args:
+        line: ex. '2024-01-01_12-00-00.mp4,0.000000,300.040000'
+
+    Returns: (file name, duration in seconds) or None if the line is not a segment
+    """
+    parts = line.strip().rsplit(',', 2)
+    if len(parts) != 3:
+        return None
+    try:
+        return parts[0], float(parts[2]) - float(parts[1])
+    except ValueError:
+        return None
+
+
+def segment_start_time(filename: str) -> float:
+    """
+    Returns: start of a segment (unix seconds) from its file name
+    """
+    return datetime.strptime(os.path.splitext(filename)[0], SEGMENT_TIME_FORMAT).timestamp()
+
+
+class RecordingIndex:
+    """
+    SQLite index of recorded segments
+    """
+
+    def __init__(self, path_db: str = None):
+        self.path_db = path_db
+        self.table_ready = False
+
+    def connect(self) -> SqliteInterface:
+        """
+        Returns: database interface, the table is created on first use
+        """
+        interface = SqliteInterface(self.path_db)
+        if not self.table_ready:
+            interface.exec("""
+            CREATE TABLE IF NOT EXISTS nvr_segments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                camera TEXT NOT NULL,
+                start_time REAL NOT NULL,
+                end_time REAL NOT NULL,
+                path TEXT NOT NULL
+            )
+            """)
+            interface.exec("CREATE INDEX IF NOT EXISTS nvr_segments_time ON nvr_segments (camera, start_time)")
+            interface.connection.commit()
+            self.table_ready = True
+        return interface
+
+    @staticmethod
+    def to_dict(row: tuple) -> dict:
+        """
+        Returns: segment row as dict
+        """
+        return {"id": row[0], "camera": row[1], "start_time": row[2], "end_time": row[3], "path": row[4]}
+
+    def add(self, camera: str, start_time: float, end_time: float, path: str) -> int:
+        """
+        Indexes a finished segment
+        Returns: id of the segment
+        """
+        interface = self.connect()
+        interface.cursor.execute(
+            "INSERT INTO nvr_segments (camera, start_time, end_time, path) VALUES (?, ?, ?, ?)",
+            (camera, start_time, end_time, path)
+        )
+        interface.connection.commit()
+        return interface.cursor.lastrowid
+
+    def find(self, camera: str, start_time: float, end_time: float) -> List[dict]:
+        """
+        Segments of a camera overlapping a time range
+        Args:
+            camera:     name of the camera
+            start_time: start of the range (unix seconds)
+            end_time:   end of the range (unix seconds)
+
+        Returns: segments ordered by start time
+        """
+        interface = self.connect()
+        interface.cursor.execute(
+            """
+            SELECT id, camera, start_time, end_time, path
+            FROM nvr_segments
+            WHERE camera = ? AND start_time < ? AND end_time > ?
+            ORDER BY start_time
+            """,
+            (camera, end_time, start_time)
+        )
+        return [self.to_dict(row) for row in interface.fetchall()]
+
+    def get(self, segment_id: int) -> Optional[dict]:
+        """
+        Returns: segment with the id or None
+        """
+        interface = self.connect()
+        interface.cursor.execute(
+            "SELECT id, camera, start_time, end_time, path FROM nvr_segments WHERE id = ?",
+            (segment_id,)
+        )
+        row = interface.cursor.fetchone()
+        return None if row is None else self.to_dict(row)
+
+    def prune(self, before: float) -> List[str]:
+        """
+        Removes segments that ended before a time from the index
+        Returns: paths of the removed segments
+        """
+        interface = self.connect()
+        interface.cursor.execute("SELECT path FROM nvr_segments WHERE end_time < ?", (before,))
+        paths = [row[0] for row in interface.fetchall()]
+        interface.cursor.execute("DELETE FROM nvr_segments WHERE end_time < ?", (before,))
+        interface.connection.commit()
+        return paths
+
+
+class NVRRecorder:
+    """
+    Keeps one ffmpeg recorder per camera running (restarted with backoff when the RTSP session drops)
+    """
+
+    def __init__(self, index: RecordingIndex, path_nvr: str = NVR_PATH,
+                 segment_seconds: int = NVR_SEGMENT_SECONDS, segment_format: str = NVR_FORMAT,
+                 retention_days: float = NVR_RETENTION_DAYS):
+        self.index = index
+        self.path_nvr = path_nvr
+        self.segment_seconds = segment_seconds
+        self.segment_format = segment_format
+        self.retention_days = retention_days
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def start(self, name: str, rtsp_url: str) -> None:
+        """
+        Starts recording of a camera (no-op if it is already recorded)
+        Args:
+            name:       name of the camera
+            rtsp_url:   RTSP URL of the camera
+        """
+        if name in self.tasks and not self.tasks[name].done():
+            return
+        self.tasks[name] = asyncio.get_event_loop().create_task(self.record(name, rtsp_url))
+
+    async def record(self, name: str, rtsp_url: str) -> None:
+        """
+        Runs ffmpeg recorder of a camera and indexes its segments until cancelled
+        """
+        output_dir = os.path.join(self.path_nvr, name)
+        os.makedirs(output_dir, exist_ok=True)
+        attempt = 0
+
+        while True:
+            started = time.monotonic()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *nvr_ffmpeg_args(rtsp_url, output_dir, self.segment_seconds, self.segment_format),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL
+                )
+            except OSError as error:
+                logger.error('Failed to start NVR recorder for %s: %s', name, error)
+                return
+
+            logger.info('Started NVR recorder for %s', name)
+            try:
+                async for line in process.stdout:
+                    self.on_segment(name, output_dir, line.decode('utf-8', errors='replace'))
+            finally:
+                if process.returncode is None:
+                    # SIGTERM -> ffmpeg finalizes the current segment
+                    process.terminate()
+                    try:
+                        await asyncio.wait_for(process.wait(), timeout=5)
+                    except asyncio.TimeoutError:
+                        process.kill()
+                        await process.wait()
+
+            # session that recorded at least one segment resets the backoff
+            attempt = 0 if time.monotonic() - started > self.segment_seconds else attempt + 1
+            delay = backoff_delay(attempt)
+            logger.warning('NVR recorder for %s exited (code %s), restarting in %.1f s',
+                           name, process.returncode, delay)
+            await asyncio.sleep(delay)
+
+    def on_segment(self, name: str, output_dir: str, line: str) -> None:
+        """
+        Indexes a finished segment reported by ffmpeg and applies retention
+        """
+        segment = parse_segment_line(line)
+        if segment is None:
+            return
+        filename, duration = segment
+        filename = os.path.basename(filename)
+        try:
+            start_time = segment_start_time(filename)
+        except ValueError:
+            logger.error('Unexpected NVR segment name: %s', filename)
+            return
+
+        self.index.add(name, start_time, start_time + duration, os.path.join(output_dir, filename))
+        self.apply_retention()
+
+    def apply_retention(self) -> None:
+        """
+        Deletes segments older than retention_days
+        """
+        if self.retention_days <= 0:
+            return
+        for path in self.index.prune(time.time() - self.retention_days * 86400):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+
+    async def stop_all(self) -> None:
+        """
+        Stops all recorders (server shutdown)
+        """
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
@@ -0,0 +1,138 @@
+"""
+Module for the global frame budget - periodically splits a CPU budget among the active capture streams.
+The cost of a frame (decode + encode of every output) is measured by the capture metrics, when all streams
+together would need more than the budget, streams of the lowest priority (then with the fewest viewers)
+are slowed down first, each to STREAM_MIN_FPS before the next one is touched.
+"""
+import asyncio
+import os
+from typing import Dict, List, NamedTuple
+from dotenv import load_dotenv, find_dotenv
+from app.camera.tapo_320ws.metrics import rate
+from app.camera.tapo_320ws.video_stream import RTSPStreamer, StreamOptions
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.scheduler').get_child_logger()
+
+load_dotenv(find_dotenv())
+# CPU cores that decoding and encoding of all streams may use (ex. 2.5), 0 = no budget
+STREAM_CPU_BUDGET = float(os.getenv("STREAM_CPU_BUDGET", "0"))
+# streams are never slowed down below this frame rate
+STREAM_MIN_FPS = float(os.getenv("STREAM_MIN_FPS", "1"))
+# seconds between budget updates
+STREAM_SCHEDULER_INTERVAL = float(os.getenv("STREAM_SCHEDULER_INTERVAL", "2"))
+# comma separated camera priorities, ex. "Gate=2,Garden=0" (higher is slowed down later), others get 1
+STREAM_PRIORITIES = {name.strip(): int(priority) for name, priority in
+                     (item.split('=', 1) for item in os.getenv("STREAM_PRIORITIES", "").split(',') if '=' in item)}
+DEFAULT_PRIORITY = 1
+
+
+class StreamDemand(NamedTuple):
+    """
+    Frame rate a stream would run at without a budget and its cost
+    """
+    rtsp_url: str
+    priority: int
+    viewers: int
+    fps: float          # requested frame rate (measured camera rate if not limited)
+    frame_cost: float   # CPU seconds of one frame (decode + encode of every output)
+
+
+def allocate(demands: List[StreamDemand], budget: float, min_fps: float = STREAM_MIN_FPS) -> Dict[str, float]:
+    """
+    Splits the CPU budget among streams
+    Args:
+        demands:    active streams
+        budget:     CPU seconds per second (cores)
+        min_fps:    lowest frame rate a stream is slowed down to
+
+    Returns: frame rate of every stream (equal to its demand if it is not slowed down)
+    """
+    rates = {demand.rtsp_url: demand.fps for demand in demands}
+    excess = sum(demand.fps * demand.frame_cost for demand in demands) - budget
+
+    for demand in sorted(demands, key=lambda item: (item.priority, item.viewers)):
+        if excess <= 0:
+            break
+        if demand.frame_cost <= 0:
+            continue
+        reducible = (demand.fps - min(min_fps, demand.fps)) * demand.frame_cost
+        cut = min(reducible, excess)
+        rates[demand.rtsp_url] = demand.fps - cut / demand.frame_cost
+        excess -= cut
+
+    return rates
+
+
+class FrameBudgetScheduler:
+    """
+    Applies the frame budget to a streamer as fps limits (see RTSPStreamer.set_fps_limit)
+    """
+
+    def __init__(self, streamer: RTSPStreamer, budget: float = STREAM_CPU_BUDGET, min_fps: float = STREAM_MIN_FPS,
+                 priorities: Dict[str, int] = None):
+        self.streamer = streamer
+        self.budget = budget
+        self.min_fps = min_fps
+        self.priorities = STREAM_PRIORITIES if priorities is None else priorities
+
+    def get_demands(self) -> List[StreamDemand]:
+        """
+        Returns: demands of streams with viewers and enough metrics to estimate their cost
+        """
+        demands = []
+        for rtsp_url, metrics in list(self.streamer.capture_metrics.items()):
+            outputs = self.streamer.active_outputs(rtsp_url)
+            camera_rate = rate(metrics.grab_times)
+            if not outputs or not camera_rate or not metrics.decode_durations:
+                continue
+
+            # requested rate capped by what the clients need, the scheduler's own fps limit is not a demand
+            requested = self.streamer.stream_options.get(rtsp_url, StreamOptions())
+            fps = camera_rate
+            for limit in (requested.target_fps, self.streamer.client_fps_cap(rtsp_url)):
+                if limit is not None and 0 < limit < fps:
+                    fps = limit
+
+            encode_cost = sum(metrics.encode_durations) / len(metrics.encode_durations) \
+                if metrics.encode_durations else 0.0
+            frame_cost = sum(metrics.decode_durations) / len(metrics.decode_durations) + encode_cost * len(outputs)
+
+            demands.append(StreamDemand(
+                rtsp_url,
+                self.priorities.get(self.streamer.camera_names.get(rtsp_url, ''), DEFAULT_PRIORITY),
+                sum(len(self.streamer.clients.get(key, [])) for key, _ in outputs),
+                fps,
+                frame_cost,
+            ))
+        return demands
+
+    def schedule(self) -> Dict[str, float]:
+        """
+        Recomputes the budget and updates fps limits, streams within their demand are not limited
+        Returns: fps limits of slowed down streams
+        """
+        demands = self.get_demands()
+        rates = allocate(demands, self.budget, self.min_fps)
+
+        limits = {}
+        for demand in demands:
+            if rates[demand.rtsp_url] < demand.fps - 1e-6:
+                limits[demand.rtsp_url] = round(rates[demand.rtsp_url], 2)
+
+        for rtsp_url in set(self.streamer.fps_limits) - set(limits):
+            self.streamer.set_fps_limit(rtsp_url, None)
+        for rtsp_url, fps in limits.items():
+            if self.streamer.fps_limits.get(rtsp_url) != fps:
+                logger.info('Frame budget: %s limited to %.2f fps', self.streamer.camera_names.get(rtsp_url), fps)
+                self.streamer.set_fps_limit(rtsp_url, fps)
+
+        return limits
+
+    async def run(self, interval: float = STREAM_SCHEDULER_INTERVAL):
+        """
+        Updates the budget every interval seconds until cancelled
+        """
+        while True:
+            self.schedule()
+            await asyncio.sleep(interval)
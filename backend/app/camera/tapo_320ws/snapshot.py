@@ -0,0 +1,137 @@
+"""
+Module for camera snapshots - single JPEG frames taken from an already open stream session or grabbed
+by a short-lived capture and cached with a TTL
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Optional, Tuple
+import cv2
+from dotenv import load_dotenv, find_dotenv
+from app.camera.tapo_320ws.encoders import get_encoder
+from app.camera.tapo_320ws.video_stream import RTSPStreamer, Frame, TRANSPORT_BINARY, resize_to_width
+from app.utils.logger import Logger
+
+logger = Logger('server_logger.snapshot').get_child_logger()
+
+load_dotenv(find_dotenv())
+# seconds a captured snapshot is served from cache
+SNAPSHOT_TTL = float(os.getenv("SNAPSHOT_TTL", "10"))
+# seconds an open stream session without clients (warm or idle) has to deliver a frame before a capture is used
+SNAPSHOT_SESSION_TIMEOUT = float(os.getenv("SNAPSHOT_SESSION_TIMEOUT", "2"))
+# frames read before giving up on a decodable one (first frames before a keyframe may fail)
+SNAPSHOT_MAX_READS = 50
+
+
+def capture_snapshot(rtsp_url: str, width: Optional[int] = None) -> Optional[Frame]:
+    """
+    Opens the RTSP stream, reads the first decodable frame and encodes it (blocking)
+    Args:
+        rtsp_url:   RTSP URL of the camera stream
+        width:      output width (None = native)
+
+    Returns: encoded frame or None if the stream can't be read
+    """
+    cap = cv2.VideoCapture(rtsp_url)
+    try:
+        if not cap.isOpened():
+            logger.info('Failed to open RTSP stream for snapshot: %s', rtsp_url)
+            return None
+
+        for _ in range(SNAPSHOT_MAX_READS):
+            success, frame = cap.read()
+            if success:
+                return Frame(get_encoder()(resize_to_width(frame, width)), 0, time.time())
+        return None
+
+    finally:
+        cap.release()
+
+
+class FrameWaiter:
+    """
+    Client of a camera stream that waits for the first frame of its output
+    """
+
+    def __init__(self):
+        self.received = asyncio.Event()
+
+    async def send_bytes(self, _: bytes) -> None:
+        """
+        Marks the frame as received
+        """
+        self.received.set()
+
+
+async def borrow_session_frame(streamer: RTSPStreamer, rtsp_url: str, quality: str, camera_name: str = '',
+                               timeout: float = SNAPSHOT_SESSION_TIMEOUT) -> Optional[Frame]:
+    """
+    Gets a frame from an open stream session that has no clients (warm or within its idle grace period).
+    Such sessions only grab without decoding, a client is attached until its output delivers a frame
+    -> no second RTSP session is opened to the camera.
+    Args:
+        streamer:       streamer owning the session
+        rtsp_url:       RTSP URL of the camera stream
+        quality:        quality tier of the frame
+        camera_name:    name of the camera
+        timeout:        seconds to wait for the frame
+
+    Returns: encoded frame or None if the session is not open or delivered nothing in time
+    """
+    if rtsp_url not in streamer.streams:
+        return None
+
+    waiter = FrameWaiter()
+    key = streamer.add_client(rtsp_url, waiter, TRANSPORT_BINARY, camera_name, quality)
+    try:
+        await asyncio.wait_for(waiter.received.wait(), timeout)
+        return streamer.get_latest_frame(rtsp_url, quality)
+    except asyncio.TimeoutError:
+        logger.info('Open stream session %s delivered no frame for snapshot', key)
+        return None
+    finally:
+        streamer.remove_client(key, waiter)
+
+
+class SnapshotCache:
+    """
+    TTL cache of captured snapshots, concurrent misses for the same stream share one capture
+    """
+
+    def __init__(self, ttl: float = SNAPSHOT_TTL):
+        self.ttl = ttl
+        self.entries: Dict[str, Tuple[float, Frame]] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    def get_cached(self, key: str) -> Optional[Frame]:
+        """
+        Returns: cached snapshot if not expired
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    async def get(self, key: str, rtsp_url: str, width: Optional[int] = None) -> Optional[Frame]:
+        """
+        Returns cached snapshot or captures a new one
+        Args:
+            key:        cache key (stream key of the tier)
+            rtsp_url:   RTSP URL of the camera stream
+            width:      output width (None = native)
+        """
+        frame = self.get_cached(key)
+        if frame is not None:
+            return frame
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # another request may have captured it meanwhile
+            frame = self.get_cached(key)
+            if frame is not None:
+                return frame
+
+            frame = await asyncio.to_thread(capture_snapshot, rtsp_url, width)
+            if frame is not None:
+                self.entries[key] = (time.monotonic() + self.ttl, frame)
+            return frame
@@ -36,6 +36,21 @@ def get_auth_by_name(name: str) -> Tuple[str, str, str, str, str]:
         raise type_error
 
 
+def build_stream_url(ip: str, camera_username: str, camera_password: str, quality: str = 'high') -> str:
+    """
+    Builds RTSP URL of a camera stream
+    Args:
+        ip:                 ip of the camera
+        camera_username:    camera account username
+        camera_password:    camera account password
+        quality:            'high' -> full resolution main stream (stream1), anything else -> substream (stream2)
+
+    Returns: RTSP URL
+    """
+    stream_path = 'stream1' if quality == 'high' else 'stream2'
+    return f"rtsp://{camera_username}:{camera_password}@{ip}:554/{stream_path}"
+
+
 def list_tapo_320ws_camera_names() -> List:
     """
     Returns: list of dicts containing camera info
@@ -3,76 +3,747 @@ Module for video streaming function using openCV2
 """
 import asyncio
 import base64
+import json
+import os
+import random
+import struct
 import threading
-from typing import Dict, List
+import time
+import zlib
+from collections import deque
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Union
 import cv2
+import numpy as np
+from dotenv import load_dotenv, find_dotenv
 from fastapi.websockets import WebSocketDisconnect
 from websockets.exceptions import WebSocketException, ConnectionClosed
+from app.camera.tapo_320ws.encoders import EncoderOptions, get_encoder
+from app.camera.tapo_320ws.mjpeg import pack_mjpeg_part
+from app.camera.tapo_320ws.metrics import CaptureMetrics, summarize, redact_url, METRICS_WINDOW
 from app.utils.logger import Logger
 
 logger = Logger('server_logger.video_stream').get_child_logger()
 
+load_dotenv(find_dotenv())
+# default frames per second sent to clients, 0 = native camera rate
+STREAM_TARGET_FPS = float(os.getenv("STREAM_TARGET_FPS", "0"))
+# frames whose mean absolute difference (0-255) from the last encoded frame is below this are not encoded, 0 = off
+STREAM_CHANGE_THRESHOLD = float(os.getenv("STREAM_CHANGE_THRESHOLD", "0"))
+# resolution of the thumbnail used by the change detector
+CHANGE_DETECTOR_SIZE = (32, 18)
+# seconds the RTSP session stays open after the last client left (page reloads / camera switching reuse it)
+STREAM_IDLE_GRACE = float(os.getenv("STREAM_IDLE_GRACE", "15"))
+# comma separated camera names whose RTSP session is opened on startup and never closed
+STREAM_WARM_CAMERAS = [name.strip() for name in os.getenv("STREAM_WARM_CAMERAS", "").split(',') if name.strip()]
+# delay before the first reconnect of a dropped RTSP session, doubled with every failed attempt up to the max
+STREAM_RECONNECT_MIN_DELAY = float(os.getenv("STREAM_RECONNECT_MIN_DELAY", "1"))
+STREAM_RECONNECT_MAX_DELAY = float(os.getenv("STREAM_RECONNECT_MAX_DELAY", "30"))
+# seconds between heartbeat pings of clients that negotiated them (?heartbeat=true)
+STREAM_PING_INTERVAL = float(os.getenv("STREAM_PING_INTERVAL", "10"))
+# heartbeat client that sent nothing (pong) for this many seconds is removed
+STREAM_PING_TIMEOUT = float(os.getenv("STREAM_PING_TIMEOUT", "30"))
+# client whose frame send takes longer than this is removed (half-open connection with full buffers)
+STREAM_SEND_TIMEOUT = float(os.getenv("STREAM_SEND_TIMEOUT", "10"))
+# named regions of interest requested as ?roi=name, ex. "gate=0.6,0.1,0.3,0.3;driveway=0,0.5,0.5,0.5"
+STREAM_REGIONS = dict(item.split('=', 1) for item in os.getenv("STREAM_REGIONS", "").split(';') if '=' in item)
+
+# transports negotiated by the client on /tapo-320ws/stream/ws/{name}
+TRANSPORT_TEXT = 'text'
+TRANSPORT_BINARY = 'binary'
+TRANSPORTS = (TRANSPORT_TEXT, TRANSPORT_BINARY)
+# multipart part for the HTTP MJPEG endpoint (client is an MJPEGSink instead of a WebSocket)
+TRANSPORT_MJPEG = 'mjpeg'
+
+# binary frame header (network byte order, 17 bytes):
+# version (u8) | sequence number (u32) | capture timestamp in ms (u64) | camera id (u32)
+FRAME_HEADER = struct.Struct('!BIQI')
+FRAME_HEADER_VERSION = 1
+
+# quality tiers requested by clients, high = main stream, low/thumb = camera substream
+QUALITY_HIGH = 'high'
+QUALITY_LOW = 'low'
+QUALITY_THUMB = 'thumb'
+# server-side output width of each tier (None = native resolution of the camera stream),
+# ordered from the highest resolution to the lowest
+QUALITY_WIDTHS: Dict[str, Optional[int]] = {
+    QUALITY_HIGH: None,
+    QUALITY_LOW: None,
+    QUALITY_THUMB: 320,
+}
+
+# frames buffered between the capture thread and the fan-out task (per stream)
+CAPTURE_QUEUE_SIZE = 4
+# frames buffered for each client, the oldest frame is dropped when a client falls behind
+CLIENT_QUEUE_SIZE = 2
+
+
+class Frame(NamedTuple):
+    """
+    Encoded JPEG frame together with its capture metadata
+    """
+    data: bytes
+    sequence: int
+    timestamp: float
+
+
+def get_camera_id(name: str) -> int:
+    """
+    Stable numeric camera id used in the binary frame header
+    Args:
+        name: name of the camera
+
+    Returns: CRC32 of the camera name
+    """
+    return zlib.crc32(name.encode('utf-8'))
+
+
+def pack_frame(frame: Frame, camera_id: int) -> bytes:
+    """
+    Prefixes JPEG bytes with the binary frame header
+    Args:
+        frame:      encoded frame
+        camera_id:  id of the camera (see get_camera_id)
+
+    Returns: header + JPEG bytes
+    """
+    header = FRAME_HEADER.pack(FRAME_HEADER_VERSION, frame.sequence & 0xFFFFFFFF,
+                               int(frame.timestamp * 1000), camera_id)
+    return header + frame.data
+
+
+class StreamOptions(NamedTuple):
+    """
+    Per stream capture options
+    """
+    target_fps: float = STREAM_TARGET_FPS
+    change_threshold: float = STREAM_CHANGE_THRESHOLD
+    encoder: EncoderOptions = EncoderOptions()
+
+
+def frame_signature(image) -> np.ndarray:
+    """
+    Tiny grayscale thumbnail of a frame used for cheap change detection
+    """
+    small = cv2.resize(image, CHANGE_DETECTOR_SIZE, interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return small
+
+
+def frame_changed(previous: Optional[np.ndarray], current: np.ndarray, threshold: float) -> bool:
+    """
+    Compares two frame signatures
+    Args:
+        previous:   signature of the last encoded frame (None = nothing encoded yet)
+        current:    signature of the new frame
+        threshold:  minimal mean absolute difference (0-255)
+
+    Returns: True if the frame should be encoded
+    """
+    if previous is None or threshold <= 0:
+        return True
+    return float(cv2.absdiff(previous, current).mean()) >= threshold
+
+
+class Region(NamedTuple):
+    """
+    Region of interest - crop rectangle as fractions of the frame (independent of the stream resolution)
+    and width of the cropped output (None = native size of the crop)
+    """
+    x: float
+    y: float
+    width: float
+    height: float
+    output_width: Optional[int] = None
+
+    @property
+    def label(self) -> str:
+        """
+        Returns: canonical text of the region, equal regions share one output
+        """
+        label = f"{self.x:g},{self.y:g},{self.width:g},{self.height:g}"
+        return label if self.output_width is None else f"{label}@{self.output_width}"
+
+
+# server-side transformation of an output - width to downscale to (None = native) or a region to crop
+OutputShape = Union[int, Region, None]
+
+
+def parse_region(spec: str, output_width: Optional[int] = None) -> Region:
+    """
+    Parses region of interest requested by a client
+    Args:
+        spec:           name from STREAM_REGIONS or 'x,y,width,height' as fractions of the frame
+        output_width:   width of the cropped output (None = native size of the crop)
+
+    Returns: region
+
+    Raises: ValueError if the region is unknown or outside the frame
+    """
+    values = [float(value) for value in STREAM_REGIONS.get(spec, spec).split(',')]
+    if len(values) != 4:
+        raise ValueError(f"Region needs x,y,width,height: {spec}")
+    x, y, width, height = values
+    if not (0 <= x < 1 and 0 <= y < 1 and 0 < width <= 1 - x + 1e-9 and 0 < height <= 1 - y + 1e-9):
+        raise ValueError(f"Region outside the frame: {spec}")
+    return Region(x, y, width, height, output_width)
+
+
+def stream_key(rtsp_url: str, quality: str = QUALITY_HIGH, region: Optional[Region] = None) -> str:
+    """
+    Key of a stream session - one per (camera stream, quality tier or region)
+    Args:
+        rtsp_url:   RTSP URL of the camera stream
+        quality:    quality tier
+        region:     region of interest cropped from the stream
+
+    Returns: rtsp_url for native resolution tiers, rtsp_url#quality for downscaled tiers,
+             rtsp_url#roi:region for regions
+    """
+    if region is not None:
+        return f"{rtsp_url}#roi:{region.label}"
+    if QUALITY_WIDTHS.get(quality) is None:
+        return rtsp_url
+    return f"{rtsp_url}#{quality}"
+
+
+def resize_to_width(image, width: Optional[int]):
+    """
+    Downscales image to the given width keeping aspect ratio (never upscales)
+    Args:
+        image:  decoded frame
+        width:  target width or None
+
+    Returns: resized (or original) image
+    """
+    if width is None or image.shape[1] <= width:
+        return image
+    height = round(image.shape[0] * width / image.shape[1])
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def shape_frame(image, shape: OutputShape):
+    """
+    Applies output shape to a decoded frame
+    Args:
+        image:  decoded frame
+        shape:  width to downscale to, region to crop (and downscale) or None
+
+    Returns: image to encode (a view of the frame for crops)
+    """
+    if not isinstance(shape, Region):
+        return resize_to_width(image, shape)
+    frame_height, frame_width = image.shape[:2]
+    left, top = round(shape.x * frame_width), round(shape.y * frame_height)
+    right = max(left + 1, min(frame_width, round((shape.x + shape.width) * frame_width)))
+    bottom = max(top + 1, min(frame_height, round((shape.y + shape.height) * frame_height)))
+    return resize_to_width(image[top:bottom, left:right], shape.output_width)
+
+
+def put_latest(queue: asyncio.Queue, item) -> bool:
+    """
+    Puts item into a bounded queue, dropping the oldest item if the queue is full
+    Args:
+        queue:  bounded asyncio queue
+        item:   item to put
+
+    Returns: True if an item was dropped
+    """
+    dropped = queue.full()
+    if dropped:
+        queue.get_nowait()
+    queue.put_nowait(item)
+    return dropped
+
+
+def backoff_delay(attempt: int, min_delay: float = STREAM_RECONNECT_MIN_DELAY,
+                  max_delay: float = STREAM_RECONNECT_MAX_DELAY) -> float:
+    """
+    Capped exponential backoff with jitter (spreads reconnects of cameras that dropped at once)
+    Args:
+        attempt:    number of failed attempts in a row (0 = first reconnect)
+        min_delay:  delay of the first attempt
+        max_delay:  maximal delay
+
+    Returns: seconds to wait, between half and full backoff
+    """
+    delay = min(max_delay, min_delay * 2 ** min(attempt, 32))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def run_capture(rtsp_url: str, control, emit: Callable[[str, Frame], None],
+                on_open: Optional[Callable] = None) -> bool:
+    """
+    Opens the RTSP URL and captures it (see capture_frames), reopens it with backoff when
+    the session drops or can't be opened, as long as control.reconnect_delay allows it (blocking).
+    Clients stay attached to their outputs meanwhile.
+    Args:
+        rtsp_url:   RTSP URL of the camera stream
+        control:    see capture_frames, also provides reconnect_delay
+        emit:       called with (output key, frame) for every encoded frame
+        on_open:    called with every opened cv2.VideoCapture
+
+    Returns: True if the capture was closed because nobody watched it, False if it gave up reconnecting
+    """
+    attempt = 0
+    while True:
+        opened_at = time.monotonic()
+        cap = cv2.VideoCapture(rtsp_url)
+        try:
+            if cap.isOpened():
+                if on_open is not None:
+                    on_open(cap)
+                idle, frames = capture_frames(cap, rtsp_url, control, emit, opened_at)
+                if idle:
+                    return True
+                # session delivered frames -> it was a drop, not a failing camera
+                if frames:
+                    attempt = 0
+                logger.info('RTSP stream dropped: %s', rtsp_url)
+            else:
+                logger.info('Failed to open RTSP stream: %s', rtsp_url)
+        finally:
+            cap.release()
+
+        delay = control.reconnect_delay(rtsp_url, attempt)
+        if delay is None:
+            return False
+        logger.info('Reconnecting RTSP stream %s in %.1f s (attempt %s)', rtsp_url, delay, attempt + 1)
+        time.sleep(delay)
+        attempt += 1
+
+
+def capture_frames(cap, rtsp_url: str, control, emit: Callable[[str, Frame], None],
+                   opened_at: float) -> Tuple[bool, int]:
+    """
+    Reads an opened capture and encodes each frame once per active output (blocking, shared by
+    capture threads and capture worker processes).
+
+    Frames above the target FPS are only grabbed (not decoded), frames nearly identical
+    to the last encoded one are decoded but not encoded (see StreamOptions).
+    Args:
+        cap:        opened cv2.VideoCapture
+        rtsp_url:   RTSP URL of the capture
+        control:    provides active_outputs, get_stream_options, keep_open, set_open_latency
+                    and get_capture_metrics (see RTSPStreamer)
+        emit:       called with (output key, frame) for every encoded frame
+        opened_at:  time.monotonic() before the capture was opened
+
+    Returns: (True if the capture was closed because nobody watched it / False if the stream ended,
+              number of grabbed frames)
+    """
+    grabbed = 0
+    sequence = 0
+    next_frame_time = 0.0
+    last_signature = None
+    # outputs that got a frame since they became active (static scenes still need one frame each)
+    served_outputs = set()
+    idle_since = None
+    metrics = control.get_capture_metrics(rtsp_url)
+
+    while True:
+        # no clients -> keep the session open (grab only) for the grace period or while warm
+        outputs = control.active_outputs(rtsp_url)
+        served_outputs.intersection_update(key for key, _ in outputs)
+        if outputs:
+            idle_since = None
+        elif idle_since is None:
+            idle_since = time.monotonic()
+        elif not control.keep_open(rtsp_url, time.monotonic() - idle_since):
+            return True, grabbed
+
+        # grab keeps the RTSP session flowing without decoding the frame
+        if not cap.grab():
+            return False, grabbed
+        grabbed += 1
+        metrics.record_grab()
+        if grabbed == 1:
+            control.set_open_latency(rtsp_url, time.monotonic() - opened_at)
+        if not outputs:
+            continue
+
+        options = control.get_stream_options(rtsp_url)
+        now = time.monotonic()
+        if options.target_fps > 0:
+            if now < next_frame_time:
+                continue
+            next_frame_time = max(next_frame_time + 1 / options.target_fps, now)
+
+        decode_start = time.perf_counter()
+        success, frame = cap.retrieve()
+        if not success:
+            return False, grabbed
+        metrics.record_decode(time.perf_counter() - decode_start)
+        timestamp = time.time()
+
+        # unchanged scene -> only outputs without any frame yet get one
+        if options.change_threshold > 0:
+            signature = frame_signature(frame)
+            if not frame_changed(last_signature, signature, options.change_threshold):
+                outputs = [output for output in outputs if output[0] not in served_outputs]
+                if not outputs:
+                    continue
+            else:
+                last_signature = signature
+        sequence += 1
+
+        for key, shape in outputs:
+            served_outputs.add(key)
+            encode_start = time.perf_counter()
+            data = get_encoder(options.encoder)(shape_frame(frame, shape))
+            metrics.record_encode(time.perf_counter() - encode_start, len(data))
+            emit(key, Frame(data, sequence, timestamp))
+
+
+class StreamClient:
+    """
+    WebSocket client of a stream together with its negotiated transport.
+    Holds a small ring of pending payloads (latest frame wins) drained by its own sender task,
+    so a slow client only skips frames instead of stalling the other viewers.
+    """
+
+    def __init__(self, websocket, transport: str = TRANSPORT_TEXT, camera_name: str = ''):
+        self.websocket = websocket
+        self.transport = transport
+        self.camera_id = get_camera_id(camera_name)
+        self.preamble = deque()
+        self.pending = deque(maxlen=CLIENT_QUEUE_SIZE)
+        self.pending_event = asyncio.Event()
+        self.dropped_frames = 0
+        self.sent_frames = 0
+        self.send_durations = deque(maxlen=METRICS_WINDOW)
+        self.task: Optional[asyncio.Task] = None
+
+    def offer(self, payload) -> None:
+        """
+        Queues payload for sending, drops the oldest pending payload if the ring is full
+        """
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped_frames += 1
+        self.pending.append(payload)
+        self.pending_event.set()
+
+    def offer_preamble(self, payload) -> None:
+        """
+        Queues payload that must be delivered before any frame (never dropped), ex. init segments
+        """
+        self.preamble.append(payload)
+        self.pending_event.set()
+
+    async def next_payload(self):
+        """
+        Waits for the next pending payload
+        """
+        while not self.preamble and not self.pending:
+            self.pending_event.clear()
+            await self.pending_event.wait()
+        if self.preamble:
+            return self.preamble.popleft()
+        return self.pending.popleft()
+
+    async def send(self, payload) -> None:
+        """
+        Sends already encoded payload, bytes are sent as binary messages and str as text messages
+        """
+        send_start = time.perf_counter()
+        if isinstance(payload, bytes):
+            await self.websocket.send_bytes(payload)
+        else:
+            await self.websocket.send_text(payload)
+        self.sent_frames += 1
+        self.send_durations.append(time.perf_counter() - send_start)
+
+    def get_metrics(self) -> dict:
+        """
+        Returns: JSON serializable send statistics
+        """
+        return {
+            "transport": self.transport,
+            "sentFrames": self.sent_frames,
+            "droppedFrames": self.dropped_frames,
+            "pendingFrames": len(self.pending),
+            "sendMs": summarize(self.send_durations, 1000),
+        }
+
+
 class RTSPStreamer:
     """
     Class that converts RTSP stream into image stream readable by a browser
+
+    Each RTSP URL is decoded once by a capture thread (self.streams), every quality tier and region
+    of interest of it is an output (self.outputs) that is encoded once per frame and shared by all its clients.
+    Clients, queues and outputs are keyed by stream_key(rtsp_url, quality, region).
+
+    Without clients the capture only grabs (no decoding) and stays open for idle_grace seconds,
+    warm streams (see keep_warm) stay open until released.
     """
 
-    def __init__(self):
+    def __init__(self, idle_grace: float = STREAM_IDLE_GRACE, reconnect_min_delay: float = STREAM_RECONNECT_MIN_DELAY,
+                 reconnect_max_delay: float = STREAM_RECONNECT_MAX_DELAY):
         self.streams: Dict[str, cv2.VideoCapture] = {}
         self.clients: Dict[str, List] = {}
         self.queues: Dict[str, asyncio.Queue] = {}
+        self.outputs: Dict[str, Tuple[str, OutputShape]] = {}
+        self.stream_clients: Dict[object, StreamClient] = {}
+        self.stream_options: Dict[str, StreamOptions] = {}
+        # frame rate caps set by the frame budget scheduler (see scheduler module)
+        self.fps_limits: Dict[str, float] = {}
+        # frames per second clients need at most (ex. mosaic tiles), see client_fps_cap
+        self.client_fps: Dict[object, float] = {}
+        self.latest_frames: Dict[str, Frame] = {}
+        self.idle_grace = idle_grace
+        self.warm_streams: Set[str] = set()
+        # seconds from opening the RTSP URL to its first frame (last open)
+        self.open_latencies: Dict[str, float] = {}
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        # reconnect attempts of each RTSP URL since server start
+        self.reconnects: Dict[str, int] = {}
+        self.capture_metrics: Dict[str, CaptureMetrics] = {}
+        # frames dropped from output queues because the fan-out fell behind the capture
+        self.queue_drops: Dict[str, int] = {}
+        self.camera_names: Dict[str, str] = {}
+        self.ping_interval = STREAM_PING_INTERVAL
+        self.ping_timeout = STREAM_PING_TIMEOUT
+        self.send_timeout = STREAM_SEND_TIMEOUT
 
-    def add_client(self, rtsp_url: str, websocket):
-        """Adds a WebSocket client to the list and starts stream if needed."""
-        if rtsp_url not in self.clients:
-            self.clients[rtsp_url] = []
-        self.clients[rtsp_url].append(websocket)
+    def keep_warm(self, rtsp_url: str):
+        """
+        Keeps the RTSP session of the URL open even without clients, opens it if needed
+        """
+        self.warm_streams.add(rtsp_url)
+        if rtsp_url not in self.streams:
+            self.start_stream(rtsp_url)
 
-        logger.info("Added client to stream %s. Total clients: %s", rtsp_url, len(self.clients[rtsp_url]))
+    def release_warm(self, rtsp_url: str):
+        """
+        Lets the RTSP session of the URL close after the idle grace period again
+        """
+        self.warm_streams.discard(rtsp_url)
+
+    def get_stream_options(self, rtsp_url: str) -> StreamOptions:
+        """
+        Returns: capture options of the RTSP URL (defaults from .env) with the frame rate capped by its fps limit
+                 and by the rate its clients need (see client_fps_cap)
+        """
+        options = self.stream_options.get(rtsp_url, StreamOptions())
+        for limit in (self.fps_limits.get(rtsp_url), self.client_fps_cap(rtsp_url)):
+            if limit is not None and (options.target_fps <= 0 or options.target_fps > limit):
+                options = options._replace(target_fps=limit)
+        return options
+
+    def client_fps_cap(self, rtsp_url: str) -> Optional[float]:
+        """
+        Returns: highest frame rate needed by the clients of the RTSP URL if all of them are capped
+                 (see add_client max_fps), None if any client takes the full rate or there are no clients
+        """
+        caps = [self.client_fps.get(client) for key, _ in self.active_outputs(rtsp_url)
+                for client in list(self.clients.get(key, []))]
+        if not caps or None in caps:
+            return None
+        return max(caps)
+
+    def set_fps_limit(self, rtsp_url: str, fps: Optional[float]):
+        """
+        Caps the encoded frame rate of the RTSP URL without changing its requested options
+        Args:
+            rtsp_url:   RTSP URL of the camera stream
+            fps:        maximal frames per second, None = no cap
+        """
+        if fps is None:
+            self.fps_limits.pop(rtsp_url, None)
+        else:
+            self.fps_limits[rtsp_url] = fps
+
+    def set_stream_options(self, rtsp_url: str, target_fps: Optional[float] = None,
+                           change_threshold: Optional[float] = None,
+                           encoder: Optional[EncoderOptions] = None) -> StreamOptions:
+        """
+        Changes capture options of the RTSP URL, applied from the next frame (also while streaming)
+        Args:
+            rtsp_url:           RTSP URL of the camera stream
+            target_fps:         frames per second to encode, 0 = native camera rate
+            change_threshold:   skip frames nearly identical to the last encoded one, 0 = off
+            encoder:            JPEG encoder backend, quality and chroma subsampling
+
+        Returns: new options (as requested, see set_fps_limit)
+        """
+        options = self.stream_options.get(rtsp_url, StreamOptions())
+        if target_fps is not None:
+            options = options._replace(target_fps=target_fps)
+        if change_threshold is not None:
+            options = options._replace(change_threshold=change_threshold)
+        if encoder is not None:
+            # fails early for unknown backend / subsampling
+            get_encoder(encoder)
+            options = options._replace(encoder=encoder)
+        self.stream_options[rtsp_url] = options
+        return options
+
+    def get_latest_frame(self, rtsp_url: str, quality: str = QUALITY_HIGH,
+                         region: Optional[Region] = None) -> Optional[Frame]:
+        """
+        Returns: last frame of a running output or None
+        """
+        return self.latest_frames.get(stream_key(rtsp_url, quality, region))
+
+    def add_client(self, rtsp_url: str, websocket, transport: str = TRANSPORT_TEXT, camera_name: str = '',
+                   quality: str = QUALITY_HIGH, region: Optional[Region] = None,
+                   max_fps: Optional[float] = None) -> str:
+        """
+        Adds a WebSocket client to the list and starts stream if needed.
+        Clients of the same region of interest share one cropped output (region overrides the quality tier width).
+        A client with max_fps caps the capture to that rate while all clients of the RTSP URL are capped.
+        Returns: stream key of the client (used for remove_client)
+        """
+        key = stream_key(rtsp_url, quality, region)
+        self.camera_names[rtsp_url] = camera_name
+        if max_fps is not None:
+            self.client_fps[websocket] = max_fps
+        if key not in self.clients:
+            self.clients[key] = []
+        self.clients[key].append(websocket)
+
+        stream_client = StreamClient(websocket, transport, camera_name)
+        stream_client.task = asyncio.get_event_loop().create_task(self.client_sender(key, stream_client))
+        self.stream_clients[websocket] = stream_client
+
+        # late joiners start with the last frame (static scenes may not produce a new one for a while)
+        if key in self.latest_frames:
+            stream_client.offer(self.build_payload(self.latest_frames[key], stream_client))
+
+        logger.info("Added client to stream %s. Total clients: %s", key, len(self.clients[key]))
+
+        # if the tier is not encoded yet, start its output
+        if key not in self.outputs:
+            self.outputs[key] = (rtsp_url, QUALITY_WIDTHS.get(quality) if region is None else region)
+            self.start_output(key)
 
         # if not already streaming, start
         if rtsp_url not in self.streams:
             self.start_stream(rtsp_url)
 
+        return key
+
     def remove_client(self, rtsp_url: str, websocket):
-        """Removes a client from the list and cleans up if no active clients remain."""
+        """
+        Removes a client from the list and cleans up if no active clients remain.
+        rtsp_url is the stream key returned by add_client
+        """
         if rtsp_url in self.clients:
             if websocket in self.clients[rtsp_url]:
                 self.clients[rtsp_url].remove(websocket)
+                self.stop_client(websocket)
                 logger.info("Removed client from stream %s; remaining clients: %s", rtsp_url, len(self.clients[rtsp_url]))
             if len(self.clients[rtsp_url]) == 0:
-                # no clients -> remove references
+                # no clients -> remove references, the idle capture stops decoding so the last frame gets stale
                 del self.clients[rtsp_url]
+                self.latest_frames.pop(rtsp_url, None)
 
     def remove_all_clients(self, rtsp_url: str):
         """Removes all clients"""
         if rtsp_url in self.clients:
+            for websocket in self.clients[rtsp_url]:
+                self.stop_client(websocket)
             del self.clients[rtsp_url]
             logger.info("Removed all clients from stream %s", rtsp_url)
 
-    async def send_to_clients(self, rtsp_url: str, frame_bytes: bytes):
+    def stop_client(self, websocket):
+        """Forgets client state and cancels its sender task."""
+        self.client_fps.pop(websocket, None)
+        stream_client = self.stream_clients.pop(websocket, None)
+        if stream_client is not None and stream_client.task is not None \
+                and stream_client.task is not asyncio.current_task():
+            stream_client.task.cancel()
+
+    async def client_sender(self, rtsp_url: str, stream_client: StreamClient):
         """
-        Encodes stream (frame) data and sends it to clients.
-        if sending fails, remove the faulty client.
+        Sends payloads queued for one client, if sending fails, remove the faulty client.
         """
-        frame_base64 = base64.b64encode(frame_bytes).decode('utf-8')
-        data = f"data:image/jpeg;base64,{frame_base64}"
-
-        bad_clients = []
-        for client in self.clients.get(rtsp_url, []):
+        while True:
+            payload = await stream_client.next_payload()
             try:
-                await client.send_text(data)
-            except (WebSocketException, ConnectionClosed, RuntimeError) as error:
+                await asyncio.wait_for(stream_client.send(payload), self.send_timeout)
+            except asyncio.TimeoutError:
+                logger.error('Sending frame to client timed out after %s s (half-open connection)', self.send_timeout)
+                self.remove_client(rtsp_url, stream_client.websocket)
+                return
+            except (WebSocketException, WebSocketDisconnect, ConnectionClosed, RuntimeError) as error:
                 logger.error('Error sending frame to client (likely disconnected): %s', error)
-                bad_clients.append(client)
+                self.remove_client(rtsp_url, stream_client.websocket)
+                return
+
+    async def watch_client(self, rtsp_url: str, websocket, heartbeat: bool = False):
+        """
+        Receives messages of a WebSocket client until it disconnects, then removes it.
+        With heartbeat the client gets a JSON text ping ({"type": "ping"}) every ping_interval seconds
+        of silence and has to send something (ex. {"type": "pong"}) within ping_timeout seconds.
+        Args:
+            rtsp_url:   stream key returned by add_client
+            websocket:  WebSocket of the client
+            heartbeat:  client negotiated pings
+
+        Raises: asyncio.TimeoutError if a heartbeat client stayed silent, WebSocketDisconnect when it disconnects
+        """
+        loop = asyncio.get_event_loop()
+        last_seen = loop.time()
+        try:
+            while True:
+                if not heartbeat:
+                    await websocket.receive_text()
+                    continue
+
+                silence = loop.time() - last_seen
+                if silence >= self.ping_timeout:
+                    raise asyncio.TimeoutError
+                try:
+                    await asyncio.wait_for(websocket.receive_text(),
+                                           min(self.ping_interval, self.ping_timeout - silence))
+                    last_seen = loop.time()
+                except asyncio.TimeoutError:
+                    # ping goes through the sender task -> never interleaves with a frame send
+                    stream_client = self.stream_clients.get(websocket)
+                    if stream_client is not None:
+                        ping = {"type": "ping", "timestamp": round(time.time() * 1000)}
+                        stream_client.offer_preamble(json.dumps(ping))
+        finally:
+            self.remove_client(rtsp_url, websocket)
+
+    async def send_to_clients(self, rtsp_url: str, frame: Frame):
+        """
+        Encodes stream (frame) data and queues it for each client of the stream.
+        Each payload variant (base64 text / binary per camera) is built at most once per frame,
+        sending itself is done by per-client sender tasks (see client_sender).
+        """
+        payloads = {}
+        self.latest_frames[rtsp_url] = frame
+
+        for client in self.clients.get(rtsp_url, []):
+            stream_client = self.stream_clients.get(client)
+            if stream_client is None:
+                continue
+            payload_key = (stream_client.transport, stream_client.camera_id)
+            if payload_key not in payloads:
+                payloads[payload_key] = self.build_payload(frame, stream_client)
+            stream_client.offer(payloads[payload_key])
 
-        # remove any clients that failed
-        for bad_client in bad_clients:
-            self.remove_client(rtsp_url, bad_client)
+    @staticmethod
+    def build_payload(frame: Frame, stream_client: StreamClient):
+        """
+        Encodes frame for the client's transport
+        Returns: bytes (binary transport), multipart part (MJPEG) or base64 data URL (text transport)
+        """
+        if stream_client.transport == TRANSPORT_BINARY:
+            return pack_frame(frame, stream_client.camera_id)
+        if stream_client.transport == TRANSPORT_MJPEG:
+            return pack_mjpeg_part(frame.data)
+        frame_base64 = base64.b64encode(frame.data).decode('utf-8')
+        return f"data:image/jpeg;base64,{frame_base64}"
 
     async def process_stream(self, rtsp_url: str):
         """
         Async get frames from self.queues and send them to clients
+        rtsp_url is the stream key of the output (see stream_key)
         """
         queue = self.queues[rtsp_url]
         try:
@@ -81,64 +752,166 @@ class RTSPStreamer:
                 if not self.clients.get(rtsp_url):
                     break
 
-                frame_bytes = await queue.get()
-                await self.send_to_clients(rtsp_url, frame_bytes)
-
-        except WebSocketDisconnect as disconnect_error:
-            logger.info("webSocket disconnected %s", disconnect_error)
+                frame = await queue.get()
+                # capture of the source stream ended
+                if frame is None:
+                    break
+                await self.send_to_clients(rtsp_url, frame)
 
         finally:
-            # closes the stream on exception
-            self.remove_all_clients(rtsp_url)
+            # closes the stream on exception, unless the output was already detached (see stop_outputs)
+            # and a late joiner owns a fresh one
+            if self.queues.get(rtsp_url) is queue:
+                self.remove_all_clients(rtsp_url)
+                del self.queues[rtsp_url]
+                self.outputs.pop(rtsp_url, None)
+                self.latest_frames.pop(rtsp_url, None)
 
+    def start_output(self, key: str):
+        """
+        Creates frame queue of an output and schedules its sender task
+        """
+        self.queues[key] = asyncio.Queue(maxsize=CAPTURE_QUEUE_SIZE)
+        asyncio.get_event_loop().create_task(self.process_stream(key))
 
+    def active_outputs(self, rtsp_url: str) -> List[Tuple[str, OutputShape]]:
+        """
+        Returns: (key, shape) of outputs of the RTSP URL that have clients
+        """
+        return [(key, shape) for key, (source_url, shape) in list(self.outputs.items())
+                if source_url == rtsp_url and self.clients.get(key)]
+
+    def keep_open(self, rtsp_url: str, idle_seconds: float) -> bool:
+        """
+        Returns: True if a capture without clients for idle_seconds should stay open
+        """
+        return rtsp_url in self.warm_streams or idle_seconds < self.idle_grace
+
+    def reconnect_delay(self, rtsp_url: str, attempt: int) -> Optional[float]:
+        """
+        Decides whether a dropped capture is reopened (it has clients or is warm) and counts the reconnect
+        Args:
+            rtsp_url:   RTSP URL of the dropped capture
+            attempt:    failed attempts in a row
+
+        Returns: seconds to wait before reconnecting or None to close the capture
+        """
+        if not self.active_outputs(rtsp_url) and rtsp_url not in self.warm_streams:
+            return None
+        self.count_reconnect(rtsp_url)
+        return backoff_delay(attempt, self.reconnect_min_delay, self.reconnect_max_delay)
+
+    def count_reconnect(self, rtsp_url: str):
+        """
+        Increments reconnect counter of the RTSP URL
+        """
+        self.reconnects[rtsp_url] = self.reconnects.get(rtsp_url, 0) + 1
+
+    def get_capture_metrics(self, rtsp_url: str) -> CaptureMetrics:
+        """
+        Returns: capture metrics of the RTSP URL (created on first use)
+        """
+        if rtsp_url not in self.capture_metrics:
+            self.capture_metrics[rtsp_url] = CaptureMetrics()
+        return self.capture_metrics[rtsp_url]
+
+    def enqueue_frame(self, key: str, frame: Frame):
+        """
+        Puts an encoded frame into the output queue (event loop side of the capture)
+        """
+        queue = self.queues.get(key)
+        if queue is not None and put_latest(queue, frame):
+            self.queue_drops[key] = self.queue_drops.get(key, 0) + 1
+
+    def get_metrics(self) -> dict:
+        """
+        Returns: JSON serializable metrics of all streams, keyed by stream URL without credentials
+        """
+        streams = {}
+        for rtsp_url in set(self.streams) | {source_url for source_url, _ in self.outputs.values()}:
+            metrics = self.capture_metrics.get(rtsp_url)
+            streams[redact_url(rtsp_url)] = {
+                "camera": self.camera_names.get(rtsp_url),
+                "open": self.streams.get(rtsp_url) is not None,
+                "warm": rtsp_url in self.warm_streams,
+                "openLatencySeconds": self.open_latencies.get(rtsp_url),
+                "reconnects": self.reconnects.get(rtsp_url, 0),
+                "fpsLimit": self.fps_limits.get(rtsp_url),
+                "capture": metrics.to_dict() if metrics is not None else None,
+                "outputs": {
+                    redact_url(key): {
+                        "width": shape.output_width if isinstance(shape, Region) else shape,
+                        "region": shape.label if isinstance(shape, Region) else None,
+                        "queueDepth": self.queues[key].qsize() if key in self.queues else 0,
+                        "queueDrops": self.queue_drops.get(key, 0),
+                        "clients": [self.stream_clients[client].get_metrics()
+                                    for client in self.clients.get(key, []) if client in self.stream_clients],
+                    }
+                    for key, (source_url, shape) in list(self.outputs.items()) if source_url == rtsp_url
+                },
+            }
+        return streams
+
+    def set_open_latency(self, rtsp_url: str, seconds: float):
+        """
+        Records time from opening the RTSP URL to its first frame
+        """
+        self.open_latencies[rtsp_url] = seconds
+        logger.info('RTSP stream %s opened in %.2f s', rtsp_url, seconds)
 
     def start_stream(self, rtsp_url: str):
         """
-        Start reading from RTSP in a background thread,
-        push frames into an asyncio.Queue, schedule the task.
+        Start reading from RTSP in a background thread (see run_capture),
+        each encoded frame is pushed into its output's asyncio.Queue.
         """
         if rtsp_url in self.streams:
             logger.info('Stream already active: %s', rtsp_url)
             return
 
-        self.queues[rtsp_url] = asyncio.Queue()
         loop = asyncio.get_event_loop()
+        # placeholder until the capture is opened -> prevents double start
+        self.streams[rtsp_url] = None
 
         def stream_thread():
-            cap = cv2.VideoCapture(rtsp_url)
-            if not cap.isOpened():
-                logger.info('Failed to open RTSP stream: %s', rtsp_url)
-                return
+            def on_open(cap):
+                self.streams[rtsp_url] = cap
 
-            self.streams[rtsp_url] = cap
+            def emit(key: str, frame: Frame):
+                # never blocks the capture thread, stale frames are dropped if fan-out falls behind
+                loop.call_soon_threadsafe(self.enqueue_frame, key, frame)
 
+            idle = False
             try:
-                while True:
-                    # if no clients, break out immediately
-                    if not self.clients.get(rtsp_url):
-                        break
-
-                    success, frame = cap.read()
-                    if not success:
-                        break
-                    _, buffer = cv2.imencode('.jpg', frame)
-                    frame_bytes = buffer.tobytes()
-
-                    asyncio.run_coroutine_threadsafe(
-                        self.queues[rtsp_url].put(frame_bytes),
-                        loop
-                    )
+                idle = run_capture(rtsp_url, self, emit, on_open)
             finally:
-                cap.release()
-                # remove streams
-                if rtsp_url in self.streams:
-                    del self.streams[rtsp_url]
-                if rtsp_url in self.queues:
-                    del self.queues[rtsp_url]
+                # decided on the event loop -> no client can join between the decision and the cleanup
+                loop.call_soon_threadsafe(self.close_stream, rtsp_url, idle)
 
         # start RTSP read thread
         threading.Thread(target=stream_thread, daemon=True).start()
 
-        # start stream sender
-        loop.create_task(self.process_stream(rtsp_url))
+    def close_stream(self, rtsp_url: str, idle: bool):
+        """
+        Cleans up after a capture thread ended. A capture closed for inactivity is restarted
+        if a client joined meanwhile, otherwise outputs of the RTSP URL are stopped.
+        """
+        self.streams.pop(rtsp_url, None)
+        if idle and self.active_outputs(rtsp_url):
+            self.start_stream(rtsp_url)
+        else:
+            self.stop_outputs(rtsp_url)
+
+    def stop_outputs(self, rtsp_url: str):
+        """
+        Stops all outputs of the RTSP URL and removes their clients, sender tasks get None (no more frames).
+        Outputs are detached right away -> a client joining later gets a fresh output and queue.
+        """
+        for key, (source_url, _) in list(self.outputs.items()):
+            if source_url != rtsp_url:
+                continue
+            del self.outputs[key]
+            self.remove_all_clients(key)
+            self.latest_frames.pop(key, None)
+            queue = self.queues.pop(key, None)
+            if queue is not None:
+                put_latest(queue, None)
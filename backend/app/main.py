@@ -15,7 +15,16 @@ from app.utils.logger import Logger
 from app.api.alive import router as alive_router
 from app.api.tapo_320ws import router as tapo_320ws_router
 from app.api.camera import router as camera_router
+from app.api.tapo_320ws.hls import hls_manager, start_timeshift
+from app.api.tapo_320ws.clips import clip_recorder
+from app.api.tapo_320ws.recordings import download_jobs, nvr_recorder, start_nvr
+from app.api.tapo_320ws.stream import warm_up_streams, streamer
+from app.camera.tapo_320ws.capture_worker import ProcessRTSPStreamer
+from app.camera.tapo_320ws.hls import CLIP_CAMERAS
+from app.camera.tapo_320ws.scheduler import FrameBudgetScheduler, STREAM_CPU_BUDGET
+from app.camera.tapo_320ws.video_stream import STREAM_PING_INTERVAL, STREAM_PING_TIMEOUT
 from app.utils.movement_listener import movement_listener
+from app.utils.stream_token import QUERY_AUTH_PATHS, verify_token
 
 load_dotenv(find_dotenv())
 
@@ -33,7 +42,17 @@ async def lifespan(fastapi_app: FastAPI):
     """
     fastapi_app.get('/alive')
     # Create a task to run the listener in the background
-    task = asyncio.create_task(movement_listener())
+    task = asyncio.create_task(movement_listener(clip_recorder.on_event))
+    # open RTSP sessions of always-warm cameras
+    warm_up_streams()
+    # fill timeshift buffers of continuously segmented cameras
+    await start_timeshift()
+    # event clips are cut from the same segment ring
+    await start_timeshift(CLIP_CAMERAS)
+    # continuous local recording
+    start_nvr()
+    # global frame budget of the live streams
+    scheduler_task = asyncio.create_task(FrameBudgetScheduler(streamer).run()) if STREAM_CPU_BUDGET > 0 else None
 
     # Yield control to start the application
     yield
@@ -45,6 +64,20 @@ async def lifespan(fastapi_app: FastAPI):
     except asyncio.CancelledError:
         main_logger.info("Listener task cancelled")
 
+    if scheduler_task is not None:
+        scheduler_task.cancel()
+
+    # stop ffmpeg segmenters and recorders
+    await hls_manager.stop_all()
+    await nvr_recorder.stop_all()
+
+    # running downloads remove their partial recordings
+    await download_jobs.cancel_all()
+
+    # stop capture worker processes
+    if isinstance(streamer, ProcessRTSPStreamer):
+        streamer.stop_all()
+
 
 app = FastAPI(lifespan=lifespan)
 
@@ -80,7 +113,16 @@ async def api_validate(request: Request, call_next):
     if request.scope["type"] == "websocket":
         return await call_next(request)
 
-    if request.headers.get("api-key") != API_KEY:
+    api_key = request.headers.get("api-key")
+    # <img> tags (MJPEG streams) and EventSource (job events) can't send headers
+    # -> signed token (or key) may be passed in the query
+    if api_key is None and QUERY_AUTH_PATHS.match(request.url.path):
+        token = request.query_params.get("token")
+        if token is not None and API_KEY and verify_token(API_KEY, request.url.path, token):
+            return await call_next(request)
+        api_key = request.query_params.get("api_key")
+
+    if api_key != API_KEY:
         main_logger.info("[SERVER]\tWrong API key")
         return JSONResponse(status_code=401, content={"message": "Unauthorized"})
 
@@ -121,4 +163,6 @@ async def get_root():
 
 # For testing
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # protocol level pings for all WebSocket clients (uvicorn CLI: UVICORN_WS_PING_INTERVAL / _TIMEOUT)
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_ping_interval=STREAM_PING_INTERVAL,
+                ws_ping_timeout=STREAM_PING_TIMEOUT)
@@ -0,0 +1,26 @@
+"""
+ffmpeg command line helpers
+"""
+import os
+from typing import List
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+
+def rtsp_input_args(rtsp_url: str) -> List[str]:
+    """
+    Common ffmpeg arguments for reading a camera RTSP stream
+    Args:
+        rtsp_url: RTSP URL of the camera
+
+    Returns: ffmpeg argv up to and including the input
+    """
+    return [
+        FFMPEG_BINARY,
+        "-hide_banner",
+        "-loglevel", "error",
+        "-rtsp_transport", "tcp",
+        "-i", rtsp_url,
+    ]
@@ -7,7 +7,7 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from smtplib import SMTPException
 import asyncio
-from typing import List
+from typing import Callable, List, Optional
 from dotenv import load_dotenv, find_dotenv
 from app.camera.tapo_320ws.utils import list_tapo_320ws_camera_names
 from app.camera.tapo_320ws.alarm_status import get_alarm_status
@@ -81,9 +81,12 @@ async def on_alarm(events: List[dict]) -> None:
         logger.error('SMTPException: %s', error)
 
 
-async def movement_listener():
+async def movement_listener(on_event: Optional[Callable[[str, float], None]] = None):
     """
     Function that listens for alarms
+    Args:
+        on_event:   called with (camera name, event start timestamp) for every polled event, ex. to save
+                    event clips (not limited by the email cooldown)
 
     Returns:
 
@@ -106,6 +109,10 @@ async def movement_listener():
                 global_alarm_status = True
                 global_events.extend(events)
 
+        if on_event is not None:
+            for event in global_events:
+                on_event(event['camera_name'], event['timestamp'])
+
         # do something on alarm
         if global_alarm_status and cooldown <= 0:
             logger.info('Alarm!!!')
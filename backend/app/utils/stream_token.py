@@ -0,0 +1,58 @@
+"""
+Short-lived signed tokens for MJPEG streams and download job events - <img> tags and EventSource can't send
+the api-key header, so the client asks for a token of the path (with the header) and passes it as ?token=
+instead of exposing the API key in URLs
+"""
+import hashlib
+import hmac
+import os
+import re
+import time
+from typing import Optional
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+# seconds a stream token can be used to open the stream (a running stream is not cut when it expires)
+STREAM_TOKEN_TTL = int(os.getenv("STREAM_TOKEN_TTL", "60"))
+
+# routes authenticated by query parameters (token or api_key), all others require the api-key header
+QUERY_AUTH_PATHS = re.compile(r'^/tapo-320ws/(stream/mjpeg/[^/]+|mosaic/mjpeg|recordings/jobs/[^/]+/events)$')
+
+
+def sign_path(secret: str, path: str, expires: int) -> str:
+    """
+    Returns: hex HMAC-SHA256 of the path and expiry
+    """
+    return hmac.new(secret.encode(), f"{path}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def create_token(secret: str, path: str, ttl: int = STREAM_TOKEN_TTL, now: Optional[float] = None) -> str:
+    """
+    Creates token for opening a stream
+    Args:
+        secret: key the token is signed with (API key)
+        path:   path of the stream (without query)
+        ttl:    seconds the token is valid
+        now:    current unix time (default time.time())
+
+    Returns: token in format <expires>.<signature>
+    """
+    expires = int((time.time() if now is None else now) + ttl)
+    return f"{expires}.{sign_path(secret, path, expires)}"
+
+
+def verify_token(secret: str, path: str, token: str, now: Optional[float] = None) -> bool:
+    """
+    Checks token of a stream path
+    Args:
+        secret: key the token was signed with (API key)
+        path:   requested path
+        token:  token from create_token
+        now:    current unix time (default time.time())
+
+    Returns: token is valid for the path and not expired
+    """
+    expires, _, signature = token.partition('.')
+    if not expires.isdigit() or int(expires) < (time.time() if now is None else now):
+        return False
+    return hmac.compare_digest(signature, sign_path(secret, path, int(expires)))
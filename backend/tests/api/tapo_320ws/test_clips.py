@@ -0,0 +1,35 @@
+"""
+tests /tapo-320ws/clips endpoints
+"""
+from unittest.mock import patch
+
+
+@patch("app.api.tapo_320ws.clips.clip_recorder")
+def test_get_clips(mock_recorder, client):
+    """
+    tests GET /tapo-320ws/clips/{name}
+    """
+    mock_recorder.list_clips.return_value = ["TestCam____2024-01-01____12-00-00.mp4"]
+
+    response = client.get("/tapo-320ws/clips/TestCam")
+
+    assert response.status_code == 200
+    assert response.json() == ["TestCam____2024-01-01____12-00-00.mp4"]
+
+
+@patch("app.api.tapo_320ws.clips.clip_recorder")
+def test_get_clip(mock_recorder, client, tmp_path):
+    """
+    tests GET /tapo-320ws/clips/{name}/{filename}, only listed clips are served
+    """
+    filename = "TestCam____2024-01-01____12-00-00.mp4"
+    (tmp_path / filename).write_bytes(b"mp4")
+    mock_recorder.list_clips.return_value = [filename]
+    mock_recorder.path_clips = str(tmp_path)
+
+    response = client.get(f"/tapo-320ws/clips/TestCam/{filename}")
+    missing = client.get("/tapo-320ws/clips/TestCam/..____secret.mp4")
+
+    assert response.status_code == 200
+    assert response.content == b"mp4"
+    assert missing.status_code == 404
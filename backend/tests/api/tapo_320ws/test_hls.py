@@ -0,0 +1,73 @@
+"""
+tests /tapo-320ws/hls endpoints
+"""
+from unittest.mock import patch, MagicMock, AsyncMock
+
+
+@patch("app.api.tapo_320ws.hls.hls_manager")
+def test_get_hls_playlist(mock_manager, client, tmp_path):
+    """
+    tests GET /tapo-320ws/hls/{name}/index.m3u8
+    """
+    playlist_path = tmp_path / "index.m3u8"
+    playlist_path.write_text("#EXTM3U\n")
+    segmenter = MagicMock()
+    segmenter.playlist_path = str(playlist_path)
+    segmenter.wait_for_playlist = AsyncMock(return_value=True)
+    mock_manager.get_running.return_value = segmenter
+
+    response = client.get("/tapo-320ws/hls/TestCam/index.m3u8")
+
+    assert response.status_code == 200
+    assert response.text == "#EXTM3U\n"
+    assert response.headers["cache-control"] == "no-cache"
+
+
+@patch("app.api.tapo_320ws.hls.hls_manager")
+def test_get_hls_segment_invalid_name(mock_manager, client):
+    """
+    tests GET /tapo-320ws/hls/{name}/{segment} refuses anything that is not a segment
+    """
+    mock_manager.get_running.return_value = MagicMock()
+
+    response = client.get("/tapo-320ws/hls/TestCam/index.m3u8.tmp")
+
+    assert response.status_code == 404
+
+
+@patch("app.api.tapo_320ws.hls.hls_manager")
+def test_get_timeshift_url(mock_manager, client):
+    """
+    tests GET /tapo-320ws/hls/{name}/timeshift clamps the offset to the buffered video
+    """
+    segmenter = MagicMock()
+    segmenter.wait_for_playlist = AsyncMock(return_value=True)
+    segmenter.buffered_seconds.return_value = 60.0
+    mock_manager.get_running.return_value = segmenter
+
+    with patch("app.api.tapo_320ws.hls.time.time", return_value=1000.0):
+        response = client.get("/tapo-320ws/hls/TestCam/timeshift?offset=300")
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "playlistUrl": "/tapo-320ws/hls/TestCam/timeshift.m3u8?start=940.000",
+        "start": 940.0,
+        "bufferedSeconds": 60.0,
+    }
+
+
+@patch("app.api.tapo_320ws.hls.hls_manager")
+def test_get_timeshift_playlist(mock_manager, client):
+    """
+    tests GET /tapo-320ws/hls/{name}/timeshift.m3u8
+    """
+    segmenter = MagicMock()
+    segmenter.wait_for_playlist = AsyncMock(return_value=True)
+    segmenter.timeshift_playlist.return_value = "#EXTM3U\n"
+    mock_manager.get_running.return_value = segmenter
+
+    response = client.get("/tapo-320ws/hls/TestCam/timeshift.m3u8?start=940")
+
+    assert response.status_code == 200
+    assert response.text == "#EXTM3U\n"
+    segmenter.timeshift_playlist.assert_called_once_with(940.0)
@@ -0,0 +1,25 @@
+"""
+tests /tapo-320ws/mosaic endpoints
+"""
+from unittest.mock import patch
+
+
+@patch("app.api.tapo_320ws.mosaic.get_auth_by_name", side_effect=TypeError)
+def test_get_mosaic_unknown_camera(_, client):
+    """
+    tests GET /tapo-320ws/mosaic/mjpeg with an unknown camera
+    """
+    response = client.get("/tapo-320ws/mosaic/mjpeg?cameras=Unknown")
+
+    assert response.status_code == 404
+
+
+def test_get_mosaic_too_many_cameras(client):
+    """
+    tests GET /tapo-320ws/mosaic/mjpeg refuses too large mosaics
+    """
+    cameras = ','.join(f"Cam{index}" for index in range(17))
+
+    response = client.get(f"/tapo-320ws/mosaic/mjpeg?cameras={cameras}")
+
+    assert response.status_code == 422
@@ -1,8 +1,13 @@
 """
 tests for /tapo-320ws/recordings/{name} endpoint
 """
+import asyncio
+import json
 from unittest.mock import patch
 from fastapi.exceptions import HTTPException
+from fastapi.testclient import TestClient
+from app.main import app
+from app.camera.tapo_320ws.download_jobs import DownloadJob
 
 
 @patch("app.api.tapo_320ws.recordings.Tapo320WSBaseInterface")
@@ -40,13 +45,15 @@ def test_get_recordings_fail(mock_camera_class, client):
 
 
 @patch("app.api.tapo_320ws.recordings.Tapo320WSBaseInterface")
-@patch("app.api.tapo_320ws.recordings.download_async")
-def test_post_download_recordings_success(mock_download_async, mock_camera_class, client):
+@patch("app.api.tapo_320ws.recordings.iter_download")
+@patch("app.api.tapo_320ws.recordings.download_jobs")
+def test_post_download_recordings_success(mock_download_jobs, mock_iter_download, mock_camera_class, client):
     """
-    tests POST /tapo-320ws/recordings/{name}
+    tests POST /tapo-320ws/recordings/{name} -> download is queued as a job
     """
     mock_camera_instance = mock_camera_class.return_value
-    mock_download_async.return_value = None
+    mock_download_jobs.join.return_value = None
+    mock_download_jobs.submit.return_value = DownloadJob("TestCam", "2024-01-01", "recording1")
 
     response = client.post(
         "/tapo-320ws/recordings/TestCam",
@@ -54,14 +61,79 @@ def test_post_download_recordings_success(mock_download_async, mock_camera_class
     )
 
     assert mock_camera_instance is not None
+    assert response.status_code == 202
+    assert response.json()["state"] == "queued"
+    assert response.json()["jobId"] == mock_download_jobs.submit.return_value.id
+    mock_iter_download.assert_called_once_with(mock_camera_instance.tapo_interface, "TestCam", "20240101",
+                                               "recording1")
+    mock_download_jobs.submit.assert_called_once_with("TestCam", "2024-01-01", "recording1",
+                                                      mock_iter_download.return_value)
+
+
+@patch("app.api.tapo_320ws.recordings.download_jobs")
+def test_download_job_status_and_cancel(mock_download_jobs, client):
+    """
+    tests GET and DELETE /tapo-320ws/recordings/jobs/{job_id}
+    """
+    job = DownloadJob("TestCam", "2024-01-01", "recording1")
+    mock_download_jobs.get.side_effect = lambda job_id: job if job_id == job.id else None
+    mock_download_jobs.cancel.side_effect = lambda job_id: job if job_id == job.id else None
+
+    response = client.get(f"/tapo-320ws/recordings/jobs/{job.id}")
+    assert response.status_code == 200
+    assert response.json()["id"] == "recording1"
+
+    response = client.delete(f"/tapo-320ws/recordings/jobs/{job.id}")
     assert response.status_code == 200
-    assert response.json() == "Recording download successful"
-    mock_download_async.assert_called_once()
+    mock_download_jobs.cancel.assert_called_once_with(job.id)
+
+    assert client.get("/tapo-320ws/recordings/jobs/unknown").status_code == 404
+    assert client.delete("/tapo-320ws/recordings/jobs/unknown").status_code == 404
+
+
+@patch("app.api.tapo_320ws.recordings.download_jobs")
+def test_download_job_events(mock_download_jobs, client):
+    """
+    tests GET /tapo-320ws/recordings/jobs/{job_id}/events -> server-sent job statuses
+    """
+    statuses = [{"state": "running", "progress": 10}, {"state": "finished", "progress": 60}]
+
+    async def follow(_):
+        for status in statuses:
+            yield status
+
+    mock_download_jobs.follow = follow
+
+    response = client.get("/tapo-320ws/recordings/jobs/job1/events")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == "".join(f"data: {json.dumps(status)}\n\n" for status in statuses)
+
+
+@patch("app.api.tapo_320ws.recordings.download_jobs")
+def test_download_job_events_query_auth(mock_download_jobs, client):
+    """
+    tests GET /tapo-320ws/recordings/jobs/{job_id}/events accepts a token of its path (EventSource can't send
+    headers), other job routes still require the api-key header
+    """
+    async def follow(_):
+        yield {"state": "finished"}
+
+    mock_download_jobs.follow = follow
+    path = "/tapo-320ws/recordings/jobs/job1/events"
+    token = client.get(f"/tapo-320ws/stream-token?path={path}").json()["token"]
+
+    assert TestClient(app).get(f"{path}?token={token}").status_code == 200
+    assert TestClient(app).get(f"{path}?api_key=TEST").status_code == 200
+    assert TestClient(app).get(path).status_code == 401
+    assert TestClient(app).get(f"/tapo-320ws/recordings/jobs/job2/events?token={token}").status_code == 401
+    assert TestClient(app).get(f"/tapo-320ws/recordings/jobs/job1?token={token}").status_code == 401
 
 
 @patch("app.api.tapo_320ws.recordings.Tapo320WSBaseInterface")
-@patch("app.api.tapo_320ws.recordings.download_async")
-def test_post_download_recordings_fail(mock_download_async, mock_camera_class, client):
+@patch("app.api.tapo_320ws.recordings.iter_download")
+def test_post_download_recordings_fail(mock_iter_download, mock_camera_class, client):
     """
     tests POST /tapo-320ws/recordings/{name} failure
     """
@@ -74,7 +146,7 @@ def test_post_download_recordings_fail(mock_download_async, mock_camera_class, c
 
     assert response.status_code == 404
     assert response.json() == {"detail": "Camera not found"}
-    mock_download_async.assert_not_called()
+    mock_iter_download.assert_not_called()
 
 
 @patch("app.api.tapo_320ws.recordings.os")
@@ -107,3 +179,73 @@ def test_delete_recordings_no_files(mock_os, client):
     assert response.status_code == 200
     assert response.json() == "Recording deletion successful"
     mock_os.remove.assert_not_called()
+
+
+@patch("app.api.tapo_320ws.recordings.recording_index")
+def test_get_local_recordings(mock_index, client):
+    """
+    tests GET /tapo-320ws/recordings/{name}?source=local is served from the NVR index
+    """
+    mock_index.find.return_value = [
+        {"id": 7, "camera": "TestCam", "start_time": 1704106800.0, "end_time": 1704107100.0, "path": "/nvr/a.mp4"},
+    ]
+
+    response = client.get("/tapo-320ws/recordings/TestCam?start_date=2024-01-01&end_date=2024-01-01&source=local")
+
+    assert response.status_code == 200
+    assert response.json()[0]["id"] == "nvr_7"
+    assert response.json()[0]["duration_seconds"] == 300
+    assert response.json()[0]["downloaded"] is True
+
+
+@patch("app.api.tapo_320ws.recordings.download_jobs")
+@patch("app.api.tapo_320ws.recordings.recording_index")
+def test_download_local_recording(mock_index, mock_download_jobs, client, tmp_path):
+    """
+    tests POST /tapo-320ws/recordings/download/{name} sends local segment without a camera session
+    """
+    segment_path = tmp_path / "2024-01-01_12-00-00.mp4"
+    segment_path.write_bytes(b"mp4")
+    mock_index.get.return_value = {"id": 7, "camera": "TestCam", "start_time": 0.0, "end_time": 300.0,
+                                   "path": str(segment_path)}
+
+    response = client.post("/tapo-320ws/recordings/download/TestCam", json={"date": "2024-01-01", "id": "nvr_7"})
+    missing = client.post("/tapo-320ws/recordings/download/TestCam2", json={"date": "2024-01-01", "id": "nvr_7"})
+
+    assert response.status_code == 200
+    assert response.content == b"mp4"
+    assert missing.status_code == 404
+    mock_download_jobs.submit.assert_not_called()
+
+
+@patch("app.api.tapo_320ws.recordings.Tapo320WSBaseInterface")
+@patch("app.api.tapo_320ws.recordings.download_jobs")
+def test_download_attaches_to_running_job(mock_download_jobs, mock_camera_class, client, tmp_path):
+    """
+    tests POST /tapo-320ws/recordings/download/{name} waits for the running download of the same recording
+    instead of opening another camera session
+    """
+    recording_path = tmp_path / "TestCam____2024-01-01____recording1.mp4"
+
+    async def running_download():
+        recording_path.write_bytes(b"mp4")
+
+    job = DownloadJob("TestCam", "2024-01-01", "recording1")
+
+    def join_job(*_):
+        # task is created on the event loop of the test client
+        if job.task is None:
+            job.task = asyncio.ensure_future(running_download())
+        return job
+
+    mock_download_jobs.join.side_effect = join_job
+
+    with patch("app.api.tapo_320ws.recordings.RECORDINGS_PATH", str(tmp_path)):
+        response = client.post("/tapo-320ws/recordings/download/TestCam",
+                               json={"date": "2024-01-01", "id": "recording1"})
+
+    assert response.status_code == 200
+    assert response.content == b"mp4"
+    mock_download_jobs.join.assert_called_once_with("TestCam", "2024-01-01", "recording1")
+    mock_download_jobs.submit.assert_not_called()
+    mock_camera_class.assert_not_called()
@@ -25,6 +25,7 @@ def test_get_alarm_status():
             "alarm_type": 6,
             "startRelative": 10,
             "endRelative": 4,
+            "timestamp": start_time,
             "camera_name": "TestCam"
         }
     ]
@@ -0,0 +1,160 @@
+"""
+tests for camera/tapo_320ws/capture_worker module
+"""
+import asyncio
+import multiprocessing
+import threading
+from unittest.mock import MagicMock
+import numpy as np
+import pytest
+
+from app.camera.tapo_320ws.capture_worker import (FrameRing, ProcessRTSPStreamer, CaptureWorker, StreamOptions,
+                                                  WorkerControl,
+                                                  capture_worker, MESSAGE_OUTPUTS, MESSAGE_OPTIONS, MESSAGE_OPENED,
+                                                  MESSAGE_FRAME, MESSAGE_CLOSED, MESSAGE_METRICS)
+from app.camera.tapo_320ws.video_stream import Frame
+
+
+@pytest.fixture
+def frame_ring():
+    """
+    small shared memory ring, unlinked after the test
+    """
+    ring = FrameRing(slots=2, slot_size=16)
+    yield ring
+    ring.close(unlink=True)
+
+
+def test_frame_ring_read_write(frame_ring):
+    """
+    frames are read by sequence number from another attachment, overwritten and oversized frames are refused
+    """
+    reader = FrameRing(*frame_ring.layout)
+
+    assert frame_ring.write(Frame(b'first', 1, 1.5))
+    assert reader.read(1) == Frame(b'first', 1, 1.5)
+
+    frame_ring.write(Frame(b'second', 2, 2.0))
+    frame_ring.write(Frame(b'third', 3, 3.0))
+    assert reader.read(1) is None
+    assert reader.read(3) == Frame(b'third', 3, 3.0)
+
+    assert not frame_ring.write(Frame(b'x' * 17, 4, 4.0))
+    reader.close()
+
+
+def test_capture_worker_writes_frames(frame_ring, mocker):
+    """
+    worker encodes frames into the ring of each output and announces them
+    """
+    mock_capture = MagicMock()
+    mock_capture.isOpened.return_value = True
+    mock_capture.grab.side_effect = [True, True, False]
+    mock_capture.retrieve.return_value = (True, np.zeros((8, 8, 3), dtype=np.uint8))
+    mocker.patch('cv2.VideoCapture', return_value=mock_capture)
+    mocker.patch('cv2.imencode', return_value=(True, np.frombuffer(b'jpeg', dtype=np.uint8)))
+
+    server, worker = multiprocessing.Pipe()
+    server.send((MESSAGE_OUTPUTS, {'rtsp://worker_test': (frame_ring.layout, None)}))
+    mocker.patch.object(WorkerControl, 'reconnect_delay', return_value=None)
+    thread = threading.Thread(target=capture_worker,
+                              args=('rtsp://worker_test', worker, tuple(StreamOptions(0, 0)), False, 10, (0, 0)))
+    thread.start()
+    thread.join(timeout=5)
+
+    messages = []
+    # worker closes its end of the pipe after the last message
+    while True:
+        try:
+            messages.append(server.recv())
+        except EOFError:
+            break
+    metrics = [value for message, value in messages if message == MESSAGE_METRICS]
+    messages = [message for message in messages if message[0] != MESSAGE_METRICS]
+    assert metrics[0].encoded_frames == 1
+    assert messages[0][0] == MESSAGE_OPENED
+    assert messages[1:] == [(MESSAGE_FRAME, ('rtsp://worker_test', 1)), (MESSAGE_FRAME, ('rtsp://worker_test', 2)),
+                            (MESSAGE_CLOSED, False)]
+    assert frame_ring.read(2).data == b'jpeg'
+    mock_capture.release.assert_called_once()
+
+
+@pytest.mark.asyncio
+class TestProcessRTSPStreamer:
+    """
+    ProcessRTSPStreamer test class
+    """
+
+    @pytest.fixture
+    async def worker_streamer(self, mocker):
+        """
+        returns (streamer, worker end of the pipe, client) with a fake worker registered on rtsp://process_test
+        """
+        streamer = ProcessRTSPStreamer()
+        mocker.patch.object(streamer, 'start_stream')
+        client = MagicMock()
+        client.send_text = mocker.AsyncMock()
+        streamer.add_client('rtsp://process_test', client)
+        streamer.start_stream.reset_mock()
+
+        server, worker = multiprocessing.Pipe()
+        streamer.streams['rtsp://process_test'] = CaptureWorker(MagicMock(), server)
+        asyncio.get_event_loop().add_reader(server.fileno(), streamer.handle_worker_messages, 'rtsp://process_test')
+        yield streamer, worker, client
+        streamer.remove_all_clients('rtsp://process_test')
+        await asyncio.sleep(0.01)
+
+    async def test_sync_outputs_sends_rings(self, worker_streamer):
+        """
+        worker learns rings of outputs with clients and the options following its clients' frame rate
+        """
+        streamer, worker, _ = worker_streamer
+
+        streamer.sync_outputs('rtsp://process_test')
+
+        message, outputs = worker.recv()
+        assert message == MESSAGE_OUTPUTS
+        assert outputs == {'rtsp://process_test': (streamer.rings['rtsp://process_test'].layout, None)}
+        message, options = worker.recv()
+        assert message == MESSAGE_OPTIONS
+        assert options == tuple(streamer.get_stream_options('rtsp://process_test'))
+
+    async def test_frames_forwarded_from_ring(self, worker_streamer):
+        """
+        announced frames are copied from shared memory and sent to clients
+        """
+        streamer, worker, client = worker_streamer
+
+        streamer.rings['rtsp://process_test'].write(Frame(b'\xff\xff\xff\xff', 1, 0.0))
+        worker.send((MESSAGE_FRAME, ('rtsp://process_test', 1)))
+        await asyncio.sleep(0.05)
+
+        client.send_text.assert_awaited_with('data:image/jpeg;base64,/////w==')
+
+    async def test_idle_worker_restarted_for_new_clients(self, worker_streamer):
+        """
+        worker that closed for inactivity while a client joined is started again
+        """
+        streamer, worker, _ = worker_streamer
+
+        worker.send((MESSAGE_CLOSED, True))
+        await asyncio.sleep(0.05)
+
+        streamer.start_stream.assert_called_once_with('rtsp://process_test')
+        assert 'rtsp://process_test' not in streamer.streams
+
+    async def test_closed_worker_joined_off_loop(self, worker_streamer):
+        """
+        exited worker process is joined in a thread, not on the event loop
+        """
+        streamer, worker, _ = worker_streamer
+        process = streamer.streams['rtsp://process_test'].process
+        loop_thread = threading.get_ident()
+        join_threads = []
+        process.join.side_effect = lambda timeout: join_threads.append(threading.get_ident())
+
+        worker.send((MESSAGE_CLOSED, False))
+        await asyncio.sleep(0.05)
+
+        process.join.assert_called_once_with(1)
+        assert join_threads and join_threads[0] != loop_thread
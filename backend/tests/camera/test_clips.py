@@ -0,0 +1,93 @@
+"""
+tests for camera/tapo_320ws/clips module
+"""
+import asyncio
+from unittest.mock import MagicMock
+import pytest
+
+from app.camera.tapo_320ws.clips import ClipRecorder, select_segments, clip_ffmpeg_args
+from app.camera.tapo_320ws.hls import HLSManager, HLSSegment, HLSSegmenter
+
+# 2024-01-01T12:00:00Z
+RING_START = 1704110400.0
+RING = [HLSSegment(f"segment_{index:06d}.ts", 2.0, index, RING_START + index * 2) for index in range(10)]
+
+
+@pytest.fixture
+def ring_manager(tmp_path):
+    """
+    HLS manager with a pinned segmenter whose ring holds RING
+    """
+    manager = HLSManager(str(tmp_path / 'hls'))
+    segmenter = HLSSegmenter('TestCam', 'rtsp://clip_test', str(tmp_path / 'hls' / 'TestCam'))
+    segmenter.read_segments = MagicMock(return_value=RING)
+    (tmp_path / 'hls' / 'TestCam').mkdir(parents=True)
+    for segment in RING:
+        (tmp_path / 'hls' / 'TestCam' / segment.uri).write_bytes(b'ts')
+    manager.segmenters['TestCam'] = segmenter
+    manager.pinned.add('TestCam')
+    return manager
+
+
+def test_select_segments():
+    """
+    segments overlapping the interval, partially covered ones included
+    """
+    segments = select_segments(RING, RING_START + 3, RING_START + 8)
+
+    assert [segment.sequence for segment in segments] == [1, 2, 3]
+
+
+def test_clip_ffmpeg_args_stream_copy():
+    """
+    clips are joined without re-encoding
+    """
+    args = clip_ffmpeg_args('/tmp/segments.txt', '/tmp/clip.mp4')
+
+    assert args[args.index('-c') + 1] == 'copy'
+    assert args[args.index('-f') + 1] == 'concat'
+    assert args[-1] == '/tmp/clip.mp4'
+
+
+@pytest.mark.asyncio
+async def test_save_clip(mocker, tmp_path, ring_manager):
+    """
+    pre-roll and post-roll segments are joined into one MP4, temporary links are removed
+    """
+    process = MagicMock()
+    process.wait = mocker.AsyncMock(return_value=0)
+    create_subprocess = mocker.patch('asyncio.create_subprocess_exec', mocker.AsyncMock(return_value=process))
+    listed = []
+
+    def read_list(*args, **_):
+        with open(args[args.index('-i') + 1], encoding='utf-8') as file:
+            listed.extend(file.read().splitlines())
+        return process
+
+    create_subprocess.side_effect = read_list
+    recorder = ClipRecorder(ring_manager, str(tmp_path / 'clips'), pre_roll=4, post_roll=4)
+
+    path = await recorder.save_clip('TestCam', RING_START + 10)
+
+    assert path.endswith('.mp4') and path.startswith(str(tmp_path / 'clips'))
+    assert len(listed) == 4
+    assert listed[0].endswith("segment_000003.ts'")
+    assert list((tmp_path / 'clips').iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_on_event_deduplicates(mocker, ring_manager, tmp_path):
+    """
+    event reported by several polls is saved once, cameras without ring are ignored
+    """
+    recorder = ClipRecorder(ring_manager, str(tmp_path / 'clips'), pre_roll=4, post_roll=4)
+    save_clip = mocker.patch.object(recorder, 'save_clip', mocker.AsyncMock())
+
+    first = recorder.on_event('TestCam', RING_START)
+    again = recorder.on_event('TestCam', RING_START)
+    later = recorder.on_event('TestCam', RING_START + 10)
+    unpinned = recorder.on_event('OtherCam', RING_START)
+    await asyncio.gather(first, later)
+
+    assert again is None and unpinned is None
+    assert save_clip.await_count == 2
@@ -0,0 +1,157 @@
+"""
+tests for camera/tapo_320ws/download module
+"""
+import asyncio
+import os
+import sys
+from unittest.mock import patch
+import pytest
+
+from app.camera.tapo_320ws.download import AudioPipeWriter, Convert, mux_ffmpeg_args
+from tests.camera.test_mpegts import pes_packet
+
+# stands in for ffmpeg: reads the video from stdin and the audio from the inherited pipe,
+# with early=1 it exits before reading everything (like ffmpeg that reached -t)
+FAKE_FFMPEG = """
+import os, sys
+if sys.argv[4] == '1':
+    with open(sys.argv[2], 'wb') as output:
+        output.write(b'early')
+    sys.exit(0)
+video = sys.stdin.buffer.read()
+with os.fdopen(int(sys.argv[1]), 'rb') as audio_pipe:
+    audio = audio_pipe.read()
+with open(sys.argv[2], 'wb') as output:
+    output.write(video + b'|' + audio)
+sys.exit(int(sys.argv[3]))
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg():
+    """
+    Replaces ffmpeg by FAKE_FFMPEG, exit code and early exit are taken from the returned dict
+    """
+    state = {"exit_code": 0, "early": 0}
+
+    def args(audio_fd, output_file, _):
+        return [sys.executable, '-c', FAKE_FFMPEG, str(audio_fd), output_file, str(state["exit_code"]),
+                str(state["early"])]
+
+    with patch('app.camera.tapo_320ws.download.mux_ffmpeg_args', side_effect=args):
+        yield state
+
+
+def test_mux_ffmpeg_args():
+    """
+    Video comes from stdin, audio from the inherited pipe and the output is cut to the recording length
+    """
+    args = mux_ffmpeg_args(7, '/tmp/out.mp4.part', 90)
+
+    assert args[args.index('-f') + 1] == 'mpegts'
+    assert 'pipe:0' in args
+    assert 'pipe:7' in args
+    assert args[args.index('-t') + 1] == '0:01:30'
+    assert args[-1] == '/tmp/out.mp4.part'
+
+
+@pytest.mark.usefixtures('fake_ffmpeg')
+async def test_convert_pipes_chunks_to_ffmpeg(tmp_path):
+    """
+    Chunks are piped into ffmpeg without temp files and the MP4 appears once it is complete
+    """
+    output = str(tmp_path / 'out.mp4')
+    convert = Convert(output, 30)
+    await convert.write(b'video1', b'audio1')
+    await convert.write(b'video2', b'audio2')
+    assert os.listdir(tmp_path) in ([], ['out.mp4.part'])
+
+    assert await convert.save() is True
+
+    with open(output, 'rb') as file:
+        assert file.read() == b'video1video2|audio1audio2'
+    assert os.listdir(tmp_path) == ['out.mp4']
+
+
+async def test_convert_save_failed(fake_ffmpeg, tmp_path):
+    """
+    Non-zero exit code of ffmpeg -> no recording and the partial output is removed
+    """
+    fake_ffmpeg["exit_code"] = 1
+    convert = Convert(str(tmp_path / 'out.mp4'), 30)
+    await convert.write(b'video', b'audio')
+
+    assert await convert.save() is False
+    assert not os.listdir(tmp_path)
+
+
+async def test_convert_ffmpeg_finished_early(fake_ffmpeg, tmp_path):
+    """
+    Chunks after ffmpeg has the whole recording (closed pipes) are dropped without failing
+    """
+    fake_ffmpeg["early"] = 1
+    output = str(tmp_path / 'out.mp4')
+    convert = Convert(output, 30)
+    await convert.write(b'video', b'audio')
+    await convert.process.wait()
+    for _ in range(3):
+        await convert.write(b'video' * 20000, b'audio' * 20000)
+
+    assert convert.inputClosed is True
+    assert await convert.save() is True
+    with open(output, 'rb') as file:
+        assert file.read() == b'early'
+
+
+async def test_convert_ffmpeg_missing(tmp_path):
+    """
+    ffmpeg that cannot be started fails the conversion instead of the download
+    """
+    with patch('asyncio.create_subprocess_exec', side_effect=FileNotFoundError('ffmpeg')):
+        convert = Convert(str(tmp_path / 'out.mp4'), 30)
+        await convert.write(b'video', b'audio')
+        await convert.write(b'video', b'audio')
+
+    assert await convert.save() is False
+    assert convert.addedChunks == 2
+
+
+@pytest.mark.usefixtures('fake_ffmpeg')
+async def test_convert_audio_pipe_failed(tmp_path):
+    """
+    Audio pipe that cannot be connected stops ffmpeg and leaks neither end of the pipe
+    """
+    open_fds = set(os.listdir('/proc/self/fd'))
+    loop = asyncio.get_running_loop()
+    connect_write_pipe = loop.connect_write_pipe
+
+    async def connect_stdin_only(protocol_factory, pipe):
+        if protocol_factory is AudioPipeWriter:
+            raise OSError('pipe')
+        return await connect_write_pipe(protocol_factory, pipe)
+
+    with patch.object(loop, 'connect_write_pipe', side_effect=connect_stdin_only):
+        convert = Convert(str(tmp_path / 'out.mp4'), 30)
+        await convert.write(b'video', b'audio')
+
+    assert convert.inputClosed is True
+    assert await convert.save() is False
+    assert set(os.listdir('/proc/self/fd')) <= open_fds
+    assert not os.listdir(tmp_path)
+
+
+@pytest.mark.usefixtures('fake_ffmpeg')
+async def test_convert_length_from_timestamps(tmp_path):
+    """
+    Length comes from the PTS of the written chunks, ffprobe is not run
+    """
+    convert = Convert(str(tmp_path / 'out.mp4'), 30)
+    assert convert.getLength() == 0
+
+    with patch('subprocess.run') as mock_run:
+        for index in range(3):
+            await convert.write(pes_packet(0x100, index * 45000), b'audio')
+        mock_run.assert_not_called()
+
+    assert convert.getLength() == 1.5
+    assert await convert.save() is True
@@ -0,0 +1,172 @@
+"""
+tests for camera/tapo_320ws/download_jobs module
+"""
+import asyncio
+import pytest
+
+from app.camera.tapo_320ws.download_jobs import DownloadJobManager, JOB_CANCELLED, JOB_FAILED, JOB_FINISHED
+
+
+def fake_download(path, steps=3, gate: asyncio.Event = None, log: list = None):
+    """
+    Download yielding Downloader statuses, creates the file at the end
+    """
+    async def download():
+        if log is not None:
+            log.append(('start', str(path)))
+        try:
+            for step in range(steps):
+                if gate is not None:
+                    await gate.wait()
+                yield {"currentAction": "Downloading", "fileName": str(path), "progress": step * 10, "total": 30}
+            path.write_bytes(b'mp4')
+            yield {"currentAction": "Converting", "fileName": str(path), "progress": 0, "total": 0}
+        finally:
+            if log is not None:
+                log.append(('end', str(path)))
+    return download()
+
+
+async def test_job_finishes(tmp_path):
+    """
+    Job tracks Downloader statuses and finishes when the recording exists
+    """
+    manager = DownloadJobManager()
+    job = manager.submit('TestCam', '2024-01-01', 'rec1', fake_download(tmp_path / 'rec1.mp4'))
+    assert job.to_dict()["state"] == 'queued'
+
+    await job.task
+
+    status = job.to_dict()
+    assert status["state"] == JOB_FINISHED
+    assert status["currentAction"] == 'Converting'
+    assert status["fileName"] == 'rec1.mp4'
+    assert manager.get(job.id) is job
+
+
+async def test_job_failed(tmp_path):
+    """
+    Download that gives up or raises fails the job without raising
+    """
+    async def giving_up():
+        yield {"currentAction": "Giving up", "fileName": str(tmp_path / 'rec1.mp4'), "progress": 0, "total": 0}
+
+    async def broken():
+        raise ConnectionError('camera offline')
+        yield {}  # pylint: disable=unreachable
+
+    manager = DownloadJobManager()
+    gave_up = manager.submit('TestCam', '2024-01-01', 'rec1', giving_up())
+    failed = manager.submit('TestCam', '2024-01-01', 'rec2', broken())
+    await asyncio.gather(gave_up.task, failed.task)
+
+    assert gave_up.state == JOB_FAILED and gave_up.error == 'Giving up'
+    assert failed.state == JOB_FAILED and failed.error == 'camera offline'
+
+
+async def test_camera_concurrency(tmp_path):
+    """
+    Downloads of one camera run one after another, other cameras run in parallel
+    """
+    log = []
+    gate = asyncio.Event()
+    manager = DownloadJobManager(workers=2, camera_concurrency=1)
+    first = manager.submit('Cam1', '2024-01-01', 'a', fake_download(tmp_path / 'a.mp4', gate=gate, log=log))
+    second = manager.submit('Cam1', '2024-01-01', 'b', fake_download(tmp_path / 'b.mp4', gate=gate, log=log))
+    other = manager.submit('Cam2', '2024-01-01', 'c', fake_download(tmp_path / 'c.mp4', gate=gate, log=log))
+    await asyncio.sleep(0.01)
+
+    assert [entry for entry in log if entry[0] == 'start'] == [('start', str(tmp_path / 'a.mp4')),
+                                                               ('start', str(tmp_path / 'c.mp4'))]
+    assert second.state == 'queued'
+
+    gate.set()
+    await asyncio.gather(first.task, second.task, other.task)
+    assert log.index(('end', str(tmp_path / 'a.mp4'))) < log.index(('start', str(tmp_path / 'b.mp4')))
+    assert {first.state, second.state, other.state} == {JOB_FINISHED}
+
+
+async def test_cancel_job(tmp_path):
+    """
+    Cancelled job closes its download and reports the cancellation to followers
+    """
+    log = []
+    manager = DownloadJobManager()
+    job = manager.submit('TestCam', '2024-01-01', 'rec1',
+                         fake_download(tmp_path / 'rec1.mp4', gate=asyncio.Event(), log=log))
+
+    async def follow():
+        return [status["state"] async for status in manager.follow(job.id)]
+
+    follower = asyncio.create_task(follow())
+    await asyncio.sleep(0.01)
+    manager.cancel(job.id)
+    with pytest.raises(asyncio.CancelledError):
+        await job.task
+
+    assert job.state == JOB_CANCELLED
+    assert log[-1] == ('end', str(tmp_path / 'rec1.mp4'))
+    assert await follower == ['running', JOB_CANCELLED]
+    assert not (tmp_path / 'rec1.mp4').exists()
+
+
+async def test_job_history(tmp_path):
+    """
+    Only the latest finished jobs are kept
+    """
+    manager = DownloadJobManager(history=1)
+    first = manager.submit('TestCam', '2024-01-01', 'a', fake_download(tmp_path / 'a.mp4', steps=0))
+    await first.task
+    second = manager.submit('TestCam', '2024-01-01', 'b', fake_download(tmp_path / 'b.mp4', steps=0))
+    await second.task
+    manager.submit('TestCam', '2024-01-01', 'c', fake_download(tmp_path / 'c.mp4', steps=0))
+
+    assert manager.get(first.id) is None
+    assert manager.get(second.id) is second
+    await manager.cancel_all()
+
+
+async def test_single_flight(tmp_path):
+    """
+    Requests of a recording that is being downloaded share the running job, a new job starts after it ended
+    """
+    log = []
+    gate = asyncio.Event()
+    manager = DownloadJobManager()
+    first = manager.submit('TestCam', '2024-01-01', 'rec1', fake_download(tmp_path / 'rec1.mp4', gate=gate, log=log))
+    second = manager.submit('TestCam', '2024-01-01', 'rec1', fake_download(tmp_path / 'rec1.mp4', log=log))
+    other = manager.submit('TestCam', '2024-01-02', 'rec1', fake_download(tmp_path / 'rec2.mp4', log=log))
+
+    assert second is first
+    assert other is not first
+    assert manager.find('TestCam', '2024-01-01', 'rec1') is first
+
+    gate.set()
+    await asyncio.gather(first.task, other.task)
+    assert log.count(('start', str(tmp_path / 'rec1.mp4'))) == 1
+    assert manager.find('TestCam', '2024-01-01', 'rec1') is None
+    assert manager.submit('TestCam', '2024-01-01', 'rec1', fake_download(tmp_path / 'rec1.mp4')) is not first
+    await manager.cancel_all()
+
+
+async def test_cancel_shared_job(tmp_path):
+    """
+    Shared job keeps running until every requester has cancelled it
+    """
+    manager = DownloadJobManager()
+    job = manager.submit('TestCam', '2024-01-01', 'rec1', fake_download(tmp_path / 'rec1.mp4', gate=asyncio.Event()))
+    assert manager.join('TestCam', '2024-01-01', 'rec1') is job
+    assert manager.submit('TestCam', '2024-01-01', 'rec1', fake_download(tmp_path / 'rec1.mp4')) is job
+    assert job.requesters == 3
+    await asyncio.sleep(0.01)
+
+    manager.cancel(job.id)
+    manager.cancel(job.id)
+    await asyncio.sleep(0.01)
+    assert job.state == 'running'
+    assert job.to_dict()["requesters"] == 1
+
+    manager.cancel(job.id)
+    with pytest.raises(asyncio.CancelledError):
+        await job.task
+    assert job.state == JOB_CANCELLED
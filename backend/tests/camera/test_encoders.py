@@ -0,0 +1,84 @@
+"""
+tests for camera/tapo_320ws/encoders module
+"""
+import numpy as np
+import pytest
+
+from app.camera.tapo_320ws.encoders import (EncoderOptions, get_encoder, opencv_encoder, benchmark, sample_frames,
+                                            available_backends, BACKEND_OPENCV, BACKEND_TURBOJPEG)
+from app.camera.tapo_320ws.video_stream import RTSPStreamer
+
+
+def luma_sampling(jpeg: bytes) -> int:
+    """
+    helper function - sampling factors of the first (Y) component from the SOF0 marker
+    """
+    index = jpeg.index(b'\xff\xc0')
+    # marker, length (2), precision, height (2), width (2), components, component id, sampling
+    return jpeg[index + 11]
+
+
+def test_opencv_encoder_options():
+    """
+    quality and chroma subsampling are applied
+    """
+    image = sample_frames(None, 320, 1)[0]
+
+    high = opencv_encoder(95, '444')(image)
+    low = opencv_encoder(50, '420')(image)
+
+    assert high[:2] == b'\xff\xd8'
+    assert len(low) < len(high)
+    assert luma_sampling(high) == 0x11
+    assert luma_sampling(low) == 0x22
+
+
+def test_get_encoder_validation():
+    """
+    unknown backend / subsampling are refused
+    """
+    with pytest.raises(ValueError):
+        get_encoder(EncoderOptions('gif'))
+    with pytest.raises(ValueError):
+        get_encoder(EncoderOptions(BACKEND_OPENCV, 90, '411'))
+
+
+def test_missing_backend_falls_back_to_opencv(mocker):
+    """
+    optional backend that is not installed falls back to OpenCV with a warning naming the backend and the error
+    """
+    mocker.patch.dict('app.camera.tapo_320ws.encoders.ENCODER_FACTORIES',
+                      {BACKEND_TURBOJPEG: mocker.Mock(side_effect=ImportError('No module named turbojpeg'))})
+    mock_logger = mocker.patch('app.camera.tapo_320ws.encoders.logger')
+    get_encoder.cache_clear()
+
+    encoder = get_encoder(EncoderOptions(BACKEND_TURBOJPEG, 90, '420'))
+
+    assert encoder(np.zeros((16, 16, 3), dtype=np.uint8))[:2] == b'\xff\xd8'
+    message = mock_logger.warning.call_args.args[0] % mock_logger.warning.call_args.args[1:]
+    assert BACKEND_TURBOJPEG in message and 'No module named turbojpeg' in message
+    assert BACKEND_TURBOJPEG not in available_backends()
+    get_encoder.cache_clear()
+
+
+def test_benchmark():
+    """
+    benchmark measures every combination
+    """
+    results = benchmark(sample_frames(None, 160, 2), [BACKEND_OPENCV], [80], ['420', '444'])
+
+    assert [(result["subsampling"], result["fps"] > 0) for result in results] == [('420', True), ('444', True)]
+
+
+def test_stream_encoder_options():
+    """
+    encoder is configured per stream
+    """
+    streamer = RTSPStreamer()
+
+    options = streamer.set_stream_options('rtsp://encoder_test', encoder=EncoderOptions(BACKEND_OPENCV, 70, '422'))
+
+    assert options.encoder.quality == 70
+    assert streamer.get_stream_options('rtsp://other').encoder == EncoderOptions()
+    with pytest.raises(ValueError):
+        streamer.set_stream_options('rtsp://encoder_test', encoder=EncoderOptions('gif'))
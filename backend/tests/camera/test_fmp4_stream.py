@@ -0,0 +1,143 @@
+"""
+tests for camera/tapo_320ws/fmp4_stream module
+"""
+import asyncio
+import json
+import struct
+from unittest.mock import MagicMock
+import pytest
+
+from app.camera.tapo_320ws.fmp4_stream import FMP4Streamer, read_box, get_codec_string
+
+
+def make_box(box_type: bytes, payload: bytes = b'') -> bytes:
+    """
+    helper function - builds ISO BMFF box
+    """
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+# moov with a minimal avcC (version 1, profile 0x4d, compatibility 0x00, level 0x1f)
+AVCC = make_box(b'avcC', bytes([1, 0x4d, 0x00, 0x1f]))
+INIT_SEGMENT = make_box(b'ftyp', b'isom') + make_box(b'moov', AVCC)
+FRAGMENT = make_box(b'moof', b'\x00' * 4) + make_box(b'mdat', b'\x01' * 16)
+
+
+def make_reader(data: bytes) -> asyncio.StreamReader:
+    """
+    helper function - stream reader with given content
+    """
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+@pytest.mark.asyncio
+async def test_read_box():
+    """
+    reads boxes one by one including 64-bit largesize boxes
+    """
+    large_box = struct.pack('>I4sQ', 1, b'mdat', 16 + 3) + b'abc'
+    reader = make_reader(make_box(b'ftyp', b'isom') + large_box)
+
+    assert await read_box(reader) == (b'ftyp', make_box(b'ftyp', b'isom'))
+    assert await read_box(reader) == (b'mdat', large_box)
+
+
+def test_get_codec_string():
+    """
+    codec string is read from avcC box
+    """
+    assert get_codec_string(INIT_SEGMENT) == 'avc1.4d001f'
+    assert get_codec_string(make_box(b'moov')) is None
+
+
+@pytest.mark.asyncio
+async def test_process_stream_sends_init_then_fragments(mocker):
+    """
+    client receives hello, init segment and fragments in order
+    """
+    streamer = FMP4Streamer()
+    mocker.patch.object(streamer, 'start_stream', autospec=True)
+
+    process = MagicMock()
+    process.stdout = asyncio.StreamReader()
+    process.stdout.feed_data(INIT_SEGMENT + FRAGMENT)
+    process.returncode = None
+    process.wait = mocker.AsyncMock()
+    mocker.patch('asyncio.create_subprocess_exec', mocker.AsyncMock(return_value=process))
+
+    websocket = MagicMock()
+    websocket.send_text = mocker.AsyncMock()
+    websocket.send_bytes = mocker.AsyncMock()
+    rtsp_url = 'rtsp://fmp4_test'
+    streamer.add_client(rtsp_url, websocket)
+
+    task = asyncio.create_task(streamer.process_stream(rtsp_url))
+    # wait for the sender task instead of a fixed delay (a slow loop, ex. GC pause, must not fail the test)
+    for _ in range(100):
+        if websocket.send_bytes.await_count >= 2:
+            break
+        await asyncio.sleep(0.01)
+    # ffmpeg exits
+    process.stdout.feed_eof()
+    await task
+
+    hello = json.loads(websocket.send_text.await_args_list[0].args[0])
+    assert hello == {"format": "fmp4", "mimeType": 'video/mp4; codecs="avc1.4d001f"'}
+    sent = [call.args[0] for call in websocket.send_bytes.await_args_list]
+    assert sent[0] == INIT_SEGMENT
+    assert sent[1] == FRAGMENT
+    process.kill.assert_called_once()
+    assert rtsp_url not in streamer.streams
+    assert rtsp_url not in streamer.clients
+
+
+@pytest.mark.asyncio
+async def test_client_joining_while_remuxer_exits_starts_new_session(mocker):
+    """
+    client that joins while the ended ffmpeg is being reaped gets a new session instead of the dying one
+    """
+    streamer = FMP4Streamer()
+    start_stream = mocker.patch.object(streamer, 'start_stream', autospec=True)
+
+    exited = asyncio.Event()
+    process = MagicMock()
+    process.stdout = make_reader(b'')
+    process.returncode = None
+    process.wait = mocker.AsyncMock(side_effect=exited.wait)
+    mocker.patch('asyncio.create_subprocess_exec', mocker.AsyncMock(return_value=process))
+
+    rtsp_url = 'rtsp://fmp4_test'
+    streamer.add_client(rtsp_url, MagicMock())
+    start_stream.reset_mock()
+    task = asyncio.create_task(streamer.process_stream(rtsp_url))
+    await asyncio.sleep(0.01)
+
+    # ffmpeg ended, its exit is still awaited
+    late = MagicMock()
+    streamer.add_client(rtsp_url, late)
+    exited.set()
+    await task
+
+    start_stream.assert_called_once_with(rtsp_url)
+    assert streamer.clients[rtsp_url] == [late]
+    assert rtsp_url in streamer.outputs
+    streamer.remove_all_clients(rtsp_url)
+
+
+@pytest.mark.asyncio
+async def test_add_client_ignores_region_and_max_fps(mocker):
+    """
+    fMP4 passthrough accepts the client options of RTSPStreamer but neither crops nor caps the frame rate
+    """
+    streamer = FMP4Streamer()
+    mocker.patch.object(streamer, 'start_stream', autospec=True)
+    websocket = MagicMock()
+
+    key = streamer.add_client('rtsp://fmp4_test', websocket, max_fps=2)
+
+    assert key == 'rtsp://fmp4_test'
+    assert not streamer.client_fps
+    streamer.remove_all_clients(key)
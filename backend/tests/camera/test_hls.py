@@ -0,0 +1,157 @@
+"""
+tests for camera/tapo_320ws/hls module
+"""
+import asyncio
+import os
+from unittest.mock import MagicMock
+import pytest
+
+from app.camera.tapo_320ws.hls import (HLSManager, HLSSegmenter, SEGMENT_PATTERN, hls_ffmpeg_args, parse_playlist,
+                                       render_playlist)
+
+RING_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:40
+#EXT-X-PROGRAM-DATE-TIME:2024-01-01T12:00:00.000+0000
+#EXTINF:2.000000,
+segment_000040.ts
+#EXT-X-PROGRAM-DATE-TIME:2024-01-01T12:00:02.000+0000
+#EXTINF:2.000000,
+segment_000041.ts
+#EXT-X-PROGRAM-DATE-TIME:2024-01-01T12:00:04.000+0000
+#EXTINF:2.000000,
+segment_000042.ts
+"""
+# 2024-01-01T12:00:00Z
+RING_START = 1704110400.0
+
+
+@pytest.fixture
+def mock_ffmpeg(mocker):
+    """
+    mocks ffmpeg subprocess, returns the mocked process
+    """
+    process = MagicMock()
+    process.returncode = None
+    process.wait = mocker.AsyncMock()
+    create_subprocess = mocker.patch('asyncio.create_subprocess_exec', mocker.AsyncMock(return_value=process))
+    return create_subprocess
+
+
+def test_hls_ffmpeg_args_stream_copy(tmp_path):
+    """
+    segmenter never re-encodes and writes into the given directory
+    """
+    args = hls_ffmpeg_args('rtsp://hls_test', str(tmp_path))
+
+    assert args[args.index('-c:v') + 1] == 'copy'
+    assert args[-1] == os.path.join(str(tmp_path), 'index.m3u8')
+
+
+@pytest.mark.asyncio
+async def test_restarted_segmenter_uses_new_segment_names(tmp_path, mock_ffmpeg, mocker):
+    """
+    segment numbering starts at the current time -> a restart never reuses names clients may have cached
+    """
+    segmenter = HLSSegmenter('TestCam', 'rtsp://hls_test', str(tmp_path / 'TestCam'))
+    clock = mocker.patch('time.time', return_value=1700000000.5)
+    await segmenter.start()
+    clock.return_value = 1700000100.5
+    await segmenter.start()
+
+    start_numbers = [call.args[call.args.index('-start_number') + 1] for call in mock_ffmpeg.await_args_list]
+    assert start_numbers == ['1700000000', '1700000100']
+    assert SEGMENT_PATTERN.match('segment_1700000000.ts')
+
+
+@pytest.mark.asyncio
+async def test_segmenter_shared_between_viewers(tmp_path, mock_ffmpeg):
+    """
+    one ffmpeg per camera no matter how many viewers
+    """
+    manager = HLSManager(str(tmp_path))
+
+    first = await manager.get_segmenter('TestCam', 'rtsp://hls_test')
+    second = await manager.get_segmenter('TestCam', 'rtsp://hls_test')
+
+    assert first is second
+    assert mock_ffmpeg.await_count == 1
+    assert os.path.isdir(first.output_dir)
+
+    await manager.stop_all()
+    assert not os.path.isdir(first.output_dir)
+
+
+@pytest.mark.asyncio
+async def test_reap_idle_segmenter(tmp_path, mock_ffmpeg):
+    """
+    idle segmenter is stopped and its segments removed
+    """
+    manager = HLSManager(str(tmp_path), idle_timeout=0.01)
+    segmenter = await manager.get_segmenter('TestCam', 'rtsp://hls_test')
+
+    await manager.reaper_task
+
+    assert 'TestCam' not in manager.segmenters
+    segmenter.process.terminate.assert_called_once()
+    assert not os.path.isdir(segmenter.output_dir)
+
+
+def test_parse_playlist():
+    """
+    sequence numbers and wall clock times of ffmpeg segments
+    """
+    segments = parse_playlist(RING_PLAYLIST)
+
+    assert [segment.uri for segment in segments] == ['segment_000040.ts', 'segment_000041.ts', 'segment_000042.ts']
+    assert [segment.sequence for segment in segments] == [40, 41, 42]
+    assert segments[1].start_time == RING_START + 2
+    assert segments[2].duration == 2.0
+
+
+def test_render_playlist_roundtrip():
+    """
+    rendered playlist lists the same segments, timeshift playlist starts at its first segment
+    """
+    segments = parse_playlist(RING_PLAYLIST)
+
+    playlist = render_playlist(segments[1:], start_at_first=True)
+
+    assert '#EXT-X-MEDIA-SEQUENCE:41' in playlist
+    assert '#EXT-X-START:TIME-OFFSET=0,PRECISE=YES' in playlist
+    assert '#EXT-X-ENDLIST' not in playlist
+    assert parse_playlist(playlist) == segments[1:]
+
+
+def test_timeshift_playlist(tmp_path):
+    """
+    timeshift playlist starts at the segment containing the start time and ends at the live edge
+    """
+    segmenter = HLSSegmenter('TestCam', 'rtsp://hls_test', str(tmp_path))
+    (tmp_path / 'index.m3u8').write_text(RING_PLAYLIST)
+
+    from_middle = parse_playlist(segmenter.timeshift_playlist(RING_START + 3))
+    from_past = parse_playlist(segmenter.timeshift_playlist(RING_START - 600))
+    from_future = parse_playlist(segmenter.timeshift_playlist(RING_START + 600))
+
+    assert [segment.sequence for segment in from_middle] == [41, 42]
+    assert [segment.sequence for segment in from_past] == [40, 41, 42]
+    assert [segment.sequence for segment in from_future] == [42]
+    assert segmenter.buffered_seconds() == 6.0
+
+
+@pytest.mark.asyncio
+async def test_pinned_segmenter_not_reaped(tmp_path, mock_ffmpeg):
+    """
+    pinned (timeshift) segmenter keeps running without viewers and is restarted when ffmpeg exits
+    """
+    manager = HLSManager(str(tmp_path), idle_timeout=0.01)
+    segmenter = await manager.pin('TestCam', 'rtsp://hls_test')
+    segmenter.process.returncode = 1
+
+    await asyncio.sleep(0.05)
+
+    assert manager.segmenters['TestCam'] is segmenter
+    assert mock_ffmpeg.await_count >= 2
+    await manager.stop_all()
@@ -0,0 +1,35 @@
+"""
+tests for camera/tapo_320ws/mjpeg module
+"""
+import pytest
+
+from app.camera.tapo_320ws.mjpeg import MJPEGSink, mjpeg_stream, pack_mjpeg_part
+from app.camera.tapo_320ws.video_stream import RTSPStreamer, Frame, TRANSPORT_MJPEG
+
+
+def test_pack_mjpeg_part():
+    """
+    part carries boundary, content type and length
+    """
+    assert pack_mjpeg_part(b'jpeg') == (b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: 4\r\n\r\n'
+                                        b'jpeg\r\n')
+
+
+@pytest.mark.asyncio
+async def test_mjpeg_stream_shares_frames(mocker):
+    """
+    sink is a regular client of the streamer, closing the response removes it
+    """
+    streamer = RTSPStreamer()
+    mocker.patch.object(streamer, 'start_stream')
+    rtsp_url = 'rtsp://mjpeg_test'
+    streamer.latest_frames[rtsp_url] = Frame(b'jpeg', 1, 0.0)
+    sink = MJPEGSink()
+
+    key = streamer.add_client(rtsp_url, sink, TRANSPORT_MJPEG)
+    parts = mjpeg_stream(streamer, key, sink)
+
+    assert await parts.__anext__() == pack_mjpeg_part(b'jpeg')
+    await parts.aclose()
+    assert sink not in streamer.stream_clients
+    assert rtsp_url not in streamer.clients
@@ -0,0 +1,64 @@
+"""
+tests for camera/tapo_320ws/mosaic module
+"""
+import asyncio
+from unittest.mock import MagicMock
+import cv2
+import numpy as np
+import pytest
+
+from app.camera.tapo_320ws.mosaic import MosaicStreamer, MosaicLayout, compose_grid, default_columns
+from app.camera.tapo_320ws.video_stream import RTSPStreamer, Frame, TRANSPORT_BINARY, FRAME_HEADER, stream_key
+
+
+def test_compose_grid():
+    """
+    tiles are resized into their cell, missing tiles stay black
+    """
+    white = np.full((90, 160, 3), 255, dtype=np.uint8)
+
+    grid = compose_grid([white, None, white], 2, (80, 45))
+
+    assert grid.shape == (90, 160, 3)
+    assert grid[:45, :80].min() == 255
+    assert grid[:45, 80:].max() == 0
+    assert grid[45:, :80].min() == 255
+
+
+def test_default_columns():
+    """
+    most square grid
+    """
+    assert [default_columns(count) for count in (1, 2, 4, 5, 9, 10)] == [1, 2, 2, 3, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_mosaic_composed_from_thumbnails(mocker):
+    """
+    mosaic holds thumbnail outputs of its cameras while it has clients and releases them afterwards
+    """
+    source = RTSPStreamer()
+    mocker.patch.object(source, 'start_stream')
+    _, jpeg = cv2.imencode('.jpg', np.full((90, 160, 3), 255, dtype=np.uint8))
+    source.latest_frames[stream_key('rtsp://cam1', 'thumb')] = Frame(jpeg.tobytes(), 1, 0.0)
+    mosaic = MosaicStreamer(source)
+    layout = MosaicLayout((('cam1', 'rtsp://cam1'), ('cam2', 'rtsp://cam2')), 2, 160, 10)
+
+    websocket = MagicMock()
+    websocket.send_bytes = mocker.AsyncMock()
+    key = mosaic.add_layout_client(layout, websocket, TRANSPORT_BINARY)
+    await asyncio.sleep(0.1)
+
+    assert len(source.clients[stream_key('rtsp://cam1', 'thumb')]) == 1
+    # nobody else watches the cameras -> thumbnails are encoded at the mosaic rate only
+    assert source.get_stream_options('rtsp://cam1').target_fps == 10
+    payload = websocket.send_bytes.await_args.args[0]
+    grid = cv2.imdecode(np.frombuffer(payload[FRAME_HEADER.size:], dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert grid.shape == (90, 320, 3)
+    assert grid[:, :150].mean() > 200
+    assert grid[:, 170:].mean() < 50
+
+    mosaic.remove_client(key, websocket)
+    await asyncio.sleep(0.2)
+    assert stream_key('rtsp://cam1', 'thumb') not in source.clients
+    assert key not in mosaic.streams
@@ -0,0 +1,90 @@
+"""
+tests for camera/tapo_320ws/mpegts module
+"""
+from app.camera.tapo_320ws.mpegts import TSDurationTracker, parse_pts, PTS_CLOCK, PTS_WRAP, TS_PACKET_SIZE
+
+VIDEO_PID = 0x100
+AUDIO_PID = 0x101
+
+
+def encode_pts(pts: int) -> bytes:
+    """
+    Returns: 5-byte PTS field of a PES header
+    """
+    return bytes((
+        0x21 | ((pts >> 29) & 0x0E),
+        (pts >> 22) & 0xFF,
+        ((pts >> 14) & 0xFE) | 0x01,
+        (pts >> 7) & 0xFF,
+        ((pts << 1) & 0xFE) | 0x01,
+    ))
+
+
+def pes_packet(pid: int, pts: int, stream_id: int = 0xE0, adaptation: bytes = b'') -> bytes:
+    """
+    Returns: TS packet starting a PES with a PTS
+    """
+    control = 0x30 if adaptation else 0x10
+    header = bytes((0x47, 0x40 | (pid >> 8), pid & 0xFF, control))
+    if adaptation:
+        header += bytes((len(adaptation),)) + adaptation
+    pes = b'\x00\x00\x01' + bytes((stream_id,)) + b'\x00\x00\x80\x80\x05' + encode_pts(pts)
+    return (header + pes).ljust(TS_PACKET_SIZE, b'\xff')
+
+
+def continuation_packet(pid: int) -> bytes:
+    """
+    Returns: TS packet continuing a PES
+    """
+    return bytes((0x47, pid >> 8, pid & 0xFF, 0x10)).ljust(TS_PACKET_SIZE, b'\x00')
+
+
+def test_parse_pts():
+    """
+    PTS is decoded from the PES header, headers without PTS give None
+    """
+    pts = 123456789
+    assert parse_pts(b'\x00\x00\x01\xe0\x00\x00\x80\x80\x05' + encode_pts(pts)) == pts
+    assert parse_pts(b'\x00\x00\x01\xe0\x00\x00\x80\x00\x00' + b'\x00' * 5) is None
+    assert parse_pts(b'\x00\x00\x02') is None
+
+
+def test_duration_of_video_frames():
+    """
+    Duration spans the video frames (including the last one), audio and continuation packets are ignored
+    """
+    tracker = TSDurationTracker()
+    frame = PTS_CLOCK // 15
+    stream = b''
+    for index in range(31):
+        stream += pes_packet(VIDEO_PID, 1000 + index * frame, adaptation=b'\x10' if index % 15 == 0 else b'')
+        stream += continuation_packet(VIDEO_PID)
+        stream += pes_packet(AUDIO_PID, 999999 + index, stream_id=0xC0)
+
+    tracker.feed(stream)
+
+    assert tracker.video_pid == VIDEO_PID
+    assert tracker.duration == 31 * frame / PTS_CLOCK
+
+
+def test_chunks_split_packets():
+    """
+    Packets split between chunks and garbage before the first sync byte are handled
+    """
+    stream = b'\x00\x01' + b''.join(pes_packet(VIDEO_PID, index * 9000) for index in range(11))
+    tracker = TSDurationTracker()
+    for offset in range(0, len(stream), 100):
+        tracker.feed(stream[offset:offset + 100])
+
+    assert tracker.duration == 1.1
+
+
+def test_pts_wrap_and_reordering():
+    """
+    PTS wrapping around and B-frames (older PTS) do not break the timeline
+    """
+    tracker = TSDurationTracker()
+    for pts in (PTS_WRAP - 9000, PTS_WRAP - 3000, PTS_WRAP - 6000, 3000, 9000):
+        tracker.feed(pes_packet(VIDEO_PID, pts))
+
+    assert tracker.duration == 24000 / PTS_CLOCK
@@ -0,0 +1,103 @@
+"""
+tests for camera/tapo_320ws/nvr module
+"""
+import asyncio
+import os
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+import pytest
+
+from app.camera.tapo_320ws.nvr import (NVRRecorder, RecordingIndex, nvr_ffmpeg_args, parse_segment_line,
+                                       segment_start_time)
+from app.database.sqlite_interface import SqliteInterface
+
+# conftest disables SqliteInterface.__init__, the index is tested on a temporary database
+SQLITE_INIT = SqliteInterface.__init__
+
+
+@pytest.fixture
+def index(tmp_path):
+    """
+    recording index on a temporary database
+    """
+    with patch.object(SqliteInterface, "__init__", SQLITE_INIT):
+        yield RecordingIndex(str(tmp_path / 'nvr.db'))
+
+
+def test_nvr_ffmpeg_args_stream_copy(tmp_path):
+    """
+    recorder never re-encodes and reports finished segments on stdout
+    """
+    args = nvr_ffmpeg_args('rtsp://nvr_test', str(tmp_path), 60, 'ts')
+
+    assert args[args.index('-c:v') + 1] == 'copy'
+    assert args[args.index('-segment_time') + 1] == '60'
+    assert args[args.index('-segment_list') + 1] == 'pipe:1'
+    assert args[-1] == os.path.join(str(tmp_path), '%Y-%m-%d_%H-%M-%S.ts')
+
+
+def test_parse_segment_line():
+    """
+    segment list CSV lines of ffmpeg
+    """
+    assert parse_segment_line('2024-01-01_12-00-00.mp4,0.000000,300.040000\n') == ('2024-01-01_12-00-00.mp4',
+                                                                                   pytest.approx(300.04))
+    assert parse_segment_line('garbage') is None
+    assert segment_start_time('2024-01-01_12-00-00.mp4') == datetime(2024, 1, 1, 12).timestamp()
+
+
+def test_recording_index(index):
+    """
+    segments are found by overlapping time range and pruned by age
+    """
+    first = index.add('TestCam', 1000.0, 1300.0, '/nvr/TestCam/a.mp4')
+    index.add('TestCam', 1300.0, 1600.0, '/nvr/TestCam/b.mp4')
+    index.add('TestCam2', 1000.0, 1300.0, '/nvr/TestCam2/a.mp4')
+
+    assert [segment['path'] for segment in index.find('TestCam', 1250.0, 1400.0)] == ['/nvr/TestCam/a.mp4',
+                                                                                      '/nvr/TestCam/b.mp4']
+    assert index.get(first)['end_time'] == 1300.0
+    assert sorted(index.prune(1500.0)) == ['/nvr/TestCam/a.mp4', '/nvr/TestCam2/a.mp4']
+    assert [segment['path'] for segment in index.find('TestCam', 0.0, 2000.0)] == ['/nvr/TestCam/b.mp4']
+
+
+def test_on_segment_indexes_and_applies_retention(tmp_path):
+    """
+    finished segment is indexed with its wall clock range, expired segments are deleted from disk
+    """
+    index = MagicMock()
+    expired = tmp_path / 'old.mp4'
+    expired.write_bytes(b'mp4')
+    index.prune.return_value = [str(expired)]
+    recorder = NVRRecorder(index, str(tmp_path), retention_days=1)
+
+    recorder.on_segment('TestCam', str(tmp_path), '2024-01-01_12-00-00.mp4,0.0,300.0\n')
+
+    start = datetime(2024, 1, 1, 12).timestamp()
+    index.add.assert_called_once_with('TestCam', start, start + 300.0,
+                                      os.path.join(str(tmp_path), '2024-01-01_12-00-00.mp4'))
+    assert not expired.exists()
+
+
+@pytest.mark.asyncio
+async def test_recorder_restarts_ffmpeg(mocker, tmp_path):
+    """
+    recorder is restarted when ffmpeg exits and stopped on shutdown
+    """
+    process = MagicMock()
+    process.returncode = 1
+    process.stdout = mocker.MagicMock()
+    process.stdout.__aiter__.return_value = [b'2024-01-01_12-00-00.mp4,0.0,300.0\n']
+    create_subprocess = mocker.patch('asyncio.create_subprocess_exec', mocker.AsyncMock(return_value=process))
+    mocker.patch('app.camera.tapo_320ws.nvr.backoff_delay', return_value=0.01)
+    index = MagicMock()
+    index.prune.return_value = []
+    recorder = NVRRecorder(index, str(tmp_path))
+
+    recorder.start('TestCam', 'rtsp://nvr_test')
+    await asyncio.sleep(0.05)
+    await recorder.stop_all()
+
+    assert create_subprocess.await_count >= 2
+    assert index.add.call_count == create_subprocess.await_count
+    assert recorder.tasks == {}
@@ -0,0 +1,98 @@
+"""
+tests for camera/tapo_320ws/scheduler module
+"""
+from unittest.mock import MagicMock
+import pytest
+
+from app.camera.tapo_320ws.scheduler import FrameBudgetScheduler, StreamDemand, allocate
+from app.camera.tapo_320ws.video_stream import RTSPStreamer, StreamOptions
+
+
+def test_allocate_within_budget():
+    """
+    streams within the budget keep their frame rate
+    """
+    demands = [StreamDemand('rtsp://a', 1, 1, 25, 0.01), StreamDemand('rtsp://b', 1, 1, 25, 0.01)]
+
+    assert allocate(demands, 1.0) == {'rtsp://a': 25, 'rtsp://b': 25}
+
+
+def test_allocate_low_priority_first():
+    """
+    lowest priority is slowed down first (to the minimum), then the next one
+    """
+    demands = [
+        StreamDemand('rtsp://high', 2, 1, 20, 0.02),
+        StreamDemand('rtsp://low', 0, 5, 20, 0.02),
+        StreamDemand('rtsp://normal', 1, 1, 20, 0.02),
+    ]
+
+    # needs 1.2 cores: low gives up 0.38 (down to 1 fps), normal the remaining 0.12 (6 fps)
+    rates = allocate(demands, 0.7, min_fps=1)
+
+    assert rates['rtsp://high'] == 20
+    assert rates['rtsp://low'] == pytest.approx(1)
+    assert rates['rtsp://normal'] == pytest.approx(14)
+
+
+def test_allocate_fewer_viewers_first():
+    """
+    with equal priority the stream with fewer viewers is slowed down first
+    """
+    demands = [StreamDemand('rtsp://popular', 1, 4, 10, 0.1), StreamDemand('rtsp://lonely', 1, 1, 10, 0.1)]
+
+    rates = allocate(demands, 1.5, min_fps=1)
+
+    assert rates == {'rtsp://popular': 10, 'rtsp://lonely': pytest.approx(5)}
+
+
+@pytest.mark.asyncio
+async def test_schedule_sets_and_clears_limits(mocker):
+    """
+    scheduler caps saturated streams through fps limits and removes the cap when the budget allows it again
+    """
+    streamer = RTSPStreamer()
+    mocker.patch.object(streamer, 'start_stream')
+    for name in ('Gate', 'Garden'):
+        rtsp_url = f'rtsp://{name}'
+        streamer.add_client(rtsp_url, MagicMock(), camera_name=name)
+        metrics = streamer.get_capture_metrics(rtsp_url)
+        # camera delivers 10 fps
+        metrics.grab_times.extend([0.0, 0.1, 0.2])
+        metrics.decode_durations.append(0.04)
+        metrics.encode_durations.append(0.01)
+    scheduler = FrameBudgetScheduler(streamer, budget=0.6, min_fps=1, priorities={'Gate': 2})
+
+    limits = scheduler.schedule()
+
+    # both run at 10 fps * 0.05 s = 0.5 cores each, Garden (default priority) gives up 0.4 cores
+    assert list(limits) == ['rtsp://Garden']
+    assert limits['rtsp://Garden'] == pytest.approx(2)
+    assert streamer.get_stream_options('rtsp://Garden').target_fps == pytest.approx(2)
+    assert streamer.get_stream_options('rtsp://Gate').target_fps == StreamOptions().target_fps
+
+    scheduler.budget = 2.0
+    assert scheduler.schedule() == {}
+    assert streamer.fps_limits == {}
+
+
+@pytest.mark.asyncio
+async def test_demand_capped_by_clients(mocker):
+    """
+    stream watched only by capped clients (ex. mosaic tiles) demands their rate, not the camera rate
+    """
+    streamer = RTSPStreamer()
+    mocker.patch.object(streamer, 'start_stream')
+    rtsp_url = 'rtsp://Mosaic'
+    streamer.add_client(rtsp_url, MagicMock(), camera_name='Mosaic', max_fps=2)
+    metrics = streamer.get_capture_metrics(rtsp_url)
+    # camera delivers 10 fps
+    metrics.grab_times.extend([0.0, 0.1, 0.2])
+    metrics.decode_durations.append(0.1)
+    streamer.set_fps_limit(rtsp_url, 1)
+    scheduler = FrameBudgetScheduler(streamer, budget=1.0, min_fps=1)
+
+    assert [demand.fps for demand in scheduler.get_demands()] == [pytest.approx(2)]
+    # 2 fps * 0.1 s fit in the budget -> no limit
+    assert scheduler.schedule() == {}
+    assert streamer.fps_limits == {}
@@ -0,0 +1,79 @@
+"""
+tests for camera/tapo_320ws/snapshot module
+"""
+import asyncio
+import numpy as np
+import pytest
+
+from app.camera.tapo_320ws.snapshot import SnapshotCache, borrow_session_frame, capture_snapshot
+from app.camera.tapo_320ws.video_stream import RTSPStreamer, Frame, QUALITY_THUMB, stream_key
+
+
+def test_capture_snapshot_skips_undecodable_frames(mocker):
+    """
+    first decodable frame is encoded and the capture is released
+    """
+    cap = mocker.MagicMock()
+    cap.isOpened.return_value = True
+    cap.read.side_effect = [(False, None), (True, np.zeros((360, 640, 3), dtype=np.uint8))]
+    mocker.patch('cv2.VideoCapture', return_value=cap)
+
+    frame = capture_snapshot('rtsp://snapshot_test', 320)
+
+    assert frame.data[:2] == b'\xff\xd8'
+    assert cap.read.call_count == 2
+    cap.release.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_cache_single_capture(mocker):
+    """
+    concurrent misses share one capture and later hits are served from cache
+    """
+    capture = mocker.patch('app.camera.tapo_320ws.snapshot.capture_snapshot',
+                           return_value=Frame(b'jpeg', 0, 0.0))
+    cache = SnapshotCache(ttl=60)
+
+    frames = await asyncio.gather(*[cache.get('key', 'rtsp://snapshot_test') for _ in range(3)])
+    frames.append(await cache.get('key', 'rtsp://snapshot_test'))
+
+    assert all(frame.data == b'jpeg' for frame in frames)
+    capture.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_cache_expired(mocker):
+    """
+    expired entries are captured again
+    """
+    capture = mocker.patch('app.camera.tapo_320ws.snapshot.capture_snapshot',
+                           return_value=Frame(b'jpeg', 0, 0.0))
+    cache = SnapshotCache(ttl=-1)
+
+    await cache.get('key', 'rtsp://snapshot_test')
+    await cache.get('key', 'rtsp://snapshot_test')
+
+    assert capture.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_borrow_session_frame(mocker):
+    """
+    open session without clients delivers a frame to a temporary client, closed sessions are not opened
+    """
+    streamer = RTSPStreamer()
+    mocker.patch.object(streamer, 'start_stream')
+    rtsp_url = 'rtsp://warm_snapshot_test'
+    key = stream_key(rtsp_url, QUALITY_THUMB)
+
+    assert await borrow_session_frame(streamer, rtsp_url, QUALITY_THUMB, timeout=0.01) is None
+    streamer.start_stream.assert_not_called()
+
+    # warm session: the capture encodes a frame once the output has a client
+    streamer.streams[rtsp_url] = None
+    asyncio.get_event_loop().call_later(0.01, streamer.enqueue_frame, key, Frame(b'warm', 1, 1.0))
+    frame = await borrow_session_frame(streamer, rtsp_url, QUALITY_THUMB, 'TestCam', timeout=1)
+
+    assert frame.data == b'warm'
+    assert key not in streamer.clients
+    assert await borrow_session_frame(streamer, rtsp_url, QUALITY_THUMB, timeout=0.01) is None
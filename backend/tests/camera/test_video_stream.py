@@ -5,8 +5,13 @@ import asyncio
 from unittest.mock import MagicMock
 import numpy as np
 import pytest
+from fastapi.websockets import WebSocketDisconnect
 
-from app.camera.tapo_320ws.video_stream import RTSPStreamer
+from app.camera.tapo_320ws.video_stream import (RTSPStreamer, Frame, FRAME_HEADER, FRAME_HEADER_VERSION,
+                                                TRANSPORT_BINARY, CLIENT_QUEUE_SIZE, get_camera_id, pack_frame,
+                                                put_latest, stream_key, resize_to_width, QUALITY_HIGH,
+                                                QUALITY_THUMB, QUALITY_WIDTHS, backoff_delay, Region, parse_region,
+                                                shape_frame)
 
 
 @pytest.mark.asyncio
@@ -84,35 +89,121 @@ class TestRTSPStreamer:
         assert ws2 in rtsp_streamer.clients[rtsp_url]
 
     @pytest.mark.asyncio
-    async def test_send_to_clients_success(self, rtsp_streamer, mock_websocket):
+    async def test_send_to_clients_success(self, rtsp_streamer, mock_websocket, mocker):
         """
         test _send_to_clients sends data to each client and doesnt remove them if successful
         """
+        mocker.patch.object(rtsp_streamer, 'start_stream', autospec=True)
         rtsp_url = 'rtsp://send_test'
-        rtsp_streamer.clients[rtsp_url] = [mock_websocket]
+        rtsp_streamer.add_client(rtsp_url, mock_websocket)
 
         # sample fake bytes
-        frame_bytes = b'\xff\xff\xff\xff'
-        await rtsp_streamer.send_to_clients(rtsp_url, frame_bytes)
+        frame = Frame(b'\xff\xff\xff\xff', 1, 0.0)
+        await rtsp_streamer.send_to_clients(rtsp_url, frame)
+        await asyncio.sleep(0.01)
 
         assert mock_websocket.send_text.await_count == 1
+        assert mock_websocket.send_text.await_args.args[0] == 'data:image/jpeg;base64,/////w=='
         assert rtsp_url in rtsp_streamer.clients
 
+    @pytest.mark.asyncio
+    async def test_send_to_clients_binary(self, rtsp_streamer, mocker):
+        """
+        binary clients receive header + raw JPEG bytes via send_bytes
+        """
+        mocker.patch.object(rtsp_streamer, 'start_stream', autospec=True)
+        websocket = MagicMock()
+        websocket.send_bytes = mocker.AsyncMock()
+        rtsp_url = 'rtsp://send_binary'
+        rtsp_streamer.add_client(rtsp_url, websocket, TRANSPORT_BINARY, 'TestCam')
+
+        frame = Frame(b'\xff\xd8\xff\xd9', 7, 1735225375.123)
+        await rtsp_streamer.send_to_clients(rtsp_url, frame)
+        await asyncio.sleep(0.01)
+
+        payload = websocket.send_bytes.await_args.args[0]
+        version, sequence, timestamp_ms, camera_id = FRAME_HEADER.unpack(payload[:FRAME_HEADER.size])
+        assert version == FRAME_HEADER_VERSION
+        assert sequence == 7
+        assert timestamp_ms == 1735225375123
+        assert camera_id == get_camera_id('TestCam')
+        assert payload[FRAME_HEADER.size:] == frame.data
+
+    @pytest.mark.asyncio
+    async def test_pack_frame_wraps_sequence(self):
+        """
+        sequence numbers wrap around to fit into u32
+        """
+        payload = pack_frame(Frame(b'', 2 ** 32 + 5, 0.0), 1)
+
+        assert len(payload) == FRAME_HEADER.size
+        assert FRAME_HEADER.unpack(payload)[1] == 5
+
     @pytest.mark.asyncio
     async def test_send_to_clients_failure_remove_client(self, rtsp_streamer, mocker):
         """
         if client fails to receive a message -> remove the client
         """
+        mocker.patch.object(rtsp_streamer, 'start_stream', autospec=True)
         failing_ws = MagicMock()
         failing_ws.send_text = mocker.AsyncMock(side_effect=RuntimeError("Fail sending"))
         rtsp_url = 'rtsp://send_fail'
-        rtsp_streamer.clients[rtsp_url] = [failing_ws]
+        rtsp_streamer.add_client(rtsp_url, failing_ws)
 
         # sample fake bytes
-        frame_bytes = b'\xff\xff\xff\xff'
-        await rtsp_streamer.send_to_clients(rtsp_url, frame_bytes)
+        frame = Frame(b'\xff\xff\xff\xff', 1, 0.0)
+        await rtsp_streamer.send_to_clients(rtsp_url, frame)
+        await asyncio.sleep(0.01)
 
         assert failing_ws not in rtsp_streamer.clients.get(rtsp_url, [])
+        assert failing_ws not in rtsp_streamer.stream_clients
+
+    @pytest.mark.asyncio
+    async def test_slow_client_does_not_block_others(self, rtsp_streamer, mocker):
+        """
+        a stalled client only drops its own frames, other clients still receive every frame
+        """
+        mocker.patch.object(rtsp_streamer, 'start_stream', autospec=True)
+        rtsp_url = 'rtsp://slow_test'
+        stalled = asyncio.Event()
+
+        async def stall(_):
+            """
+            helper function - send that never finishes until released
+            """
+            await stalled.wait()
+
+        slow_ws = MagicMock()
+        slow_ws.send_text = mocker.AsyncMock(side_effect=stall)
+        fast_ws = MagicMock()
+        fast_ws.send_text = mocker.AsyncMock()
+        rtsp_streamer.add_client(rtsp_url, slow_ws)
+        rtsp_streamer.add_client(rtsp_url, fast_ws)
+
+        for sequence in range(1, 6):
+            await rtsp_streamer.send_to_clients(rtsp_url, Frame(bytes([sequence]), sequence, 0.0))
+            await asyncio.sleep(0.01)
+
+        assert fast_ws.send_text.await_count == 5
+        assert slow_ws.send_text.await_count == 1
+        slow_client = rtsp_streamer.stream_clients[slow_ws]
+        assert len(slow_client.pending) == CLIENT_QUEUE_SIZE
+        assert slow_client.dropped_frames == 4 - CLIENT_QUEUE_SIZE
+
+        stalled.set()
+        rtsp_streamer.remove_all_clients(rtsp_url)
+
+    @pytest.mark.asyncio
+    async def test_put_latest_drops_oldest(self):
+        """
+        full bounded queue drops the oldest item instead of blocking
+        """
+        queue = asyncio.Queue(maxsize=2)
+        for item in range(3):
+            put_latest(queue, item)
+
+        assert queue.get_nowait() == 1
+        assert queue.get_nowait() == 2
 
     @pytest.mark.asyncio
     async def test_process_stream_stops_when_no_clients(self, rtsp_streamer, mocker):
@@ -127,8 +218,8 @@ class TestRTSPStreamer:
         ws.send_text = mocker.AsyncMock()
         rtsp_streamer.clients[rtsp_url] = [ws]
 
-        await queue.put(b'frame1')
-        await queue.put(b'frame2')
+        await queue.put(Frame(b'frame1', 1, 0.0))
+        await queue.put(Frame(b'frame2', 2, 0.0))
 
         original_send_to_clients = rtsp_streamer.send_to_clients
 
@@ -153,28 +244,392 @@ class TestRTSPStreamer:
         assert task.done() is True
 
     @pytest.mark.asyncio
-    async def test_start_stream_capture_read(self, rtsp_streamer, mocker):
+    async def test_start_stream_capture_read(self, rtsp_streamer, mock_websocket, mocker):
         """
-        test start_stream opens new VideoCapture, reads frames, and pushes them to the queue
+        test start_stream opens new VideoCapture, reads frames once and encodes them once per quality tier
         """
         rtsp_url = 'rtsp://start_test'
         mock_capture = MagicMock()
         mock_capture.isOpened.return_value = True
 
         # mock video
-        mock_capture.read.side_effect = [
+        mock_capture.grab.side_effect = [True, True, False]
+        mock_capture.retrieve.side_effect = [
             (True, np.zeros((640, 640, 3), dtype=np.uint8)),
             (True, np.ones((640, 640, 3), dtype=np.uint8) * 255),
-            (False, None)
         ]
 
         mocker.patch('cv2.VideoCapture', return_value=mock_capture)
+        mock_imencode = mocker.patch('cv2.imencode', return_value=(True, np.frombuffer(b'jpeg', dtype=np.uint8)))
 
-        rtsp_streamer.clients[rtsp_url] = ['test_websocket']
+        thumb_websocket = MagicMock()
+        thumb_websocket.send_text = mocker.AsyncMock()
+        # register both tiers before the capture thread runs, stream ends without reconnecting
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        mocker.patch.object(rtsp_streamer, 'reconnect_delay', return_value=None)
+        rtsp_streamer.add_client(rtsp_url, mock_websocket)
+        thumb_key = rtsp_streamer.add_client(rtsp_url, thumb_websocket, quality=QUALITY_THUMB)
 
-        rtsp_streamer.start_stream(rtsp_url)
+        RTSPStreamer.start_stream(rtsp_streamer, rtsp_url)
 
         await asyncio.sleep(0.2)
 
+        assert mock_capture.grab.call_count == 3
+        assert mock_imencode.call_count == 4
+        encoded_widths = sorted(call.args[1].shape[1] for call in mock_imencode.call_args_list)
+        assert encoded_widths == [QUALITY_WIDTHS[QUALITY_THUMB]] * 2 + [640] * 2
         assert rtsp_url not in rtsp_streamer.streams
         assert rtsp_url not in rtsp_streamer.queues
+        assert thumb_key not in rtsp_streamer.queues
+
+    @pytest.mark.asyncio
+    async def test_stream_key_per_tier(self):
+        """
+        native resolution tiers are keyed by their RTSP URL, downscaled tiers get their own key
+        """
+        assert stream_key('rtsp://cam/stream1', QUALITY_HIGH) == 'rtsp://cam/stream1'
+        assert stream_key('rtsp://cam/stream2', QUALITY_THUMB) == 'rtsp://cam/stream2#thumb'
+
+    @pytest.mark.asyncio
+    async def test_resize_to_width(self):
+        """
+        frames are downscaled keeping aspect ratio and never upscaled
+        """
+        image = np.zeros((720, 1280, 3), dtype=np.uint8)
+
+        assert resize_to_width(image, 320).shape == (180, 320, 3)
+        assert resize_to_width(image, None) is image
+        assert resize_to_width(image, 1920) is image
+
+    @pytest.mark.asyncio
+    async def test_region_crop(self):
+        """
+        regions are parsed from fractions, keyed canonically and cropped from the frame
+        """
+        image = np.zeros((720, 1280, 3), dtype=np.uint8)
+        region = parse_region('0.5,0.25,0.5,0.5', 320)
+
+        assert region == Region(0.5, 0.25, 0.5, 0.5, 320)
+        assert stream_key('rtsp://cam/stream1', QUALITY_HIGH, region) == 'rtsp://cam/stream1#roi:0.5,0.25,0.5,0.5@320'
+        assert shape_frame(image, Region(0.5, 0.25, 0.5, 0.5)).shape == (360, 640, 3)
+        assert shape_frame(image, region).shape == (180, 320, 3)
+        assert shape_frame(image, 320).shape == (180, 320, 3)
+        with pytest.raises(ValueError):
+            parse_region('0.5,0.5,0.6,0.5')
+        with pytest.raises(ValueError):
+            parse_region('unknown_region')
+
+    @pytest.mark.asyncio
+    async def test_region_output_shared(self, rtsp_streamer, mock_websocket, mocker):
+        """
+        clients of the same region share one output next to the full frame output
+        """
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        other_websocket = MagicMock()
+        region = Region(0, 0, 0.5, 0.5)
+
+        rtsp_streamer.add_client('rtsp://roi_test', MagicMock())
+        first = rtsp_streamer.add_client('rtsp://roi_test', mock_websocket, region=region)
+        second = rtsp_streamer.add_client('rtsp://roi_test', other_websocket, region=parse_region('0,0,0.5,0.5'))
+
+        assert first == second
+        assert dict(rtsp_streamer.active_outputs('rtsp://roi_test')) == {'rtsp://roi_test': None, first: region}
+        assert len(rtsp_streamer.clients[first]) == 2
+
+    @pytest.mark.asyncio
+    async def test_fps_limit_caps_requested_options(self, rtsp_streamer):
+        """
+        fps limit caps the effective frame rate and keeps the requested options
+        """
+        rtsp_streamer.set_stream_options('rtsp://limit_test', target_fps=10)
+        rtsp_streamer.set_fps_limit('rtsp://limit_test', 4)
+
+        assert rtsp_streamer.get_stream_options('rtsp://limit_test').target_fps == 4
+        assert rtsp_streamer.set_stream_options('rtsp://limit_test', change_threshold=2).target_fps == 10
+
+        rtsp_streamer.set_fps_limit('rtsp://limit_test', None)
+        assert rtsp_streamer.get_stream_options('rtsp://limit_test').target_fps == 10
+        rtsp_streamer.set_fps_limit('rtsp://native_test', 5)
+        assert rtsp_streamer.get_stream_options('rtsp://native_test').target_fps == 5
+
+    @pytest.mark.asyncio
+    async def test_client_fps_caps_stream_only_if_all_clients_capped(self, rtsp_streamer, mocker):
+        """
+        capture runs at the highest rate its capped clients need, an uncapped client gets the full rate
+        """
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        rtsp_url = 'rtsp://client_fps_test'
+        slow, faster, viewer = MagicMock(), MagicMock(), MagicMock()
+
+        rtsp_streamer.add_client(rtsp_url, slow, TRANSPORT_BINARY, quality=QUALITY_THUMB, max_fps=2)
+        rtsp_streamer.add_client(rtsp_url, faster, TRANSPORT_BINARY, quality=QUALITY_THUMB, max_fps=5)
+        assert rtsp_streamer.get_stream_options(rtsp_url).target_fps == 5
+
+        viewer_key = rtsp_streamer.add_client(rtsp_url, viewer)
+        assert rtsp_streamer.get_stream_options(rtsp_url).target_fps == 0
+
+        rtsp_streamer.remove_client(viewer_key, viewer)
+        rtsp_streamer.set_fps_limit(rtsp_url, 1)
+        assert rtsp_streamer.get_stream_options(rtsp_url).target_fps == 1
+        rtsp_streamer.remove_all_clients(stream_key(rtsp_url, QUALITY_THUMB))
+        assert not rtsp_streamer.client_fps
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_removes_silent_client(self, rtsp_streamer, mock_websocket, mocker):
+        """
+        heartbeat client gets pings and is removed when it does not answer within the timeout
+        """
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        rtsp_streamer.ping_interval = 0.02
+        rtsp_streamer.ping_timeout = 0.1
+        never = asyncio.Event()
+        mock_websocket.receive_text = mocker.AsyncMock(side_effect=never.wait)
+        key = rtsp_streamer.add_client('rtsp://heartbeat_test', mock_websocket)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await rtsp_streamer.watch_client(key, mock_websocket, heartbeat=True)
+
+        pings = [call.args[0] for call in mock_websocket.send_text.call_args_list]
+        assert pings and all('"ping"' in ping for ping in pings)
+        assert mock_websocket not in rtsp_streamer.clients.get(key, [])
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_answering_client_stays(self, rtsp_streamer, mock_websocket, mocker):
+        """
+        client answering the pings is kept until it disconnects
+        """
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        rtsp_streamer.ping_interval = 0.05
+        rtsp_streamer.ping_timeout = 0.1
+        replies = ['{"type": "pong"}'] * 5
+
+        async def receive():
+            await asyncio.sleep(0.03)
+            if not replies:
+                raise WebSocketDisconnect()
+            return replies.pop()
+
+        mock_websocket.receive_text = receive
+        key = rtsp_streamer.add_client('rtsp://heartbeat_test', mock_websocket)
+
+        with pytest.raises(WebSocketDisconnect):
+            await rtsp_streamer.watch_client(key, mock_websocket, heartbeat=True)
+
+        assert not replies
+        assert mock_websocket not in rtsp_streamer.clients.get(key, [])
+
+    @pytest.mark.asyncio
+    async def test_send_timeout_removes_client(self, rtsp_streamer, mock_websocket, mocker):
+        """
+        client whose send blocks (half-open connection) is removed after the send timeout
+        """
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        rtsp_streamer.send_timeout = 0.05
+        async def blocked_send(_):
+            await asyncio.Event().wait()
+
+        mock_websocket.send_text = blocked_send
+        key = rtsp_streamer.add_client('rtsp://send_timeout_test', mock_websocket)
+
+        await rtsp_streamer.send_to_clients(key, Frame(b'jpeg', 1, 0.0))
+        await asyncio.sleep(0.15)
+
+        assert mock_websocket not in rtsp_streamer.clients.get(key, [])
+
+    @pytest.fixture
+    async def capture_streamer(self, rtsp_streamer, mock_websocket, mocker):
+        """
+        returns (streamer, capture mock, imencode mock) with one client registered on rtsp://capture_test
+        """
+        mock_capture = MagicMock()
+        mock_capture.isOpened.return_value = True
+        mocker.patch('cv2.VideoCapture', return_value=mock_capture)
+        mock_imencode = mocker.patch('cv2.imencode', return_value=(True, np.frombuffer(b'jpeg', dtype=np.uint8)))
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        # capture ends with the mocked frames
+        mocker.patch.object(rtsp_streamer, 'reconnect_delay', return_value=None)
+        rtsp_streamer.add_client('rtsp://capture_test', mock_websocket)
+        return rtsp_streamer, mock_capture, mock_imencode
+
+    @pytest.mark.asyncio
+    async def test_target_fps_skips_retrieve(self, capture_streamer, mocker):
+        """
+        frames above the target FPS are grabbed but never decoded or encoded
+        """
+        rtsp_streamer, mock_capture, mock_imencode = capture_streamer
+        # camera delivers 16 fps -> clock advances with every grabbed frame
+        mock_time = mocker.patch('app.camera.tapo_320ws.video_stream.time')
+        mock_time.monotonic.side_effect = lambda: mock_capture.grab.call_count * 0.0625
+        mock_time.time.return_value = 0.0
+        mock_capture.grab.side_effect = [True] * 24 + [False]
+        mock_capture.retrieve.return_value = (True, np.zeros((64, 64, 3), dtype=np.uint8))
+        rtsp_streamer.set_stream_options('rtsp://capture_test', target_fps=4)
+
+        RTSPStreamer.start_stream(rtsp_streamer, 'rtsp://capture_test')
+        await asyncio.sleep(0.2)
+
+        assert mock_capture.grab.call_count == 25
+        # frames 1, 4, 8, ..., 24 (every 0.25 s of 1.5 s)
+        assert mock_capture.retrieve.call_count == 7
+        assert mock_imencode.call_count == 7
+
+    @pytest.mark.asyncio
+    async def test_unchanged_frames_not_encoded(self, capture_streamer):
+        """
+        change detector skips encoding of frames identical to the last encoded one
+        """
+        rtsp_streamer, mock_capture, mock_imencode = capture_streamer
+        static = np.zeros((64, 64, 3), dtype=np.uint8)
+        moved = np.ones((64, 64, 3), dtype=np.uint8) * 255
+        mock_capture.grab.side_effect = [True] * 4 + [False]
+        mock_capture.retrieve.side_effect = [(True, static), (True, static), (True, static), (True, moved)]
+        rtsp_streamer.set_stream_options('rtsp://capture_test', change_threshold=2)
+
+        RTSPStreamer.start_stream(rtsp_streamer, 'rtsp://capture_test')
+        await asyncio.sleep(0.2)
+
+        assert mock_capture.retrieve.call_count == 4
+        assert mock_imencode.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_late_joiner_gets_latest_frame(self, rtsp_streamer, mocker):
+        """
+        new client immediately receives the last frame of a running output
+        """
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        first = MagicMock()
+        first.send_text = mocker.AsyncMock()
+        rtsp_url = 'rtsp://late_test'
+        rtsp_streamer.add_client(rtsp_url, first)
+        await rtsp_streamer.send_to_clients(rtsp_url, Frame(b'\xff\xff\xff\xff', 1, 0.0))
+
+        late = MagicMock()
+        late.send_text = mocker.AsyncMock()
+        rtsp_streamer.add_client(rtsp_url, late)
+        await asyncio.sleep(0.01)
+
+        assert late.send_text.await_args.args[0] == 'data:image/jpeg;base64,/////w=='
+        rtsp_streamer.remove_all_clients(rtsp_url)
+
+    @pytest.mark.asyncio
+    async def test_idle_capture_kept_open_for_grace_period(self, capture_streamer, mock_websocket):
+        """
+        after the last client left the capture keeps grabbing (without decoding) until the grace period ends
+        """
+        rtsp_streamer, mock_capture, _ = capture_streamer
+        rtsp_streamer.idle_grace = 0.1
+        rtsp_streamer.remove_client('rtsp://capture_test', mock_websocket)
+        mock_capture.grab.return_value = True
+
+        RTSPStreamer.start_stream(rtsp_streamer, 'rtsp://capture_test')
+        await asyncio.sleep(0.05)
+        assert rtsp_streamer.streams['rtsp://capture_test'] is mock_capture
+        assert 'rtsp://capture_test' in rtsp_streamer.open_latencies
+
+        await asyncio.sleep(0.2)
+        assert 'rtsp://capture_test' not in rtsp_streamer.streams
+        mock_capture.retrieve.assert_not_called()
+        mock_capture.release.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_client_joining_idle_shutdown_restarts_capture(self, rtsp_streamer, mock_websocket, mocker):
+        """
+        client that joined while the idle capture was closing reuses its output and the capture is restarted
+        """
+        rtsp_url = 'rtsp://late_join_test'
+        mock_start_stream = mocker.patch.object(rtsp_streamer, 'start_stream')
+        # capture thread already decided to close, its cleanup is not processed yet
+        rtsp_streamer.streams[rtsp_url] = None
+        rtsp_streamer.add_client(rtsp_url, mock_websocket)
+        mock_start_stream.assert_not_called()
+
+        rtsp_streamer.close_stream(rtsp_url, idle=True)
+        await asyncio.sleep(0.01)
+
+        mock_start_stream.assert_called_once_with(rtsp_url)
+        assert rtsp_streamer.clients[rtsp_url] == [mock_websocket]
+        assert rtsp_url in rtsp_streamer.outputs
+        rtsp_streamer.remove_all_clients(rtsp_url)
+
+    @pytest.mark.asyncio
+    async def test_client_joining_stopped_output_gets_fresh_one(self, rtsp_streamer, mocker):
+        """
+        client that joined right after the outputs were stopped is not dropped by the stopping sender task
+        """
+        rtsp_url = 'rtsp://stopped_test'
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        first = MagicMock()
+        first.send_text = mocker.AsyncMock()
+        rtsp_streamer.add_client(rtsp_url, first)
+        old_queue = rtsp_streamer.queues[rtsp_url]
+
+        rtsp_streamer.stop_outputs(rtsp_url)
+        late = MagicMock()
+        late.send_text = mocker.AsyncMock()
+        rtsp_streamer.add_client(rtsp_url, late)
+        await asyncio.sleep(0.01)
+
+        assert rtsp_streamer.clients[rtsp_url] == [late]
+        assert rtsp_streamer.queues[rtsp_url] is not old_queue
+        await rtsp_streamer.send_to_clients(rtsp_url, Frame(b'\xff\xff\xff\xff', 1, 0.0))
+        await asyncio.sleep(0.01)
+        assert late.send_text.await_args.args[0] == 'data:image/jpeg;base64,/////w=='
+        first.send_text.assert_not_called()
+        rtsp_streamer.remove_all_clients(rtsp_url)
+
+    @pytest.mark.asyncio
+    async def test_warm_stream_stays_open(self, rtsp_streamer, mocker):
+        """
+        warm streams are opened without clients and survive the grace period until released
+        """
+        mock_capture = MagicMock()
+        mock_capture.isOpened.return_value = True
+        mock_capture.grab.return_value = True
+        mocker.patch('cv2.VideoCapture', return_value=mock_capture)
+        rtsp_streamer.idle_grace = 0
+
+        rtsp_streamer.keep_warm('rtsp://warm_test')
+        await asyncio.sleep(0.1)
+        assert rtsp_streamer.streams['rtsp://warm_test'] is mock_capture
+
+        rtsp_streamer.release_warm('rtsp://warm_test')
+        await asyncio.sleep(0.1)
+        assert 'rtsp://warm_test' not in rtsp_streamer.streams
+
+    @pytest.mark.asyncio
+    async def test_dropped_stream_reconnects(self, rtsp_streamer, mock_websocket, mocker):
+        """
+        dropped session is reopened with clients attached and the reconnect is counted
+        """
+        rtsp_url = 'rtsp://reconnect_test'
+        dropped = MagicMock()
+        dropped.isOpened.return_value = True
+        dropped.grab.side_effect = [True, False]
+        dropped.retrieve.return_value = (True, np.zeros((8, 8, 3), dtype=np.uint8))
+        reopened = MagicMock()
+        reopened.isOpened.return_value = True
+        reopened.grab.return_value = True
+        reopened.retrieve.return_value = (True, np.zeros((8, 8, 3), dtype=np.uint8))
+        mocker.patch('cv2.VideoCapture', side_effect=[dropped, reopened])
+        rtsp_streamer.reconnect_min_delay = 0.01
+        mocker.patch.object(rtsp_streamer, 'start_stream')
+        rtsp_streamer.add_client(rtsp_url, mock_websocket)
+
+        RTSPStreamer.start_stream(rtsp_streamer, rtsp_url)
+        await asyncio.sleep(0.1)
+
+        assert rtsp_streamer.reconnects[rtsp_url] == 1
+        assert rtsp_streamer.streams[rtsp_url] is reopened
+        assert rtsp_streamer.clients[rtsp_url] == [mock_websocket]
+        dropped.release.assert_called_once()
+        rtsp_streamer.idle_grace = 0
+        rtsp_streamer.remove_client(rtsp_url, mock_websocket)
+
+    @pytest.mark.asyncio
+    async def test_backoff_delay(self):
+        """
+        backoff doubles per attempt, is capped and jittered into the upper half
+        """
+        assert 0.5 <= backoff_delay(0, 1, 30) <= 1
+        assert 4 <= backoff_delay(3, 1, 30) <= 8
+        assert 15 <= backoff_delay(10, 1, 30) <= 30
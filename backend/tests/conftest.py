@@ -116,7 +116,7 @@ def mock_tapo_320ws_methods():
                 change_night_vision_status=lambda self: TAPO_320WS_TEST_DEFAULTS["change_night_vision_status"],
                 get_light_status=lambda self: TAPO_320WS_TEST_DEFAULTS["get_light_status"],
                 get_night_vision_status=lambda self: TAPO_320WS_TEST_DEFAULTS["get_night_vision_status"],
-                get_stream_url=lambda self: TAPO_320WS_TEST_DEFAULTS["get_stream_url"],
+                get_stream_url=lambda self, quality='high': TAPO_320WS_TEST_DEFAULTS["get_stream_url"],
                 get_time_correction=lambda self: TAPO_320WS_TEST_DEFAULTS["get_time_correction"],
                 get_recordings=lambda self, date: TAPO_320WS_TEST_DEFAULTS["get_recordings"],
                 get_events=lambda self: TAPO_320WS_TEST_DEFAULTS["get_events"],
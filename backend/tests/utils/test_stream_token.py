@@ -0,0 +1,30 @@
+"""
+Tests for stream_token module
+"""
+from app.utils.stream_token import QUERY_AUTH_PATHS, create_token, verify_token
+
+
+def test_token_valid_for_path_until_expiry():
+    """
+    Token opens its path until it expires, other paths and keys are refused
+    """
+    token = create_token('secret', '/tapo-320ws/mosaic/mjpeg', ttl=60, now=1000)
+
+    assert verify_token('secret', '/tapo-320ws/mosaic/mjpeg', token, now=1059)
+    assert not verify_token('secret', '/tapo-320ws/mosaic/mjpeg', token, now=1061)
+    assert not verify_token('secret', '/tapo-320ws/stream/mjpeg/TestCam', token, now=1000)
+    assert not verify_token('other', '/tapo-320ws/mosaic/mjpeg', token, now=1000)
+    assert not verify_token('secret', '/tapo-320ws/mosaic/mjpeg', 'garbage', now=1000)
+
+
+def test_query_auth_paths():
+    """
+    Only the MJPEG stream and download job event routes accept query authentication
+    """
+    assert QUERY_AUTH_PATHS.match('/tapo-320ws/stream/mjpeg/TestCam')
+    assert QUERY_AUTH_PATHS.match('/tapo-320ws/mosaic/mjpeg')
+    assert not QUERY_AUTH_PATHS.match('/tapo-320ws/stream/TestCam')
+    assert not QUERY_AUTH_PATHS.match('/tapo-320ws/stream/mjpeg/TestCam/other')
+    assert not QUERY_AUTH_PATHS.match('/tapo-320ws/recordings/TestCam')
+    assert QUERY_AUTH_PATHS.match('/tapo-320ws/recordings/jobs/0123abcd/events')
+    assert not QUERY_AUTH_PATHS.match('/tapo-320ws/recordings/jobs/0123abcd')